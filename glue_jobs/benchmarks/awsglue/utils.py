@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Local stand-in of awsglue.utils for running the jobs outside Glue
+
+Only put on sys.path by benchmarks/run_benchmarks.py and tests/conftest.py,
+the Glue runtime provides the real module.
+
+"""
+
+
+def getResolvedOptions(argv, options):
+    "Return {option: value} for the --option value pairs of argv, like the Glue one"
+    resolved = {}
+    for index, arg in enumerate(argv[:-1]):
+        if arg.startswith('--') and arg[2:] in options:
+            resolved[arg[2:]] = argv[index + 1]
+    missing = [option for option in options if option not in resolved]
+    if missing:
+        raise Exception(f"the following arguments are required: {', '.join(missing)}")
+    return resolved
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Offline benchmarks of the transformation Glue jobs
+
+Every job runs end to end (manifest listing -> transformations -> saves,
+as its __main__ does in Glue) against a local S3 / DynamoDB / Glue
+stand-in (moto server), on synthetic raw data at multiples of our
+production volumes (see SIZES). Each run is a fresh python process, so
+the import cost is included, and reports:
+
+    wall time, peak RSS (the job and its forked workers),
+    AWS requests per service / S3 operation, outputs written
+
+Only for local use, the Glue jobs do not need its requirements:
+moto[server], numpy, pandas, pyarrow. awsglue.utils comes from the
+stand-in next to this file.
+
+Usage:
+    python glue_jobs/benchmarks/run_benchmarks.py [--jobs ihs,covid] [--scales 1,10,100]
+        [--workers 1] [--output results.json] [--logs /tmp/bench-logs]
+
+"""
+
+# builtin imports
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import runpy
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+GLUE_JOBS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+REGION = 'us-east-1'
+# crawler job argument: data layer it crawls, one crawler per run bucket
+CRAWLERS = {'crawler_cleaneddata': 'cleaned-data', 'crawler_transformeddata': 'transformed-data'}
+# catalog database of the crawlers, its tables are where the jobs register partitions
+DATABASE = 'bench'
+RAW_FOLDER = '2023-01-01'
+
+# Volumes of one production run (1x), the scale multiplies the first (width) value of each job
+SIZES = {
+    'covid': {'states': 60, 'days': 1100},
+    'ihs': {'mnemonics': 1000, 'months': 360},
+    'fred': {'series': 50, 'months': 600},
+    'yahoofin': {'tickers': 30, 'days': 1260},
+    'meteostat': {'stations': 200, 'months': 24},
+    'moodys': {'series': 200, 'months': 360},
+}
+
+# Requests counted per operation, the other ones per service
+S3_OPERATIONS = ('ListObjectsV2', 'GetObject', 'HeadObject', 'PutObject', 'CopyObject',
+                 'CreateMultipartUpload', 'UploadPart', 'UploadPartCopy', 'CompleteMultipartUpload',
+                 'DeleteObject')
+REQUEST_KEYS = [f"s3.{operation}" for operation in S3_OPERATIONS] + ['s3.other', 'dynamodb', 'glue', 'other']
+
+
+def put_csv(s3, bucket, key, df, index=False):
+    "Upload a DataFrame as csv"
+    s3.put_object(Bucket=bucket, Key=key, Body=df.to_csv(index=index).encode('utf-8'))
+
+
+def put_mapper_table(dynamodb, table_name, key_attr, value_attr, pairs):
+    "Create a DynamoDB mapper table holding key_attr -> value_attr items"
+    table = dynamodb.create_table(
+        TableName=table_name,
+        KeySchema=[{'AttributeName': key_attr, 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': key_attr, 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST')
+    with table.batch_writer() as batch:
+        for key, value in pairs:
+            batch.put_item(Item={key_attr: key, value_attr: value})
+
+
+def seed_covid(s3, dynamodb, bucket, scale, rng):
+    "Covid cases and vaccine files of the US states, and the IRM population file"
+    import numpy as np
+    import pandas as pd
+    size = SIZES['covid']
+    states = [f"State {i}" for i in range(size['states'] * scale)]
+    days = pd.date_range('2020-03-01', periods=size['days']).strftime('%Y-%m-%d')
+    frame = pd.DataFrame({
+        'Province_State': np.repeat(states, len(days)),
+        'Country_Region': 'US',
+        'Date': np.tile(days, len(states)),
+    })
+    growth = rng.integers(0, 500, size=(len(states), len(days))).cumsum(axis=1).ravel()
+    cases = frame.assign(Confirmed=growth.astype(float), Deaths=(growth // 50).astype(float))
+    vaccine = frame.assign(People_at_least_one_dose=(growth * 3).astype(float),
+                           People_fully_vaccinated=(growth * 2).astype(float))
+    months = pd.date_range('2020-03-01', periods=size['days'] // 30, freq='MS').strftime('%Y-%m-%d')
+    irm = pd.DataFrame({
+        'Country': 'UNITED STATES',
+        'Province_State_': np.repeat([state.upper() for state in states], len(months)),
+        'Date': np.tile(months, len(states)),
+        'Population': rng.integers(500000, 40000000, size=len(states) * len(months)).astype(float),
+        'Inverse Risk Metric': rng.uniform(0, 1, size=len(states) * len(months)),
+    })
+    put_csv(s3, bucket, f"raw-data/covid/data/{RAW_FOLDER}/covidcases.csv", cases)
+    put_csv(s3, bucket, f"raw-data/covid/data/{RAW_FOLDER}/vaccinedata.csv", vaccine)
+    put_csv(s3, bucket, "raw-data/covid/covidexternal/covidexternal3.csv", irm)
+    return 'transformation-covid/krny_trnsf_covid.py', {
+        'folder': 'raw-data/covid', 'irm_file': 'raw-data/covid/covidexternal/covidexternal3.csv'}
+
+
+def seed_ihs(s3, dynamodb, bucket, scale, rng):
+    "One wide IHS file, one row per mnemonic and one column per month"
+    import pandas as pd
+    size = SIZES['ihs']
+    mnemonics = size['mnemonics'] * scale
+    months = pd.date_range('1994-01-01', periods=size['months'], freq='MS')
+    raw = pd.DataFrame(rng.normal(100, 20, size=(mnemonics, len(months))).round(3),
+                       columns=[f"{month.month}/1/{month.year}" for month in months])
+    raw.insert(0, 'New Mnemonic', [f"IHS{i}" for i in range(mnemonics)])
+    raw.insert(0, 'Short Label', [f"IHS series {i}" for i in range(mnemonics)])
+    raw.insert(0, 'Mnemonic', [f"ihs{i}" for i in range(mnemonics)])
+    put_csv(s3, bucket, f"raw-data/ihs/data/{RAW_FOLDER}/ihs economics.csv", raw)
+    return 'transformation-ihs/krny_trnsf_ihs.py', {'folder': 'raw-data/ihs'}
+
+
+def seed_fred(s3, dynamodb, bucket, scale, rng):
+    "One csv file per FRED series and the series mapper table"
+    import pandas as pd
+    size = SIZES['fred']
+    series = [f"FRED{i}" for i in range(size['series'] * scale)]
+    months = pd.date_range('1973-01-01', periods=size['months'], freq='MS').strftime('%Y-%m-%d')
+    for name in series:
+        put_csv(s3, bucket, f"raw-data/fred/{RAW_FOLDER}/{name}.csv",
+                pd.DataFrame({'DATE': months, name: rng.normal(size=len(months)).round(4)}))
+    table_name = f"{bucket}-fred"
+    put_mapper_table(dynamodb, table_name, 'Series_ID', 'Series_Name',
+                     [(name, f"FRED series {name}") for name in series])
+    return 'transformation-fred/krny_trnsf_fred.py', {'folder': 'raw-data/fred', 'mapper': table_name}
+
+
+def seed_yahoofin(s3, dynamodb, bucket, scale, rng):
+    "Daily open/close prices of the tickers and the ticker mapper table"
+    import numpy as np
+    import pandas as pd
+    size = SIZES['yahoofin']
+    tickers = [f"TCK{i}" for i in range(size['tickers'] * scale)]
+    days = pd.bdate_range('2018-01-01', periods=size['days']).strftime('%Y-%m-%d')
+    prices = rng.normal(100, 5, size=len(tickers) * len(days)).round(2)
+    raw = pd.DataFrame({
+        'Date': np.tile(days, len(tickers)),
+        'colname': np.repeat(tickers, len(days)),
+        'open': prices,
+        'close': prices + rng.normal(0, 1, size=len(prices)).round(2),
+    })
+    put_csv(s3, bucket, f"raw-data/yahoo_finance/{RAW_FOLDER}/yahoofin.csv", raw)
+    table_name = f"{bucket}-yahoofin"
+    put_mapper_table(dynamodb, table_name, 'ticker', 'ticker_name',
+                     [(ticker, f"Ticker {ticker}") for ticker in tickers])
+    return 'transformation-yahoofin/krny_trnsf_yahoofin.py', {
+        'folder': 'raw-data/yahoo_finance', 'table_name': table_name}
+
+
+def seed_meteostat(s3, dynamodb, bucket, scale, rng):
+    "Monthly weather of the stations, the station mapper and the state region file"
+    import numpy as np
+    import pandas as pd
+    size = SIZES['meteostat']
+    stations = [str(72000 + i) for i in range(size['stations'] * scale)]
+    months = pd.date_range('2021-01-01', periods=size['months'], freq='MS').strftime('%Y-%m-%d')
+    raw = pd.DataFrame({'time': np.tile(months, len(stations)),
+                        'stationID': np.repeat(stations, len(months))})
+    for column in ['tavg', 'tmin', 'tmax', 'prcp', 'wspd', 'pres', 'tsun']:
+        raw[column] = rng.normal(10, 5, size=len(raw)).round(1)
+    states = ['TX', 'NY', 'CA', 'FL', 'IL']
+    mapped = pd.DataFrame({'StationID': stations, 'region': [states[i % len(states)] for i in range(len(stations))]})
+    region = pd.DataFrame({'State Code': states, 'Region': ['S', 'NE', 'W', 'S', 'MW'],
+                           'State': ['Texas', 'New York', 'California', 'Florida', 'Illinois']})
+    put_csv(s3, bucket, f"raw-data/meteostat/data/{RAW_FOLDER}/Meteostat_clean.csv", raw)
+    put_csv(s3, bucket, "raw-data/meteostat/config/mapped_weather_stations.csv", mapped)
+    put_csv(s3, bucket, "raw-data/meteostat/config/us_state_region.csv", region)
+    return 'transformation-meteostat/krny_trnsf_meteostat.py', {
+        'folder': 'raw-data/meteostat',
+        'mapped_file': 'raw-data/meteostat/config/mapped_weather_stations.csv',
+        'region_file': 'raw-data/meteostat/config/us_state_region.csv'}
+
+
+def seed_moodys(s3, dynamodb, bucket, scale, rng):
+    "Wide Moody's files of both sources (monthly and quarterly) and their mnemonics"
+    import pandas as pd
+    size = SIZES['moodys']
+    columns = [f"MDY{i}" for i in range(size['series'] * scale)]
+    months = pd.date_range('1994-01-31', periods=size['months'], freq='M').strftime('%Y-%m-%d')
+    quarters = pd.period_range('1994Q1', periods=size['months'] // 3, freq='Q').astype(str)
+    sources = {}
+    for name, date_column, periods in [('moodys_all', 'Date', months), ('moodys_188', 'date', quarters)]:
+        sources[name] = {'folder': f"raw-data/{name}/data", 'config': f"raw-data/{name}/config",
+                         'date_column': date_column}
+        raw = pd.DataFrame(rng.normal(size=(len(periods), len(columns))).round(4), columns=columns)
+        raw.insert(0, date_column, periods)
+        put_csv(s3, bucket, f"raw-data/{name}/data/{RAW_FOLDER}/{name}.csv", raw)
+        put_csv(s3, bucket, f"raw-data/{name}/config/{name}_mnemonics.csv",
+                pd.DataFrame({'mnemonic': columns, 'description': columns}))
+    return 'transformation-moodys/krny_trnsf_moodys.py', {'sources': json.dumps(sources)}
+
+
+def seed_pipeline(s3, dynamodb, bucket, scale, rng):
+    "The data of every job in one bucket, run as the stages of the pipeline job"
+    stage_args = {}
+    for job, seed in JOBS.items():
+        if job != 'pipeline':
+            stage_args[job] = seed(s3, dynamodb, bucket, scale, rng)[1]
+    return 'transformation-pipeline/krny_trnsf_pipeline.py', {'stage_args': json.dumps(stage_args)}
+
+
+JOBS = {
+    'covid': seed_covid,
+    'ihs': seed_ihs,
+    'fred': seed_fred,
+    'yahoofin': seed_yahoofin,
+    'meteostat': seed_meteostat,
+    'moodys': seed_moodys,
+    'pipeline': seed_pipeline,
+}
+
+
+def count_requests(counts):
+    "Count the AWS API calls of this process (and its forked workers) in the shared counts"
+    import boto3
+
+    def before_call(event_name, **kwargs):
+        _, service, operation = event_name.split('.', 2)
+        if service == 's3':
+            key = f"s3.{operation}" if f"s3.{operation}" in REQUEST_KEYS else 's3.other'
+        else:
+            key = service if service in REQUEST_KEYS else 'other'
+        with counts.get_lock():
+            counts[REQUEST_KEYS.index(key)] += 1
+
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register('before-call', before_call)
+
+
+def run_child(script, argv, result_file):
+    "Run one job script as __main__ in this process and write its measures to result_file"
+    sys.path[:0] = [GLUE_JOBS_DIR, BENCHMARKS_DIR]
+    counts = multiprocessing.Array('q', len(REQUEST_KEYS))
+    count_requests(counts)
+
+    status = 'ok'
+    started = time.perf_counter()
+    sys.argv = [script] + argv
+    try:
+        runpy.run_path(os.path.join(GLUE_JOBS_DIR, script), run_name='__main__')
+    except SystemExit as err:
+        if err.code not in (None, 0):
+            status = f"exit {err.code}"
+    except Exception as err:
+        status = f"error: {err}"
+    wall = time.perf_counter() - started
+
+    # ru_maxrss is in KB on linux, the children are the forked workers of parallel.run_folders
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    with open(result_file, 'w') as result:
+        json.dump({
+            'status': status,
+            'wall_s': round(wall, 3),
+            'peak_rss_mb': round(peak_rss / 1024, 1),
+            'requests': {key: count for key, count in zip(REQUEST_KEYS, counts) if count},
+        }, result)
+
+
+def free_port():
+    "A free local TCP port for the moto server"
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def count_outputs(s3, bucket):
+    "Number of objects written to the cleaned and transformed layers"
+    paginator = s3.get_paginator('list_objects_v2')
+    return sum(len(page.get('Contents', []))
+               for prefix in ('cleaned-data/', 'transformed-data/')
+               for page in paginator.paginate(Bucket=bucket, Prefix=prefix))
+
+
+def run_benchmark(job, scale, workers, env, logs_dir):
+    "Seed a bucket for job at scale, run the job in a child process and return its measures"
+    import boto3
+    import numpy as np
+    s3 = boto3.client('s3')
+    dynamodb = boto3.resource('dynamodb')
+    bucket = f"bench-{job}-{scale}x"
+    s3.create_bucket(Bucket=bucket)
+    glue = boto3.client('glue')
+    crawlers = {}
+    for argument, layer in CRAWLERS.items():
+        crawlers[argument] = f"{bucket}-{layer}"
+        glue.create_crawler(Name=crawlers[argument], Role='benchmark', DatabaseName=DATABASE,
+                            Targets={'S3Targets': [{'Path': f"s3://{bucket}/{layer}"}]})
+    script, job_args = JOBS[job](s3, dynamodb, bucket, scale, np.random.default_rng(0))
+    job_args = {'bucket': bucket, **crawlers, 'workers': str(workers), **job_args}
+    argv = [item for name, value in job_args.items() for item in (f"--{name}", value)]
+
+    log_file = os.path.join(logs_dir, f"{job}-{scale}x.log")
+    result_file = os.path.join(logs_dir, f"{job}-{scale}x.json")
+    with open(log_file, 'w') as log:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', script,
+                                  result_file, '--'] + argv,
+                                 env=env, stdout=log, stderr=subprocess.STDOUT)
+    if process.returncode or not os.path.exists(result_file):
+        return {'job': job, 'scale': scale, 'status': f"failed, see {log_file}"}
+    with open(result_file) as result:
+        measures = json.load(result)
+    return {'job': job, 'scale': scale, **measures, 'outputs': count_outputs(s3, bucket), 'log': log_file}
+
+
+def print_results(results):
+    "Print the measures as a table"
+    print(f"{'job':<10} {'scale':>5} {'wall s':>8} {'RSS MB':>8} {'S3 req':>7} {'outputs':>7}  status / requests")
+    for result in results:
+        requests = result.get('requests', {})
+        s3_requests = sum(count for key, count in requests.items() if key.startswith('s3.'))
+        print(f"{result['job']:<10} {result['scale']:>4}x {result.get('wall_s', '-'):>8} "
+              f"{result.get('peak_rss_mb', '-'):>8} {s3_requests:>7} {result.get('outputs', '-'):>7}  "
+              f"{result['status']} {requests}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the transformation Glue jobs")
+    parser.add_argument('--jobs', default=','.join(JOBS), help="comma separated jobs (default all)")
+    parser.add_argument('--scales', default='1,10,100', help="comma separated multiples of the production volumes")
+    parser.add_argument('--workers', type=int, default=1, help="--workers passed to the jobs")
+    parser.add_argument('--output', help="json file the results are written to")
+    parser.add_argument('--logs', help="directory of the job logs (default a temp dir)")
+    options = parser.parse_args()
+
+    from moto.server import ThreadedMotoServer
+    import boto3
+
+    # the moto server logs every request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    env = dict(os.environ, AWS_ENDPOINT_URL=f"http://127.0.0.1:{port}", AWS_DEFAULT_REGION=REGION,
+               AWS_ACCESS_KEY_ID='benchmark', AWS_SECRET_ACCESS_KEY='benchmark')
+    os.environ.update(env)
+    logs_dir = options.logs or tempfile.mkdtemp(prefix='glue-bench-')
+    os.makedirs(logs_dir, exist_ok=True)
+
+    results = []
+    try:
+        boto3.client('glue').create_database(DatabaseInput={'Name': DATABASE})
+        for job in options.jobs.split(','):
+            for scale in [int(scale) for scale in options.scales.split(',')]:
+                print(f"Running {job} at {scale}x ...", flush=True)
+                results.append(run_benchmark(job, scale, options.workers, env, logs_dir))
+    finally:
+        server.stop()
+
+    print_results(results)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    print(f"Job logs in {logs_dir}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        # run_benchmarks.py --child <script> <result file> -- <job arguments>
+        run_child(sys.argv[2], sys.argv[5:], sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: This programe starts the crawls requested while a crawler was running
+
+The transformation jobs do not wait for a busy crawler, their crawl
+requests stay pending in the crawl state (see krny_common.crawls). This
+job is run when a crawl finishes, by an EventBridge rule on the
+"Glue Crawler State Change" event of the crawlers (state Succeeded or
+Failed), and starts one crawl for all the pending prefixes of each of them.
+Nothing is started when nothing is pending, so the crawl it starts does
+not chain further crawls.
+
+Usage: This script meant for AWS Glue Job -pythonshell
+with Job Parameters as:
+    --bucket: <bucketname>
+    --crawler_cleaneddata: <crawler name for cleaned data>
+    --crawler_transformeddata: <crawler name for tarnsformed data>
+
+"""
+
+__author__ = "Divesh Chandolia"
+__copyright__ = "Copyright 2023, Kearney Sensing Solution"
+__version__ = "1.0.1"
+__maintainer__ = "Divesh Chandolia"
+__email__ = "dchand01@atkearney.com"
+__date__ = "March 2023"
+
+# builtin imports
+import logging
+import sys
+
+# Shared helpers
+from krny_common import crawls
+
+# Platform specific imports
+from awsglue.utils import getResolvedOptions
+args = getResolvedOptions(sys.argv, [
+    'bucket',
+    'crawler_cleaneddata',
+    'crawler_transformeddata'
+])
+
+BUCKET = args.get('bucket')
+
+# get crawler name
+CRAWLER1 = args.get('crawler_cleaneddata')
+CRAWLER2 = args.get('crawler_transformeddata')
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+
+if __name__ == "__main__":
+    logger.info("-- start --")
+    started = crawls.follow_up(BUCKET, [CRAWLER1, CRAWLER2])
+    logger.info(f"-- end -- crawlers started: {started}")
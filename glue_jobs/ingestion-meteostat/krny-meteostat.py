@@ -1,14 +1,17 @@
 import json
 import boto3
 import pandas as pd
-import os
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from meteostat import Point, Monthly
 from io import StringIO
 import sys
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from awsglue.utils import getResolvedOptions
+from krny_common import s3io, startup, STATE_DIR
 
 
 #opening sesion
@@ -22,11 +25,10 @@ handler = logging.StreamHandler(sys.stdout)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
 logger.addHandler(handler)
+startup.log_import_time()
 
 #getting data incremental
 today = datetime.today()
-Point.cache_dir = '/tmp'
-Monthly.cache_dir = '/tmp'
 
 try:
     #getting data from environment variable
@@ -40,6 +42,22 @@ except Exception as err:
     logger.error(f"Error while reading environmental variables : {err}")
     sys.exit(0)
 
+#station fetching: parallel fetches, attempts per station and deadline (seconds) of a station,
+#all its attempts included, counted from the start of its fetch
+FETCH_WORKERS = int(getResolvedOptions(sys.argv, ['fetch_workers'])['fetch_workers']) \
+    if '--fetch_workers' in sys.argv else 8
+FETCH_RETRIES = 3
+STATION_DEADLINE = 180
+
+Point.cache_dir = '/tmp'
+Monthly.cache_dir = '/tmp'
+#the worker /tmp starts empty, nothing to clean, and the meteostat autoclean races between fetch threads
+Monthly.autoclean = False
+
+#per station high-water marks: last complete month already fetched for each station
+STATE_FILE = f"{STATE_DIR}/meteostat/station_high_water_marks.json"
+MONTH_FORMAT = "%Y-%m-%d"
+
 
 #reading mapper
 finalweatherst_df = pd.read_csv(mapped_station_by_city,index_col=0)
@@ -51,36 +69,127 @@ result = s3_client.list_objects(Bucket=bucket_name, Prefix=folder, Delimiter='/'
 for prefix in result.get('CommonPrefixes', list()):
     p1 = prefix.get('Prefix', '')
     folders.append(p1)
-if not folders:
-    five_yrs_ago = datetime.now() + relativedelta(years=-5)
-else:
-    five_yrs_ago = datetime.now() + relativedelta(months=-3)
-    
-    
-    
-def weatherdata_fetch(df):
-    for i in range(len(df)):
-        station=df['StationID'][i]
-        data = Monthly(station, start = five_yrs_ago, end = today)
-        data = data.fetch()
-        data['stationID']=df['StationID'][i]
-        wlist.append(data)
-        final_data = pd.concat(wlist)
-    return final_data
-finalweatherdata_df = weatherdata_fetch(finalweatherst_df)
-    
-    
+#window of the stations without a high-water mark: 5 years backfill,
+#3 months for the stations of the runs made before the marks existed
+five_yrs_ago = datetime.now() + relativedelta(years=-5)
+three_months_ago = datetime.now() + relativedelta(months=-3)
+current_month = datetime(today.year, today.month, 1)
+
+
+def read_high_water_marks():
+    "It reads {station: last complete month}, None if the state file does not exist yet"
+    try:
+        return json.loads(s3io.get_object(bucket_name, STATE_FILE))
+    except s3io.get_client().exceptions.NoSuchKey:
+        logger.info(f"No station high-water marks at {STATE_FILE}")
+        return None
+    except Exception as err:
+        logger.error(f"Error while reading station high-water marks : {err}")
+        sys.exit(0)
+
+
+def station_start(station, marks, default_start):
+    "First month to fetch for a station (str ID), the month after its high-water mark"
+    if station in marks:
+        return datetime.strptime(marks[station], MONTH_FORMAT) + relativedelta(months=1)
+    return default_start
+
+
+def fetch_station(station, start, end, started, events):
+    "Fetch the monthly data of one station, retried with a backoff until its deadline"
+    started[station] = time.monotonic()
+    events[station].set()
+    deadline = started[station] + STATION_DEADLINE
+    for attempt in range(1, FETCH_RETRIES + 1):
+        try:
+            data = Monthly(station, start = start, end = end)
+            data = data.fetch()
+            data['stationID']=station
+            return data
+        except Exception as err:
+            logger.warning(f"Station {station} fetch failed (attempt {attempt}/{FETCH_RETRIES}): {err}")
+            if attempt == FETCH_RETRIES or time.monotonic() + 2 ** attempt >= deadline:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def station_result(station, future, started, events):
+    """
+    Wait for the fetch of a station until its deadline, TimeoutError past it.
+    A station not started within a deadline (all workers stuck) fails too.
+    """
+    if not events[station].wait(STATION_DEADLINE):
+        future.cancel()
+        raise TimeoutError(f"not started after {STATION_DEADLINE}s")
+    return future.result(timeout=max(0, started[station] + STATION_DEADLINE - time.monotonic()))
+
+
+def weatherdata_fetch(df, marks, default_start):
+    """
+    Fetch every station of the mapper from the month after its high-water mark,
+    with a bounded pool. Stations failing all attempts are skipped.
+    Returns the new rows and the updated marks.
+    """
+    # str IDs: the marks are read back from json with str keys, the mapper can give ints
+    stations = list(dict.fromkeys(df['StationID'].astype(str)))
+    new_marks = dict(marks)
+    failed = []
+    started, events = {}, {station: threading.Event() for station in stations}
+    executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+    try:
+        futures = [executor.submit(fetch_station, station, station_start(station, marks, default_start), today,
+                                   started, events)
+                   for station in stations]
+        for station, future in zip(stations, futures):
+            try:
+                data = station_result(station, future, started, events)
+            except Exception as err:
+                logger.error(f"Error while fetching station {station} : {err!r}")
+                failed.append(station)
+                continue
+            wlist.append(data)
+            # the current month is still partial, it is fetched again by the next run
+            complete = data.index[data.index < current_month]
+            if len(complete):
+                new_marks[station] = complete.max().strftime(MONTH_FORMAT)
+    finally:
+        # a fetch past its deadline is not waited for: the data is saved and the transformation
+        # started without it, only the process exit still waits for its http read
+        executor.shutdown(wait=False, cancel_futures=True)
+    if failed:
+        logger.error(f"{len(failed)} of {len(stations)} stations not fetched : {failed}")
+    new_stations = [station for station in stations if station not in marks]
+    logger.info(f"{len(stations)} stations, {len(new_stations)} without high-water mark")
+    return (pd.concat(wlist) if wlist else pd.DataFrame()), new_marks
+
+
+marks = read_high_water_marks()
+default_start = five_yrs_ago
+if marks is None:
+    marks = {}
+    if folders:
+        default_start = three_months_ago
+finalweatherdata_df, new_marks = weatherdata_fetch(finalweatherst_df, marks, default_start)
+
+if finalweatherdata_df.empty:
+    logger.info("No new station data to save")
+    sys.exit(0)
+
 #Parsing it into S3 bucket
 now = datetime.now()
 date_time = now.strftime("%Y-%m-%d")
-filename = folder + date_time + '/' + file_name + '.csv'
+#one new file per run, a later run of the same day does not rewrite a file already processed
+filename = folder + date_time + '/' + file_name + '_' + now.strftime("%H%M%S%f") + '.csv'
 csv_buffer = StringIO()
 finalweatherdata_df.to_csv(csv_buffer)
 try:
     s3_client.put_object(Bucket=bucket_name, ContentType='text/csv', Key=filename, Body=csv_buffer.getvalue())
+    s3io.put_object(bucket_name, STATE_FILE, json.dumps(new_marks).encode('utf-8'),
+                    wait=True, ContentType='application/json')
 except Exception as err:
     logger.error(f"Error while saving : {err}")
-        
+    sys.exit(0)
+
 try:
     #glue job invocation
     runId = glue.start_job_run(JobName=gluejobname)
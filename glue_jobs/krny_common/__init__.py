@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Shared helpers for the kearney sensing solution Glue jobs
+
+This package is shipped to every Glue job with `--extra-py-files`
+(see buildspec/*.yml) so the job scripts can import it as `krny_common`.
+
+"""
+
+__author__ = "Divesh Chandolia"
+__copyright__ = "Copyright 2023, Kearney Sensing Solution"
+__version__ = "1.0.1"
+__maintainer__ = "Divesh Chandolia"
+__email__ = "dchand01@atkearney.com"
+__date__ = "March 2023"
+
+# Data layers in the S3 bucket
+RAW_DIR = 'raw-data'
+CLEANED_DIR = 'cleaned-data'
+TRANSFORMED_DIR = 'transformed-data'
+
+# Job state (manifests etc.), kept outside the crawled layers
+STATE_DIR = 'job-state'
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Direct Glue Data Catalog partition registration for the job outputs
+
+The s3io writers record every file saved in this run with its format and
+columns (see s3io.pop_outputs()). `publish()` then makes them queryable
+without a crawl: for each crawler given, the outputs under its S3 targets
+are matched with the tables of its catalog database (the table whose
+location holds the output folder) and the new folders are added as
+partitions with batch_create_partition.
+
+A crawl is requested instead (see krny_common.crawls), for all of the
+outputs of the crawler, when they do not fit its tables:
+
+    no table holds the output (new dataset, first run)
+    the columns differ from the table ones (schema change)
+    the folder depth does not match the table partition keys
+    the schema is unknown (eg. a file copied as is)
+
+CSV columns are compared by name and order only, the crawler infers their
+types from the data. PARQUET columns are compared by name and type.
+
+When several jobs share a process (pipeline runner), DEFERRED makes
+publish() keep the outputs for one publish() of all of them at the end.
+
+Usage:
+    catalog.publish(BUCKET, [CRAWLER1, CRAWLER2], s3io.pop_outputs())
+
+"""
+
+# builtin imports
+import logging
+import posixpath
+
+from krny_common import s3io, crawls
+
+logger = logging.getLogger(__name__)
+
+# batch_create_partition accepts at most 100 partitions per call
+MAX_BATCH_PARTITIONS = 100
+# set by a caller publishing the outputs itself, see publish()
+DEFERRED = False
+
+
+def csv_columns(df, index=False):
+    "Catalog columns [(name, type)] of df written as csv"
+    columns = [(name, df.index.get_level_values(i).dtype) for i, name in enumerate(df.index.names)] \
+        if index else []
+    columns += [(name, dtype) for name, dtype in df.dtypes.items()]
+    types = []
+    for name, dtype in columns:
+        if dtype.kind == 'b':
+            glue_type = 'boolean'
+        elif dtype.kind in 'iu':
+            glue_type = 'bigint'
+        elif dtype.kind == 'f':
+            glue_type = 'double'
+        else:
+            glue_type = 'string'
+        types.append(('' if name is None else str(name), glue_type))
+    return types
+
+
+def parquet_columns(schema):
+    "Catalog columns [(name, type)] of an arrow schema"
+    import pyarrow as pa
+
+    types = []
+    for field in schema:
+        if pa.types.is_boolean(field.type):
+            glue_type = 'boolean'
+        elif pa.types.is_integer(field.type):
+            glue_type = 'bigint' if field.type.bit_width == 64 else 'int'
+        elif pa.types.is_floating(field.type):
+            glue_type = 'double' if field.type.bit_width == 64 else 'float'
+        elif pa.types.is_timestamp(field.type):
+            glue_type = 'timestamp'
+        elif pa.types.is_date(field.type):
+            glue_type = 'date'
+        else:
+            glue_type = 'string'
+        types.append((field.name, glue_type))
+    return types
+
+
+def _folder(path):
+    "s3 url path with exactly one trailing slash"
+    return path.rstrip('/') + '/'
+
+
+def crawler_targets(crawler):
+    "Return (database name, [s3 target folders]) of a crawler"
+    response = s3io.get_client('glue').get_crawler(Name=crawler)['Crawler']
+    targets = [_folder(target['Path']) for target in response.get('Targets', {}).get('S3Targets', [])]
+    return response.get('DatabaseName'), targets
+
+
+def get_tables(database):
+    "Yield the catalog tables of database"
+    paginator = s3io.get_client('glue').get_paginator('get_tables')
+    for page in paginator.paginate(DatabaseName=database):
+        for table in page.get('TableList', []):
+            yield table
+
+
+def schema_change(table, output):
+    "Describe how output does not fit the table columns, None when it fits"
+    if output.get('columns') is None:
+        return f"schema of {output['key']} unknown"
+    classification = table.get('Parameters', {}).get('classification')
+    if classification and classification != output['format']:
+        return f"{output['key']} is {output['format']}, table {table['Name']} is {classification}"
+    table_columns = [(column['Name'].lower(), column['Type'].lower())
+                     for column in table['StorageDescriptor'].get('Columns', [])]
+    columns = [(name.lower(), glue_type) for name, glue_type in output['columns']]
+    if output['format'] == 'csv':
+        fits = [name for name, _ in columns] == [name for name, _ in table_columns]
+    else:
+        fits = sorted(columns) == sorted(table_columns)
+    if not fits:
+        return f"columns of {output['key']} differ from table {table['Name']}"
+    return None
+
+
+def plan_partitions(database, outputs):
+    """
+    Match outputs with the tables of database. Return
+    ({table name: {partition values: (location, table)}}, None) or
+    (None, reason) when an output does not fit.
+    """
+    tables = sorted(((_folder(table['StorageDescriptor']['Location']), table)
+                     for table in get_tables(database) if table.get('StorageDescriptor', {}).get('Location')),
+                    key=lambda item: len(item[0]), reverse=True)
+    partitions = {}
+    for output in outputs:
+        url = f"s3://{output['bucket']}/{output['key']}"
+        folder = _folder(posixpath.dirname(url))
+        # a table can also be a single file (location = the file itself)
+        match = next(((location, table) for location, table in tables
+                      if folder.startswith(location) or location == _folder(url)),
+                     None)
+        if match is None:
+            return None, f"no table for {output['key']}"
+        location, table = match
+        reason = schema_change(table, output)
+        if reason:
+            return None, reason
+        keys = table.get('PartitionKeys', [])
+        # hive style folders (key=value) keep the value only
+        values = tuple(part.split('=', 1)[-1] for part in folder[len(location):].split('/') if part) \
+            if folder.startswith(location) else ()
+        if len(values) != len(keys):
+            return None, f"{output['key']} does not match the partitions of table {table['Name']}"
+        if values:
+            partitions.setdefault(table['Name'], {})[values] = (folder, table)
+    return partitions, None
+
+
+def register_partitions(database, partitions):
+    "Add the planned partitions to their tables, the existing ones are left as is"
+    glue = s3io.get_client('glue')
+    for table_name, table_partitions in partitions.items():
+        inputs = []
+        for values, (location, table) in table_partitions.items():
+            descriptor = dict(table['StorageDescriptor'], Location=location)
+            inputs.append({'Values': list(values), 'StorageDescriptor': descriptor,
+                           'Parameters': table.get('Parameters', {})})
+        added = 0
+        for start in range(0, len(inputs), MAX_BATCH_PARTITIONS):
+            batch = inputs[start:start + MAX_BATCH_PARTITIONS]
+            response = glue.batch_create_partition(DatabaseName=database, TableName=table_name,
+                                                   PartitionInputList=batch)
+            errors = [error for error in response.get('Errors', [])
+                      if error.get('ErrorDetail', {}).get('ErrorCode') != 'AlreadyExistsException']
+            if errors:
+                raise Exception(f"Partitions of {table_name} not added: {errors}")
+            added += len(batch) - len(response.get('Errors', []))
+        logger.info(f"{added} partitions added to {database}.{table_name}")
+
+
+def publish(bucket, crawlers, outputs):
+    """
+    Make the outputs queryable: their partitions are added to the catalog
+    tables of the crawler crawling them, a crawl is scheduled (crawl state
+    kept in bucket) for a crawler whose outputs do not fit its tables.
+    Return the crawlers started by this job.
+    """
+    if DEFERRED:
+        # kept for the caller that deferred the publishing
+        s3io.record_outputs(outputs)
+        return []
+    to_crawl = {}
+    for crawler in crawlers:
+        crawled = []
+        try:
+            database, targets = crawler_targets(crawler)
+            crawled = [output for output in outputs
+                       if any(f"s3://{output['bucket']}/{output['key']}".startswith(target) for target in targets)]
+            if not crawled:
+                continue
+            if database is None:
+                reason = "no catalog database"
+            else:
+                partitions, reason = plan_partitions(database, crawled)
+                if reason is None:
+                    register_partitions(database, partitions)
+                    continue
+        except Exception as err:
+            reason = f"{err}"
+        logger.info(f"Crawl of {crawler} needed: {reason}")
+        to_crawl[crawler] = sorted({posixpath.dirname(f"s3://{output['bucket']}/{output['key']}") + '/'
+                                    for output in crawled})
+    return crawls.schedule(bucket, to_crawl)
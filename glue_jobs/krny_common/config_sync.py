@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Conditional server side copy of config files published by the jobs
+
+Some jobs publish a config file as is to the transformed layer (eg. the
+Moody's mnemonics). `sync_objects()` copies such files only when they
+changed: the ETag of the source is kept in the metadata of the copy
+(x-amz-meta-source-etag) and compared with a HEAD of both objects, so an
+unchanged file costs two HEAD requests instead of a copy (and a crawler
+re-scan of its folder).
+
+The copy runs on the S3 side, as a multipart copy above
+MULTIPART_THRESHOLD, whose ETag then differs from the source one, hence
+the metadata. A copy made before this module (same ETag, no metadata)
+counts as up to date.
+
+Usage:
+    copied = config_sync.sync_objects(BUCKET, [(CONFIG_FILE, PUBLISHED_FILE), ...])
+
+"""
+
+# builtin imports
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Lib
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from krny_common import s3io
+
+logger = logging.getLogger(__name__)
+
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 64 * 1024 * 1024
+ETAG_METADATA = 'source-etag'
+
+
+def _head(bucket, key):
+    "HEAD of an object, None when it does not exist"
+    try:
+        return s3io.get_client().head_object(Bucket=bucket, Key=key)
+    except ClientError as err:
+        if err.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+
+def is_up_to_date(source, destination):
+    "True when the destination HEAD is a copy of the source HEAD"
+    if destination is None:
+        return False
+    etag = source['ETag']
+    return destination.get('Metadata', {}).get(ETAG_METADATA) == etag or destination['ETag'] == etag
+
+
+def sync_object(bucket, src_key, dst_key, dst_bucket=None):
+    "Copy src_key to dst_key on the S3 side when it changed, return True when copied"
+    dst_bucket = dst_bucket or bucket
+    source = _head(bucket, src_key)
+    if source is None:
+        raise Exception(f"Config file {src_key} not found")
+    if is_up_to_date(source, _head(dst_bucket, dst_key)):
+        logger.info(f"{dst_key} is up to date with {src_key}")
+        return False
+
+    logger.info(f"Copying {src_key} to {dst_key} ({source['ContentLength']} bytes)")
+    extra_args = {
+        'Metadata': {**source.get('Metadata', {}), ETAG_METADATA: source['ETag']},
+        'MetadataDirective': 'REPLACE',
+    }
+    if source.get('ContentType'):
+        extra_args['ContentType'] = source['ContentType']
+    config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                            multipart_chunksize=MULTIPART_CHUNKSIZE,
+                            max_concurrency=s3io.MAX_WORKERS)
+    s3io.get_client().copy({'Bucket': bucket, 'Key': src_key}, dst_bucket, dst_key,
+                           ExtraArgs=extra_args, Config=config)
+    # copied as is, the catalog leaves its schema to the crawler
+    s3io.record_outputs([{'bucket': dst_bucket, 'key': dst_key, 'format': None, 'columns': None}])
+    return True
+
+
+def sync_objects(bucket, pairs, dst_bucket=None):
+    """
+    Sync every (src_key, dst_key) pair concurrently. Return the dst_keys
+    copied, a failed pair is logged and left out.
+    """
+    pairs = list(pairs)
+    copied = []
+    if not pairs:
+        return copied
+    with ThreadPoolExecutor(max_workers=min(len(pairs), s3io.MAX_WORKERS)) as executor:
+        futures = [s3io.submit(executor, sync_object, bucket, src_key, dst_key, dst_bucket)
+                   for src_key, dst_key in pairs]
+        for (src_key, dst_key), future in zip(pairs, futures):
+            try:
+                if future.result():
+                    copied.append(dst_key)
+            except Exception as err:
+                logger.error(f"Error while syncing {src_key} to {dst_key}: {err}")
+    return copied
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Crawler scheduling shared by all the Glue jobs
+
+The jobs share the cleaned-data and transformed-data crawlers. Started by
+every job on its own, the crawls overlap and the start_crawler calls of
+jobs finishing together fail with CrawlerRunningException. The jobs
+request a crawl here instead, with the prefixes they changed, and the
+requests are coalesced in a small state object per crawler
+(job-state/crawls/<crawler>.json), updated with conditional writes
+(s3io.put_if_match):
+
+    pending      prefixes changed and not crawled yet
+    running      prefixes covered by the crawl in progress, since started_at
+
+`schedule()` does not wait for the crawler: the crawl is started right
+away when the crawler is idle, otherwise the prefixes stay pending. When
+a crawl finishes, the "Glue Crawler State Change" event runs the crawl
+follow-up job (crawl-followup/krny_crawl_followup.py) and its
+`follow_up()` starts one crawl for all the prefixes requested meanwhile.
+So there is at most one crawl per crawler at a time and no job pays for
+waiting on a crawler. Without the event rule, the pending prefixes are
+crawled when the next job schedules a crawl.
+
+A crawl always covers the crawler targets, the prefixes record what each
+crawl was requested for.
+
+Usage:
+    started = crawls.schedule(BUCKET, {CRAWLER1: ['s3://bucket/cleaned-data/fred/data/2023-01-01/']})
+
+    # crawl follow-up job
+    started = crawls.follow_up(BUCKET, [CRAWLER1, CRAWLER2])
+
+"""
+
+# builtin imports
+import json
+import logging
+import time
+
+# Lib
+from botocore.exceptions import ClientError
+
+from krny_common import s3io, STATE_DIR
+
+logger = logging.getLogger(__name__)
+
+# a crawler reported finished can still be stopping, follow_up() waits for it to be ready
+READY_WAIT_SECONDS = 300
+POLL_SECONDS = 15
+UPDATE_ATTEMPTS = 10
+
+
+def state_path(crawler):
+    "S3 key of the scheduling state of a crawler"
+    return f"{STATE_DIR}/crawls/{crawler}.json"
+
+
+def load_state(bucket, crawler):
+    "Return (state dict, ETag) of a crawler, (empty state, None) when there is none yet"
+    try:
+        response = s3io.get_client().get_object(Bucket=bucket, Key=state_path(crawler))
+    except s3io.get_client().exceptions.NoSuchKey:
+        return {'pending': [], 'running': [], 'started_at': None}, None
+    return json.loads(response['Body'].read()), response['ETag']
+
+
+def update_state(bucket, crawler, change):
+    """
+    Apply change(state) to the state of a crawler and write it back when it
+    changed, the read and change are done again when another job wrote it
+    in between. Return what change returned.
+    """
+    for attempt in range(1, UPDATE_ATTEMPTS + 1):
+        state, etag = load_state(bucket, crawler)
+        before = json.dumps(state, sort_keys=True)
+        result = change(state)
+        if json.dumps(state, sort_keys=True) == before or \
+                s3io.put_if_match(bucket, state_path(crawler), json.dumps(state).encode('utf-8'), etag):
+            return result
+        logger.info(f"Crawl state of {crawler} changed by another job (attempt {attempt}/{UPDATE_ATTEMPTS})")
+        time.sleep(attempt / 2)
+    raise Exception(f"Crawl state of {crawler} not saved after {UPDATE_ATTEMPTS} attempts")
+
+
+def request(bucket, crawler, prefixes):
+    "Add prefixes to the pending crawl of crawler"
+
+    def add(state):
+        state['pending'] = sorted(set(state['pending']) | set(prefixes))
+
+    update_state(bucket, crawler, add)
+    logger.info(f"Crawl of {crawler} requested for {len(prefixes)} prefixes")
+
+
+def crawler_status(crawler):
+    "Return (state READY / RUNNING / STOPPING, start time of its last crawl or None)"
+    response = s3io.get_client('glue').get_crawler(Name=crawler)['Crawler']
+    started = response.get('LastCrawl', {}).get('StartTime')
+    return response.get('State'), started.timestamp() if started else None
+
+
+def start_pending(bucket, crawler):
+    """
+    Start the pending crawl of crawler if the crawler is ready. Return
+    'started', 'idle' (nothing pending), 'running' or 'stopping' (not ready).
+    """
+    status, last_start = crawler_status(crawler)
+
+    def claim(state):
+        if status != 'READY':
+            return 'stopping' if status == 'STOPPING' else 'running'
+        if state['running'] and (last_start is None or last_start < state['started_at']):
+            # the previous claim never started its crawl, it is done again
+            state['pending'] = sorted(set(state['pending']) | set(state['running']))
+            state['running'] = []
+        if not state['pending']:
+            return 'idle'
+        state['running'], state['started_at'] = state['pending'], time.time()
+        state['pending'] = []
+        return 'started'
+
+    outcome = update_state(bucket, crawler, claim)
+    if outcome != 'started':
+        return outcome
+    try:
+        s3io.get_client('glue').start_crawler(Name=crawler)
+    except ClientError as err:
+        # started out of the scheduling (eg. from the console), the prefixes are pending again
+        logger.warning(f"Crawler {crawler} not started: {err}")
+
+        def release(state):
+            state['pending'] = sorted(set(state['pending']) | set(state['running']))
+            state['running'] = []
+
+        update_state(bucket, crawler, release)
+        return 'running'
+    logger.info(f"Crawler {crawler} started")
+    return outcome
+
+
+def schedule(bucket, prefixes_by_crawler):
+    """
+    Request a crawl of every {crawler: prefixes} and start the idle
+    crawlers, a running one is left to the crawl follow-up.
+    Return the crawlers started by this job.
+    """
+    started = []
+    for crawler, prefixes in prefixes_by_crawler.items():
+        try:
+            request(bucket, crawler, prefixes)
+            outcome = start_pending(bucket, crawler)
+        except Exception as err:
+            logger.error(f"Exception while scheduling crawler {crawler}: {err}")
+            continue
+        if outcome == 'started':
+            started.append(crawler)
+        else:
+            logger.info(f"Crawler {crawler} is {outcome}, the crawl stays pending for its follow-up")
+    return started
+
+
+def follow_up(bucket, crawlers, ready_wait=READY_WAIT_SECONDS):
+    """
+    Start the pending crawl of every crawler when a crawl finished, a
+    crawler still stopping is waited for. Return the crawlers started.
+    """
+    deadline = time.time() + ready_wait
+    started = []
+    for crawler in crawlers:
+        while True:
+            try:
+                outcome = start_pending(bucket, crawler)
+            except Exception as err:
+                logger.error(f"Exception while starting the pending crawl of {crawler}: {err}")
+                break
+            if outcome == 'started':
+                started.append(crawler)
+            if outcome != 'stopping' or time.time() + POLL_SECONDS > deadline:
+                logger.info(f"Crawler {crawler}: {outcome}")
+                break
+            time.sleep(POLL_SECONDS)
+    return started
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Vectorised date normalisation for the Glue job DataFrames
+
+Date columns are kept as datetime64 instead of being turned into python
+date objects row by row (`.apply(lambda x: x.date())`), so sorts, merges
+and groupbys on them run on native dtypes. A datetime64 column at
+midnight is still written to csv as YYYY-MM-DD.
+
+`parse_periods()` reads the mixed period strings of sources such as
+Moody's in one vectorised pass:
+
+    2010Q1      -> 2010-03-31 (last day of the quarter)
+    2010M01     -> 2010-01-01
+    2010-01     -> 2010-01-01
+    2010-01-15  -> 2010-01-15
+
+Usage:
+    df['Date'] = dates.to_date(df['Date'], format="%Y-%m-%d")
+    df['month_year'] = dates.month_start(df['Date'])
+    df['Date'] = dates.parse_periods(df['date'])
+
+"""
+
+# builtin imports
+import logging
+
+# Lib
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+PERIOD_PATTERN = (r'^\s*(?P<year>\d{4})'
+                  r'(?:Q(?P<quarter>[1-4])'
+                  r'|M(?P<month_number>\d{1,2})'
+                  r'|-(?P<month>\d{1,2})(?:-(?P<day>\d{1,2}))?)\s*$')
+# unparseable values shown in the log / error message
+MAX_REPORTED = 5
+
+
+def to_date(values, format=None):
+    "Parse values to a datetime64 column holding the date part only (midnight)"
+    return pd.to_datetime(values, format=format).dt.normalize()
+
+
+def month_start(values):
+    "Truncate dates to the first day of their month, as a datetime64 column"
+    return pd.to_datetime(values).dt.to_period('M').dt.to_timestamp()
+
+
+def parse_periods(values, errors='raise'):
+    """
+    Parse quarterly, monthly and daily period strings (see module doc) to a
+    datetime64 Series. Unparseable rows raise a ValueError listing them,
+    or with errors='coerce' are logged and left as NaT.
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    parts = values.astype('string').str.extract(PERIOD_PATTERN).astype('float')
+    parts = parts[parts['year'].notna()]
+    quarter = parts['quarter'].notna()
+    month = parts['month'].fillna(parts['month_number']).fillna(parts['quarter'] * 3)
+    fields = pd.DataFrame({'year': parts['year'], 'month': month, 'day': parts['day'].fillna(1)})
+    parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]', name=values.name)
+    parsed[fields.index] = pd.to_datetime(fields.astype('int64'), errors='coerce')
+    parsed[quarter[quarter].index] += pd.offsets.MonthEnd(0)
+
+    bad = parsed.isna() & values.notna()
+    if bad.any():
+        sample = ', '.join(f"{index}: {value!r}" for index, value in values[bad].head(MAX_REPORTED).items())
+        message = f"{bad.sum()} unparseable periods (row: value) {sample}"
+        if errors != 'coerce':
+            raise ValueError(message)
+        logger.warning(message)
+    return parsed
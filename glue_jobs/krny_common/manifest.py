@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Processed-partition manifest for incremental change detection
+
+Each source prefix (eg. raw-data/fred) has a small JSON state object in S3
+with the ETag and size of every raw file already processed and the last
+key seen. A normal run only lists keys from the folder of that last key
+on (S3 StartAfter), so the listing cost follows the new data instead of
+the whole history. The last processed folder is listed again, so a file
+rewritten there is seen by its ETag/size. The folders of the source prefix
+are also listed on every run (no files), down to the depth of the last
+processed folder (eg. data/<date>/ or <year>/<month>/), so a new folder
+sorting before the last key (eg. a backfilled older date) is listed too.
+A processed file missing from these listings was deleted and is dropped.
+
+Every FULL_SCAN_DAYS the whole source prefix is listed once and compared
+by ETag/size. Files rewritten or deleted in the older processed folders
+(before the last processed one) are only seen by this full scan, so they
+wait up to FULL_SCAN_DAYS.
+The transformed-data layer is only listed once, to seed the manifest from
+the folders the jobs processed before it existed.
+
+Usage:
+    folders = manifest.get_changed_folders(BUCKET, SRC_DIR)
+    ... process folders ...
+    manifest.mark_processed(BUCKET, SRC_DIR, folders)
+
+"""
+
+# builtin imports
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+from krny_common import s3io, RAW_DIR, CLEANED_DIR, TRANSFORMED_DIR, STATE_DIR
+
+logger = logging.getLogger(__name__)
+
+FULL_SCAN_DAYS = 7
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# listing results of the current run, keyed by (bucket, src_dir)
+_listings = {}
+
+
+def manifest_path(src_dir):
+    "S3 key of the manifest for a source prefix"
+    return f"{STATE_DIR}/manifests/{src_dir.strip('/')}/manifest.json"
+
+
+def load_manifest(bucket, src_dir):
+    "Return the manifest dict for src_dir, None if it does not exist yet"
+    key = manifest_path(src_dir)
+    try:
+        return json.loads(s3io.get_object(bucket, key))
+    except s3io.get_client().exceptions.NoSuchKey:
+        logger.info(f"No manifest found at {key}")
+    except Exception as err:
+        logger.error(f"Error while reading manifest {key}: {err}")
+    return None
+
+
+def save_manifest(bucket, src_dir, manifest):
+    "Write the manifest dict of src_dir back to S3"
+    key = manifest_path(src_dir)
+    logger.info(f"Saving manifest {key}")
+    s3io.put_object(bucket, key, json.dumps(manifest).encode('utf-8'),
+                    wait=True, ContentType='application/json')
+
+
+def _list_files(bucket, prefix, suffixes, start_after=None):
+    "Return {key: [etag, size]} for keys under prefix ending with one of suffixes"
+    files = {}
+    for obj in s3io.list_objects(bucket, prefix, start_after):
+        if obj['Key'].endswith(suffixes):
+            files[obj['Key']] = [obj['ETag'].strip('"'), obj['Size']]
+    return files
+
+
+def _start_after(src_dir, last_key):
+    "Key to list after: right before the folder of last_key, so that whole folder is listed again"
+    folder = os.path.dirname(last_key) if last_key else None
+    if not folder or folder == src_dir.rstrip('/'):
+        return last_key
+    return folder
+
+
+def _known_folders(root, objects):
+    "Every folder prefix (with its trailing /) holding a processed file under root"
+    known = set()
+    for key in objects:
+        parts = key[len(root):].split('/')[:-1]
+        for depth in range(1, len(parts) + 1):
+            known.add(root + '/'.join(parts[:depth]) + '/')
+    return known
+
+
+def _list_new_folders(bucket, src_dir, objects, start_after, suffixes, exclude=()):
+    """
+    Return ({key: [etag, size]}, [prefixes whose files were all listed]) of the
+    folders under src_dir with no processed file which sort before start_after,
+    the StartAfter listing misses them. The processed folders are walked down
+    to the depth of the start_after folder, with the files directly in them.
+    """
+    root = src_dir.rstrip('/') + '/'
+    max_depth = start_after[len(root):].count('/') + 1 if start_after.startswith(root) else 1
+    known = _known_folders(root, objects)
+    files, listed, todo = {}, [], [(root, 1)]
+    while todo:
+        prefix, depth = todo.pop()
+        folders, prefix_objects = s3io.list_folders(bucket, prefix)
+        listed.append(prefix)
+        files.update({obj['Key']: [obj['ETag'].strip('"'), obj['Size']] for obj in prefix_objects
+                      if obj['Key'].endswith(suffixes)})
+        for folder in folders:
+            if folder > start_after or folder.startswith(exclude):
+                # listed by StartAfter, or left out
+                continue
+            if folder not in known:
+                logger.info(f"New folder {folder} before {start_after}")
+                files.update(_list_files(bucket, folder, suffixes))
+            elif depth < max_depth:
+                todo.append((folder, depth + 1))
+    return files, listed
+
+
+def _deleted_keys(objects, src_files, start_after, listed):
+    """
+    Processed keys missing from the listing: after start_after or directly in
+    a listed folder, the others were not listed
+    """
+    listed = set(listed)
+    return {key for key in objects if key not in src_files
+            and (start_after is None or key > start_after or os.path.dirname(key) + '/' in listed)}
+
+
+def _exclude(files, exclude):
+    "Drop the keys under the exclude prefixes"
+    if not exclude:
+        return files
+    return {key: value for key, value in files.items() if not key.startswith(exclude)}
+
+
+def _group_by_folder(keys):
+    "Group keys by their directory name"
+    folders = {}
+    for key in sorted(keys):
+        folders.setdefault(os.path.dirname(key), []).append(key)
+    return folders
+
+
+def _last_key(objects, src_files):
+    "Last key to list after, it is right before the first file still to process"
+    pending = [key for key, value in src_files.items() if objects.get(key) != value]
+    first_pending = min(pending) if pending else None
+    processed = [key for key in objects if first_pending is None or key < first_pending]
+    return max(processed) if processed else None
+
+
+def _seed_manifest(bucket, src_dir, src_files, dst_suffixes):
+    """
+    Build the first manifest from the legacy rule: a raw folder is processed
+    when the same folder exists under transformed-data, as csv or parquet.
+    """
+    dst_dir = src_dir.replace(RAW_DIR, TRANSFORMED_DIR)
+    dst_folders = {os.path.dirname(key).replace(TRANSFORMED_DIR, RAW_DIR)
+                   for key in _list_files(bucket, dst_dir, dst_suffixes)}
+    objects = {key: value for key, value in src_files.items()
+               if os.path.dirname(key) in dst_folders}
+    logger.info(f"Seeding manifest for {src_dir} with {len(dst_folders)} processed folders")
+    return {
+        'prefix': src_dir,
+        'last_key': _last_key(objects, src_files),
+        'last_full_scan': datetime.utcnow().strftime(DATE_FORMAT),
+        'objects': objects,
+    }
+
+
+def get_changed_folders(bucket, src_dir, suffixes=('.csv',), dst_suffixes=('.csv', '.parquet'),
+                        full_scan_days=FULL_SCAN_DAYS, exclude=()):
+    """
+    This function returns {folder: [files]} for the raw-data folders which
+    are new or have a changed file since the last processed run.
+    The whole file list of a changed folder is returned. The keys under the
+    exclude prefixes (eg. a config folder inside src_dir) are left out.
+    """
+    suffixes = tuple(suffixes)
+    exclude = tuple(prefix.rstrip('/') + '/' for prefix in exclude)
+    manifest = load_manifest(bucket, src_dir)
+    if manifest is None:
+        src_files = _exclude(_list_files(bucket, src_dir, suffixes), exclude)
+        manifest = _seed_manifest(bucket, src_dir, src_files, tuple(dst_suffixes))
+        full_scan = True
+    else:
+        last_full_scan = datetime.strptime(manifest['last_full_scan'], DATE_FORMAT)
+        full_scan = datetime.utcnow() - last_full_scan >= timedelta(days=full_scan_days)
+        if full_scan:
+            logger.info(f"Full scan of {src_dir}, last one was {manifest['last_full_scan']}")
+            src_files = _exclude(_list_files(bucket, src_dir, suffixes), exclude)
+        else:
+            start_after = _start_after(src_dir, manifest['last_key'])
+            logger.info(f"Listing {src_dir} after {start_after}")
+            listed_files = _list_files(bucket, src_dir, suffixes, start_after)
+            listed = []
+            if start_after:
+                new_files, listed = _list_new_folders(bucket, src_dir, manifest['objects'], start_after, suffixes,
+                                                     exclude)
+                listed_files.update(new_files)
+            listed_files = _exclude(listed_files, exclude)
+            deleted = _deleted_keys(manifest['objects'], listed_files, start_after, listed)
+            if deleted:
+                logger.info(f"{len(deleted)} processed files deleted from {src_dir}")
+            src_files = {key: value for key, value in manifest['objects'].items() if key not in deleted}
+            src_files.update(listed_files)
+
+    known = manifest['objects']
+    changed = {os.path.dirname(key) for key, value in src_files.items()
+               if known.get(key) != value}
+    folders = {folder: files for folder, files in _group_by_folder(src_files).items()
+               if folder in changed}
+
+    _listings[(bucket, src_dir)] = (manifest, src_files, full_scan)
+    logger.info(f"{len(folders)} new or changed folders under {src_dir}")
+    return folders
+
+
+def mark_processed(bucket, src_dir, folders, failed_keys=()):
+    """
+    Record the files of the processed folders in the manifest and save it.
+    Folders with an output in failed_keys (see s3io.wait_for_uploads) are
+    left out so they are picked up again by the next run.
+    """
+    try:
+        manifest, src_files, full_scan = _listings[(bucket, src_dir)]
+    except KeyError:
+        logger.error(f"mark_processed called before get_changed_folders for {src_dir}")
+        return
+    # drop the files deleted from raw-data, all of them on a full scan, else the listed ones
+    objects = {key: value for key, value in manifest['objects'].items() if key in src_files}
+    if full_scan:
+        manifest['last_full_scan'] = datetime.utcnow().strftime(DATE_FORMAT)
+    failed_folders = {os.path.dirname(key.replace(CLEANED_DIR, RAW_DIR).replace(TRANSFORMED_DIR, RAW_DIR))
+                      for key in failed_keys}
+    for folder in folders:
+        if folder in failed_folders:
+            logger.warning(f"Not marking {folder} as processed, some outputs failed")
+            continue
+        for key in folders[folder]:
+            objects[key] = src_files[key]
+    manifest['objects'] = objects
+    manifest['last_key'] = _last_key(objects, src_files)
+    save_manifest(bucket, src_dir, manifest)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Cached DynamoDB mapper tables (column id -> column name)
+
+`load_mapper()` returns {key_attr: value_attr} for every item of a mapper
+table. The scan is paginated (LastEvaluatedKey), only reads the two
+attributes it needs and can be split in parallel segments for large
+tables.
+
+The result is kept as a JSON snapshot in S3, next to the manifests, and
+a run uses the saved snapshot right away instead of waiting on the scan.
+A snapshot older than MAX_AGE_MINUTES is scanned again by
+`refresh_stale()`, which the jobs call once their folders are processed,
+so an edited or new mapper item shows in the outputs from the next run.
+There is no change marker to check instead: the tables are written
+outside these jobs and the table item count is only refreshed by DynamoDB
+about every six hours. The scan is not run in a background thread as
+the folders can be processed in forked workers.
+
+Usage:
+    mapper_dict = mapper.load_mapper(MAPPER_TABLE, 'Series_ID', 'Series_Name', BUCKET)
+    ...
+    mapper.refresh_stale()
+
+"""
+
+# builtin imports
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from boto3.dynamodb.types import TypeDeserializer
+
+from krny_common import s3io, STATE_DIR
+
+logger = logging.getLogger(__name__)
+
+MAX_AGE_MINUTES = 60
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# mappers already loaded by this process, keyed by (table, key_attr, value_attr)
+_mappers = {}
+# mappers loaded from an old snapshot, (bucket, segments) by the same key
+_stale = {}
+
+
+def snapshot_path(table_name):
+    "S3 key of the snapshot of a mapper table"
+    return f"{STATE_DIR}/mappers/{table_name}.json"
+
+
+def _scan_segment(table_name, key_attr, value_attr, segment=None, total_segments=None):
+    "Scan one segment (or the whole table) page by page, return {key: value}"
+    deserializer = TypeDeserializer()
+    kwargs = {
+        'TableName': table_name,
+        'ProjectionExpression': '#k, #v',
+        'ExpressionAttributeNames': {'#k': key_attr, '#v': value_attr},
+    }
+    if total_segments:
+        kwargs.update(Segment=segment, TotalSegments=total_segments)
+    items = {}
+    paginator = s3io.get_client('dynamodb').get_paginator('scan')
+    for page in paginator.paginate(**kwargs):
+        for item in page.get('Items', []):
+            if key_attr in item and value_attr in item:
+                items[str(deserializer.deserialize(item[key_attr]))] = \
+                    str(deserializer.deserialize(item[value_attr]))
+    return items
+
+
+def scan_mapper(table_name, key_attr, value_attr, segments=1):
+    "Scan the whole mapper table, in `segments` parallel segments when more than 1"
+    logger.info(f"Scanning mapper table {table_name}")
+    if segments <= 1:
+        return _scan_segment(table_name, key_attr, value_attr)
+    items = {}
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(_scan_segment, table_name, key_attr, value_attr, segment, segments)
+                   for segment in range(segments)]
+        for future in futures:
+            items.update(future.result())
+    return items
+
+
+def _load_snapshot(bucket, table_name):
+    "Return the saved snapshot dict, None if there is none"
+    try:
+        return json.loads(s3io.get_object(bucket, snapshot_path(table_name)))
+    except Exception as err:
+        logger.info(f"No mapper snapshot for {table_name}: {err}")
+        return None
+
+
+def save_snapshot(bucket, table_name, key_attr, value_attr, items):
+    "Save the items of the mapper table as its S3 snapshot, log a failure"
+    snapshot = {
+        'table': table_name,
+        'key_attr': key_attr,
+        'value_attr': value_attr,
+        'saved': datetime.utcnow().strftime(DATE_FORMAT),
+        'items': items,
+    }
+    try:
+        s3io.put_object(bucket, snapshot_path(table_name), json.dumps(snapshot).encode('utf-8'),
+                        wait=True, ContentType='application/json')
+    except Exception as err:
+        logger.warning(f"Cannot save mapper snapshot of {table_name}: {err}")
+
+
+def load_mapper(table_name, key_attr, value_attr, bucket=None, max_age_minutes=MAX_AGE_MINUTES,
+                segments=1):
+    """
+    Return {key_attr: value_attr} of the mapper table. Without bucket the
+    table is always scanned (once per process), with bucket the S3 snapshot
+    is used when there is one and marked for `refresh_stale()` when older
+    than max_age_minutes.
+    """
+    cache_key = (table_name, key_attr, value_attr)
+    if cache_key in _mappers:
+        return _mappers[cache_key]
+
+    snapshot = _load_snapshot(bucket, table_name) if bucket else None
+    if snapshot is not None and snapshot.get('key_attr') == key_attr \
+            and snapshot.get('value_attr') == value_attr:
+        age = datetime.utcnow() - datetime.strptime(snapshot['saved'], DATE_FORMAT)
+        logger.info(f"Using mapper snapshot of {table_name} saved at {snapshot['saved']}")
+        if age >= timedelta(minutes=max_age_minutes):
+            _stale[cache_key] = (bucket, segments)
+        _mappers[cache_key] = snapshot['items']
+        return snapshot['items']
+
+    items = scan_mapper(table_name, key_attr, value_attr, segments)
+    logger.info(f"{len(items)} items read from {table_name}")
+    if bucket:
+        save_snapshot(bucket, table_name, key_attr, value_attr, items)
+    _mappers[cache_key] = items
+    return items
+
+
+def refresh_stale():
+    "Scan again the mappers loaded from an old snapshot and save their new snapshot"
+    for cache_key, (bucket, segments) in list(_stale.items()):
+        table_name, key_attr, value_attr = cache_key
+        try:
+            items = scan_mapper(table_name, key_attr, value_attr, segments)
+        except Exception as err:
+            logger.warning(f"Cannot refresh mapper snapshot of {table_name}: {err}")
+            continue
+        changed = sum(1 for key, value in items.items() if _mappers[cache_key].get(key) != value)
+        removed = len(set(_mappers[cache_key]) - set(items))
+        logger.info(f"Mapper {table_name} refreshed: {len(items)} items, {changed} new or changed, "
+                    f"{removed} removed")
+        save_snapshot(bucket, table_name, key_attr, value_attr, items)
+        _mappers[cache_key] = items
+        del _stale[cache_key]
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Per-stage job metrics as CloudWatch embedded metric format logs
+
+The jobs wrap their stages (listing, reads, transformation steps, writes)
+in `stage()`. When a stage ends one JSON line in CloudWatch embedded
+metric format (EMF) is written to stdout with:
+
+    Duration (ms), Rows, Columns, Memory (DataFrame deep memory, bytes),
+    BytesRead / BytesWritten (S3, see s3io.transferred()), PeakRSS (MB)
+
+The S3 bytes are those of the thread running the stage, PeakRSS is the
+one of the whole process.
+
+Job and Stage are the metric dimensions, the other properties given to
+stage() (folder, file ...) are kept in the log line for Logs Insights.
+The lines bypass the job log format so CloudWatch can parse them.
+
+Usage:
+    with metrics.stage('list'):
+        folders = get_folder_list()
+
+    with metrics.stage('transform', file=file_path) as stage:
+        df = apply_transformations(df, file_path)
+        stage.frame(df)
+
+    for file_path, df in metrics.iter_stage('read', s3io.iter_csv(BUCKET, files)):
+        ...
+
+"""
+
+# builtin imports
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from krny_common import s3io
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = 'KearneySensing/GlueJobs'
+JOB = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'job'
+ENABLED = True
+# job name of the current thread when several jobs share the process (pipeline runner)
+_context = threading.local()
+
+# the EMF lines are written as is, without the job log format
+_emf_logger = logging.getLogger(f"{__name__}.emf")
+_emf_logger.propagate = False
+_emf_logger.setLevel(logging.INFO)
+_emf_handler = logging.StreamHandler(sys.stdout)
+_emf_handler.setFormatter(logging.Formatter('%(message)s'))
+_emf_logger.addHandler(_emf_handler)
+
+UNITS = {
+    'Duration': 'Milliseconds',
+    'Rows': 'Count',
+    'Columns': 'Count',
+    'Memory': 'Bytes',
+    'BytesRead': 'Bytes',
+    'BytesWritten': 'Bytes',
+    'PeakRSS': 'Megabytes',
+}
+
+
+class Stage:
+    "Values of a running stage, frame() records the DataFrame(s) it produced"
+
+    def __init__(self, name, properties):
+        self.name = name
+        self.properties = properties
+        self.values = {}
+        self.discarded = False
+
+    def frame(self, df):
+        "Add the rows and deep memory of df (eg. one batch) to the stage, None is ignored"
+        if df is None:
+            return df
+        self.values['Rows'] = self.values.get('Rows', 0) + len(df)
+        self.values['Columns'] = max(self.values.get('Columns', 0), len(df.columns))
+        self.values['Memory'] = self.values.get('Memory', 0) + int(df.memory_usage(deep=True).sum())
+        return df
+
+    def discard(self):
+        "Do not emit this stage"
+        self.discarded = True
+
+
+def set_job(name):
+    "Report the stages of the current thread under job name instead of JOB"
+    _context.job = name
+
+
+def peak_rss():
+    "Peak resident memory of this process in MB"
+    # ru_maxrss is in KB on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def emit(name, values, **properties):
+    "Write one EMF line for stage name with its metric values and extra properties"
+    if not ENABLED:
+        return
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['Job', 'Stage']],
+                'Metrics': [{'Name': metric, 'Unit': UNITS[metric]} for metric in values],
+            }],
+        },
+        'Job': getattr(_context, 'job', JOB),
+        'Stage': name,
+        **{key: str(value) for key, value in properties.items()},
+        **values,
+    }
+    _emf_logger.info(json.dumps(record))
+
+
+@contextmanager
+def stage(name, **properties):
+    "Measure the enclosed block as stage name and emit its metrics when it ends"
+    record = Stage(name, properties)
+    transferred = s3io.transferred()
+    started = time.perf_counter()
+    try:
+        yield record
+    except BaseException as err:
+        record.properties['Error'] = type(err).__name__
+        raise
+    finally:
+        if not record.discarded:
+            _emit_stage(record, started, transferred)
+
+
+def _emit_stage(record, started, transferred):
+    "Emit the metrics of a finished stage, a failure is only logged"
+    values = {'Duration': round((time.perf_counter() - started) * 1000, 1)}
+    values.update(record.values)
+    now = s3io.transferred()
+    values['BytesRead'] = now['read'] - transferred['read']
+    values['BytesWritten'] = now['written'] - transferred['written']
+    values['PeakRSS'] = peak_rss()
+    try:
+        emit(record.name, values, **record.properties)
+    except Exception as err:
+        logger.warning(f"Metrics of stage {record.name} not emitted: {err}")
+
+
+def iter_stage(name, iterable, **properties):
+    """
+    Yield the items of iterable, the wait for each one is measured as stage
+    name. Items can be DataFrames or (file_path, DataFrame) pairs.
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name, **properties) as record:
+            item = next(iterator, None)
+            if item is None:
+                record.discard()
+                break
+            file_path, df = item if isinstance(item, tuple) else (None, item)
+            if file_path is not None:
+                record.properties['file'] = file_path
+            record.frame(df)
+        yield item
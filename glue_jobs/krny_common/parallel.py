@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Per-folder parallel execution for the Glue job __main__ loops
+
+`run_folders()` runs func(folder, files) for every folder, either inline
+(workers=1, the default) or spread over a pool of forked processes. Each
+folder is isolated: its exception (or sys.exit) is collected instead of
+aborting the run, and its queued S3 uploads are awaited so a failed put
+counts as a failed folder. The files saved by a forked folder are
+recorded back in the parent (s3io.pop_outputs()).
+
+The log records of a folder are buffered while it runs and written out
+in folder order when it is done, so the job log reads folder by folder.
+
+Usage:
+    results, failures = parallel.run_folders(process_folder, folders, WORKERS)
+    done = {k: v for k, v in folders.items() if k not in failures}
+
+"""
+
+# builtin imports
+import logging
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from krny_common import s3io, metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _BufferHandler(logging.Handler):
+    "Keep the log records of one folder to emit them later"
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # make the record picklable for the trip back to the parent
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+def _run_folder(func, folder, files, buffered):
+    "Run func on one folder, return (result, error, log records, saved files)"
+    root = logging.getLogger()
+    handler = _BufferHandler()
+    saved_handlers = root.handlers[:]
+    if buffered:
+        root.handlers = [handler]
+    result, error = None, None
+    try:
+        logger.info(f"Processing folder {folder}")
+        with metrics.stage('folder', folder=folder):
+            result = func(folder, files)
+            with metrics.stage('wait_uploads', folder=folder):
+                failed = s3io.wait_for_uploads()
+        if failed:
+            error = f"Upload failed for {failed}"
+    except (Exception, SystemExit) as err:
+        logger.error(f"Error while processing folder {folder}: {err!r}")
+        logger.debug(traceback.format_exc())
+        s3io.wait_for_uploads()
+        error = repr(err)
+    finally:
+        root.handlers = saved_handlers
+    return result, error, handler.records, s3io.pop_outputs()
+
+
+def _folder_outcome(folder, future):
+    """
+    Outcome of a forked folder, a worker that died (eg. killed when out of
+    memory, BrokenProcessPool) fails its folder only
+    """
+    try:
+        return future.result()
+    except Exception as err:
+        logger.error(f"Worker of folder {folder} failed: {err!r}")
+        return None, repr(err), [], []
+
+
+def run_folders(func, folders, workers=1):
+    """
+    Run func(folder, files) for every item of folders and return
+    (results, failures): {folder: result} and {folder: error message}.
+    """
+    workers = max(1, int(workers or 1))
+    results, failures = {}, {}
+    items = sorted(folders.items())
+    pool = None
+    try:
+        if workers == 1 or len(items) < 2:
+            outcomes = (_run_folder(func, folder, files, False) for folder, files in items)
+        else:
+            logger.info(f"Processing {len(items)} folders with {workers} processes")
+            # fork so the job's module level setup (args, clients config) is inherited
+            pool = ProcessPoolExecutor(max_workers=min(workers, len(items)),
+                                       mp_context=multiprocessing.get_context('fork'))
+            futures = [pool.submit(_run_folder, func, folder, files, True) for folder, files in items]
+            outcomes = (_folder_outcome(folder, future) for (folder, files), future in zip(items, futures))
+
+        for (folder, files), (result, error, records, outputs) in zip(items, outcomes):
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+            s3io.record_outputs(outputs)
+            if error is None:
+                results[folder] = result
+            else:
+                failures[folder] = error
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if failures:
+        logger.error(f"{len(failures)} of {len(items)} folders failed: {sorted(failures)}")
+    return results, failures
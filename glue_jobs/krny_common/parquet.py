@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Typed PARQUET conversion used by the s3io writers
+
+The crawlers build one table per data layer folder, so the column types
+of a dataset must match the existing partitions, written by pandas
+`to_parquet` before this module. `to_table()` gives every DataFrame the
+same arrow types pandas used, with fixed ones for the columns pandas
+left to inference:
+
+    integer         -> its int type (int64), as to_parquet: a column without gaps
+    float           -> double (an int column with gaps is float in pandas)
+    bool            -> bool
+    datetime64      -> timestamp[us]
+    datetime.date   -> date32
+    anything else   -> string
+
+Columns can be pinned to another arrow type with `schema`, eg.
+{'Population': 'int64'}.
+
+"""
+
+# builtin imports
+import datetime
+import logging
+
+# Lib
+import pandas as pd
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION = 'snappy'
+ROW_GROUP_SIZE = 100000
+
+
+def _column_type(series):
+    "Stable arrow type of a pandas column"
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return pa.bool_()
+    if pd.api.types.is_integer_dtype(dtype):
+        # numpy int dtype, or the numpy dtype of a nullable Int64 column
+        return pa.from_numpy_dtype(getattr(dtype, 'numpy_dtype', dtype))
+    if pd.api.types.is_numeric_dtype(dtype):
+        return pa.float64()
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return pa.timestamp('us', tz=getattr(dtype, 'tz', None))
+    values = series.dropna()
+    if len(values) and values.map(lambda x: type(x) is datetime.date).all():
+        return pa.date32()
+    return pa.string()
+
+
+def arrow_schema(df, schema=None):
+    "Return the stable arrow schema of df, schema overrides the type of some columns"
+    schema = schema or {}
+    fields = []
+    for name in df.columns:
+        if name in schema:
+            column_type = schema[name]
+            if isinstance(column_type, str):
+                column_type = pa.type_for_alias(column_type)
+        else:
+            column_type = _column_type(df[name])
+        fields.append(pa.field(str(name), column_type))
+    return pa.schema(fields)
+
+
+def to_table(df, schema=None):
+    """
+    Convert df to an arrow table with a stable schema.
+    schema is either an arrow schema (used as is) or a dict of overrides.
+    """
+    if not isinstance(schema, pa.Schema):
+        schema = arrow_schema(df, schema)
+    df = df.copy(deep=False)
+    df.columns = [str(name) for name in df.columns]
+    for field in schema:
+        if pa.types.is_string(field.type):
+            df[field.name] = df[field.name].where(df[field.name].isna(), df[field.name].astype(str))
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Per-process cache of reference (config / lookup) files in S3
+
+The jobs join every raw file with the same small lookup files (station
+mapper, state regions, IRM population ...). `read_csv()` loads such a file
+once per process and keeps it with its ETag. Within MAX_AGE seconds the
+cached copy is used as is, after that it is revalidated with a conditional
+GET (If-None-Match), so an unchanged file is not downloaded again.
+
+`derived()` caches what a job builds from reference files, eg. a join
+ready station -> region map, and rebuilds it only when the ETag of one of
+its source files changes.
+
+Forked workers (see krny_common.parallel) inherit what the parent process
+already loaded.
+
+Usage:
+    region_map = refdata.derived('station_region_map', build_station_region_map,
+                                 BUCKET, [MAPPED_WEATHER_STATIONS, US_STATE_REGION])
+
+"""
+
+# builtin imports
+import logging
+import threading
+import time
+
+# Lib
+import pandas as pd
+from botocore.exceptions import ClientError
+
+from krny_common import s3io
+
+logger = logging.getLogger(__name__)
+
+MAX_AGE = 300
+
+_lock = threading.Lock()
+# (bucket, key, kwargs) -> [etag, checked at, DataFrame]
+_files = {}
+# name -> (etags of the sources, value)
+_derived = {}
+
+
+def _cache_key(bucket, key, kwargs):
+    return (bucket, key, tuple(sorted((name, repr(value)) for name, value in kwargs.items())))
+
+
+def _load(bucket, key, max_age, kwargs):
+    "Return the cache entry of a csv file, loading or revalidating it when needed"
+    cache_key = _cache_key(bucket, key, kwargs)
+    with _lock:
+        entry = _files.get(cache_key)
+    if entry is not None and time.time() - entry[1] < max_age:
+        return entry
+
+    request = {'Bucket': bucket, 'Key': key}
+    if entry is not None:
+        request['IfNoneMatch'] = entry[0]
+    try:
+        response = s3io.get_client().get_object(**request)
+    except ClientError as err:
+        if entry is not None and err.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+            logger.debug(f"Reference file {key} not modified")
+            entry = [entry[0], time.time(), entry[2]]
+            with _lock:
+                _files[cache_key] = entry
+            return entry
+        logger.error(f"Error while reading {key}: {err}")
+        raise Exception(f"While reading file: {err}")
+
+    logger.info(f"Reading reference file: {key}")
+    df = pd.read_csv(response['Body'], **kwargs)
+    entry = [response['ETag'], time.time(), df]
+    with _lock:
+        _files[cache_key] = entry
+    return entry
+
+
+def read_csv(bucket, key, max_age=MAX_AGE, **kwargs):
+    "Return a copy of the cached reference csv file, kwargs are passed to pd.read_csv"
+    return _load(bucket, key, max_age, kwargs)[2].copy()
+
+
+def etag(bucket, key, max_age=MAX_AGE):
+    "ETag of the cached reference csv file"
+    return _load(bucket, key, max_age, {})[0]
+
+
+def derived(name, build, bucket, keys, max_age=MAX_AGE):
+    """
+    Return build(*frames) for the reference csv files keys, cached under name
+    until the ETag of one of the files changes.
+    """
+    entries = [_load(bucket, key, max_age, {}) for key in keys]
+    etags = tuple(entry[0] for entry in entries)
+    with _lock:
+        cached = _derived.get(name)
+    if cached is not None and cached[0] == etags:
+        return cached[1]
+    value = build(*[entry[2].copy() for entry in entries])
+    with _lock:
+        _derived[name] = (etags, value)
+    return value
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: CSV key -> value registries in S3 updated once per run
+
+A registry (eg. the IHS mnemonic -> description file) gathers its new
+pairs in memory during the run and `commit()` merges them into the S3
+file with one write. The write is conditional on the ETag read just
+before (If-Match, or If-None-Match for a new file): when another run
+changed the file in between, it is read and merged again, so concurrent
+runs do not lose each other's updates. Without conditional writes in
+botocore, commit() raises instead of writing unconditionally (see
+s3io.put_if_match).
+
+Usage:
+    registry = CsvRegistry(BUCKET, MNEMONIC_FILE, 'mnemonic', 'description')
+    registry.update({'GDP': 'Gross domestic product'})
+    registry.commit()
+
+"""
+
+# builtin imports
+import logging
+import time
+
+# Lib
+import pandas as pd
+
+from krny_common import s3io
+
+logger = logging.getLogger(__name__)
+
+COMMIT_ATTEMPTS = 5
+
+
+class CsvRegistry:
+    """
+    Key -> value pairs kept as a two column csv file in S3. Pairs added
+    with update() override the ones of the file, in the order they came.
+    """
+
+    def __init__(self, bucket, key, key_column, value_column):
+        self.bucket = bucket
+        self.key = key
+        self.key_column = key_column
+        self.value_column = value_column
+        self.pending = {}
+
+    def update(self, pairs):
+        "Add or replace pairs in memory, nothing is written before commit()"
+        self.pending.update(pairs)
+
+    def read(self):
+        "Return (pairs of the S3 file, its ETag), ({}, None) when it does not exist"
+        try:
+            response = s3io.get_client().get_object(Bucket=self.bucket, Key=self.key)
+        except s3io.get_client().exceptions.NoSuchKey:
+            logger.info(f"Registry {self.key} does not exist yet")
+            return {}, None
+        df = pd.read_csv(response['Body'])
+        df = df[[self.key_column, self.value_column]].set_index(self.key_column)
+        return df.to_dict()[self.value_column], response['ETag']
+
+    def commit(self):
+        "Merge the pending pairs into the S3 file with one conditional write, retried on conflicts"
+        if not self.pending:
+            return True
+        for attempt in range(1, COMMIT_ATTEMPTS + 1):
+            pairs, etag = self.read()
+            merged = {**pairs, **self.pending}
+            if merged == pairs and etag:
+                logger.info(f"Registry {self.key} already up to date")
+                self.pending = {}
+                return True
+            df = pd.DataFrame({self.key_column: list(merged), self.value_column: list(merged.values())})
+            body = df.to_csv(index=False).encode('utf-8')
+            logger.info(f"Saving registry {self.key} ({len(merged) - len(pairs)} new keys)")
+            if s3io.put_if_match(self.bucket, self.key, body, etag):
+                self.pending = {}
+                return True
+            logger.warning(f"Registry {self.key} changed by another run, merging again "
+                           f"(attempt {attempt}/{COMMIT_ATTEMPTS})")
+            time.sleep(attempt)
+        logger.error(f"Registry {self.key} not saved after {COMMIT_ATTEMPTS} attempts")
+        return False
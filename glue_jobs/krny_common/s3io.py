@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Shared S3 I/O layer for the kearney sensing solution Glue jobs
+
+It keeps one pooled boto3 S3 client per process and two bounded thread
+pools (reads and writes) so a job can overlap S3 network time with its
+pandas work instead of doing one blocking get/put per file.
+
+Saves are asynchronous: the DataFrame is serialised on the caller thread
+and only the put is handed to the pool. Call `wait_for_uploads()` before
+triggering crawlers or leaving the job. A read of a key that still has a
+pending put waits for that put first.
+
+The S3 bytes, queued uploads and saved files are kept per thread (the
+thread a pool task was submitted from, see submit()), so several jobs can
+share the process, eg. the stages of the pipeline job.
+
+Large files can be streamed instead: `iter_csv_chunks()` yields bounded
+row batches and `ParquetStreamWriter` writes them out as row groups, so
+memory stays flat whatever the file size.
+
+Usage:
+    from krny_common import s3io, CLEANED_DIR
+
+    for file_path, df in s3io.iter_csv(BUCKET, files):
+        s3io.save_csv(df, BUCKET, file_path, CLEANED_DIR)
+    s3io.wait_for_uploads()
+
+"""
+
+# builtin imports
+import logging
+import os
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+# Lib
+import pandas as pd
+import boto3
+import botocore
+from botocore.config import Config
+from botocore.exceptions import ClientError, ParamValidationError
+
+from krny_common import RAW_DIR, TRANSFORMED_DIR
+
+logger = logging.getLogger(__name__)
+
+# Pool sizing, one connection per worker of each pool plus the caller thread
+MAX_WORKERS = 8
+MAX_POOL_CONNECTIONS = 2 * MAX_WORKERS + 1
+PREFETCH = 2
+
+# Streaming reads/writes
+CHUNK_ROWS = 5000
+SPOOL_SIZE = 64 * 1024 * 1024
+
+# error codes of a conditional put that lost against another writer
+CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409')
+
+_lock = threading.Lock()
+_clients = {}
+_executors = {}
+_pending = {}
+_uploads = []
+# thread -> bytes read from / queued for writing to S3, see transferred()
+_transferred = {}
+# files saved with their upload future and thread, see pop_outputs()
+_outputs = []
+# owner thread of the pool task run by the current thread, see submit()
+_context = threading.local()
+
+
+def _reset_after_fork():
+    "A forked child gets its own client and pools, the parent ones are not fork safe"
+    global _lock
+    _lock = threading.Lock()
+    _clients.clear()
+    _executors.clear()
+    _pending.clear()
+    _uploads.clear()
+    _transferred.clear()
+    _outputs.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def configure(max_workers=None, prefetch=None):
+    "Change pool sizes, it must be called before the first S3 call"
+    global MAX_WORKERS, MAX_POOL_CONNECTIONS, PREFETCH
+    with _lock:
+        if _clients or _executors:
+            logger.warning("s3io already in use, pool size change ignored")
+            return
+        if max_workers:
+            MAX_WORKERS = int(max_workers)
+            MAX_POOL_CONNECTIONS = 2 * MAX_WORKERS + 1
+        if prefetch:
+            PREFETCH = int(prefetch)
+
+
+def get_client(service='s3'):
+    "Return the process wide boto3 client for service with a tuned connection pool"
+    with _lock:
+        if service not in _clients:
+            config = Config(
+                max_pool_connections=MAX_POOL_CONNECTIONS,
+                retries={'max_attempts': 5, 'mode': 'standard'})
+            _clients[service] = boto3.client(service, config=config)
+        return _clients[service]
+
+
+def _get_executor(kind):
+    "Return the bounded thread pool used for reads or writes"
+    with _lock:
+        if kind not in _executors:
+            _executors[kind] = ThreadPoolExecutor(
+                max_workers=MAX_WORKERS, thread_name_prefix=f"s3io-{kind}")
+        return _executors[kind]
+
+
+def _owner():
+    "Thread the S3 traffic, uploads and outputs of the current thread belong to"
+    return getattr(_context, 'owner', None) or threading.get_ident()
+
+
+def _run_as(owner, func, *args, **kwargs):
+    "Run func in a pool thread on behalf of the owner thread"
+    _context.owner = owner
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _context.owner = None
+
+
+def submit(executor, func, *args, **kwargs):
+    "Submit func to executor, its S3 traffic and outputs are counted for the calling thread"
+    return executor.submit(_run_as, _owner(), func, *args, **kwargs)
+
+
+def _count(direction, size):
+    "Add size bytes to the read or written total of the current thread"
+    with _lock:
+        totals = _transferred.setdefault(_owner(), {'read': 0, 'written': 0})
+        totals[direction] += size or 0
+
+
+def transferred():
+    "Return {'read': bytes, 'written': bytes} transferred (or queued) by this thread so far"
+    with _lock:
+        return dict(_transferred.get(_owner(), {'read': 0, 'written': 0}))
+
+
+def record_outputs(outputs, future=None):
+    """
+    Record saved files of this thread, dicts of bucket, key, format ('csv' / 'parquet')
+    and columns ([(name, catalog type)] or None when unknown), see krny_common.catalog
+    """
+    owner = _owner()
+    with _lock:
+        _outputs.extend((output, future, owner) for output in outputs)
+
+
+def pop_outputs():
+    "Return and forget the files recorded by this thread whose upload succeeded"
+    owner = _owner()
+    with _lock:
+        outputs = [(output, future) for output, future, thread in _outputs if thread == owner]
+        _outputs[:] = [item for item in _outputs if item[2] != owner]
+    return [output for output, future in outputs if future is None or future.exception() is None]
+
+
+def layer_path(file_path, layer=TRANSFORMED_DIR):
+    "Map a raw-data key to the same key under another data layer"
+    return file_path.replace(RAW_DIR, layer)
+
+
+def _wait_pending(bucket, key):
+    "Block until a queued put on bucket/key (if any) has finished"
+    future = _pending.get((bucket, key))
+    if future is not None:
+        future.exception()
+
+
+def get_body(bucket, key):
+    "Return the streaming body of an S3 object"
+    _wait_pending(bucket, key)
+    response = get_client().get_object(Bucket=bucket, Key=key)
+    _count('read', response.get('ContentLength'))
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    logger.debug(f"Successful S3 get_object response. Status - {status}")
+    return response.get("Body")
+
+
+def get_object(bucket, key):
+    "Return the body bytes of an S3 object"
+    return get_body(bucket, key).read()
+
+
+def read_csv(bucket, file_path, **kwargs):
+    "Read csv data file and return pd dataframe, kwargs are passed to pd.read_csv"
+    logger.info(f"Reading file: {file_path}")
+    try:
+        return pd.read_csv(get_body(bucket, file_path), **kwargs)
+    except Exception as err:
+        logger.error(f"Error while reading {file_path}: {err}")
+        raise Exception(f"While reading file: {err}")
+
+
+def read_csv_many(bucket, file_paths, **kwargs):
+    "Read several csv files concurrently and return the dataframes in the same order"
+    executor = _get_executor('read')
+    futures = [submit(executor, read_csv, bucket, file_path, **kwargs)
+               for file_path in file_paths]
+    return [future.result() for future in futures]
+
+
+def iter_csv(bucket, file_paths, prefetch=None, **kwargs):
+    """
+    Yield (file_path, df) in order while the next files are already
+    being downloaded, at most `prefetch` reads are in flight.
+    """
+    executor = _get_executor('read')
+    prefetch = prefetch or PREFETCH
+    queue = deque()
+    file_paths = iter(file_paths)
+
+    def submit_next():
+        file_path = next(file_paths, None)
+        if file_path is not None:
+            queue.append((file_path, submit(executor, read_csv, bucket, file_path, **kwargs)))
+
+    for _ in range(prefetch):
+        submit_next()
+    while queue:
+        file_path, future = queue.popleft()
+        submit_next()
+        yield file_path, future.result()
+
+
+def iter_csv_chunks(bucket, file_path, chunksize=None, **kwargs):
+    """
+    Stream a csv file from S3 and yield it as DataFrames of at most
+    `chunksize` rows, so the whole file is never parsed into memory at once.
+    """
+    logger.info(f"Streaming file: {file_path} in batches of {chunksize or CHUNK_ROWS} rows")
+    try:
+        reader = pd.read_csv(get_body(bucket, file_path),
+                             chunksize=chunksize or CHUNK_ROWS, **kwargs)
+    except Exception as err:
+        logger.error(f"Error while reading {file_path}: {err}")
+        raise Exception(f"While reading file: {err}")
+    with reader:
+        for chunk in reader:
+            yield chunk
+
+
+def list_objects(bucket, prefix, start_after=None):
+    "Yield the object summaries (Key, ETag, Size, ...) under prefix, after start_after if given"
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after:
+        kwargs['StartAfter'] = start_after
+    paginator = get_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(**kwargs):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def list_folders(bucket, prefix):
+    """
+    Return ([sub folder prefixes], [object summaries]) directly under
+    prefix, one level only (Delimiter='/')
+    """
+    folders, objects = [], []
+    paginator = get_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        folders.extend(item['Prefix'] for item in page.get('CommonPrefixes', []))
+        objects.extend(page.get('Contents', []))
+    return folders, objects
+
+
+def _run_after(previous, func, *args):
+    "Run func once the previous write on the same key is done, it keeps writes in order"
+    if previous is not None:
+        previous.exception()
+    return func(*args)
+
+
+def _submit_write(bucket, key, func, *args, wait=False):
+    "Queue func(*args) on the write pool as the next write of bucket/key"
+    executor = _get_executor('write')
+    with _lock:
+        previous = _pending.get((bucket, key))
+        future = executor.submit(_run_after, previous, func, *args)
+        _pending[(bucket, key)] = future
+        # kept with the queuing thread, several jobs can share the process
+        _uploads.append((bucket, key, future, _owner()))
+    if wait:
+        future.result()
+    return future
+
+
+def _put(bucket, key, body, extra_args):
+    "Blocking put used by the write pool"
+    get_client().put_object(Bucket=bucket, Key=key, Body=body, **extra_args)
+    return key
+
+
+def _upload_file(bucket, key, fileobj):
+    "Blocking (multipart when large) upload of an open file used by the write pool"
+    try:
+        fileobj.seek(0)
+        get_client().upload_fileobj(fileobj, bucket, key)
+    finally:
+        fileobj.close()
+    return key
+
+
+def put_object(bucket, key, body, wait=False, **extra_args):
+    """
+    Queue a put of body to bucket/key on the write pool and return its future.
+    With wait=True the put is done before returning.
+    """
+    _count('written', len(body))
+    return _submit_write(bucket, key, _put, bucket, key, body, extra_args, wait=wait)
+
+
+def put_if_match(bucket, key, body, etag, **extra_args):
+    """
+    Put body to bucket/key only if the object still has etag (If-Match), or
+    does not exist when etag is None (If-None-Match). Return False when it
+    changed since it was read. Raise when botocore cannot send conditional
+    writes: a plain put would silently lose the other writers' updates.
+    """
+    _wait_pending(bucket, key)
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    try:
+        get_client().put_object(Bucket=bucket, Key=key, Body=body, **condition, **extra_args)
+    except ParamValidationError as err:
+        logger.error(f"Conditional write of {key} not supported by botocore {botocore.__version__}: {err}")
+        raise Exception(f"botocore {botocore.__version__} has no conditional writes, {key} not saved")
+    except ClientError as err:
+        if err.response.get('Error', {}).get('Code') in CONFLICT_CODES:
+            return False
+        raise
+    _count('written', len(body))
+    return True
+
+
+def save_csv(df, bucket, file_path, layer=TRANSFORMED_DIR, index=False, wait=False):
+    "Save the DataFrame as CSV under the given data layer (transformed by default)"
+    from krny_common import catalog
+
+    try:
+        dst_path = layer_path(file_path, layer)
+        logger.info(f"Saving file {dst_path}")
+        body = df.to_csv(index=index).encode('utf-8')
+        future = put_object(bucket, dst_path, body, wait=wait)
+        record_outputs([{'bucket': bucket, 'key': dst_path, 'format': 'csv',
+                         'columns': catalog.csv_columns(df, index)}], future)
+        return future
+    except Exception as err:
+        logger.error(f"Error while saving: {err}")
+
+
+def save_parquet(df, bucket, file_path, layer=TRANSFORMED_DIR, index=False, wait=False,
+                 schema=None, compression=None, row_group_size=None):
+    """
+    Save the DataFrame as typed PARQUET under the given data layer (transformed by default).
+    With index=True the index is saved as column(s). See krny_common.parquet for schema.
+    """
+    import pyarrow.parquet as pq
+    from krny_common import parquet, catalog
+
+    try:
+        dst_path = layer_path(file_path, layer)
+        dst_path = os.path.splitext(dst_path)[0] + '.parquet'
+        logger.info(f"Saving file {dst_path}")
+        if index:
+            df = df.reset_index()
+        pq_buffer = BytesIO()
+        table = parquet.to_table(df, schema)
+        pq.write_table(table, pq_buffer,
+                       compression=compression or parquet.COMPRESSION,
+                       row_group_size=row_group_size or parquet.ROW_GROUP_SIZE)
+        future = put_object(bucket, dst_path, pq_buffer.getvalue(), wait=wait)
+        record_outputs([{'bucket': bucket, 'key': dst_path, 'format': 'parquet',
+                         'columns': catalog.parquet_columns(table.schema)}], future)
+        return future
+    except Exception as err:
+        logger.error(f"Error while saving: {err}")
+
+
+def save_frame(df, bucket, file_path, layer=TRANSFORMED_DIR, file_format='csv', index=False,
+               wait=False, **kwargs):
+    "Save the DataFrame as 'csv' or 'parquet' under the given data layer"
+    if file_format == 'parquet':
+        return save_parquet(df, bucket, file_path, layer, index=index, wait=wait, **kwargs)
+    return save_csv(df, bucket, file_path, layer, index=index, wait=wait)
+
+
+def wait_for_uploads():
+    "Wait for every put queued by this thread, log failures and return the list of failed keys"
+    thread = _owner()
+    with _lock:
+        uploads = [upload[:3] for upload in _uploads if upload[3] == thread]
+        _uploads[:] = [upload for upload in _uploads if upload[3] != thread]
+    failed = []
+    for bucket, key, future in uploads:
+        err = future.exception()
+        if err is not None:
+            logger.error(f"Error while saving s3://{bucket}/{key}: {err}")
+            failed.append(key)
+    with _lock:
+        for bucket, key, future in uploads:
+            if _pending.get((bucket, key)) is future:
+                del _pending[(bucket, key)]
+    return failed
+
+
+class ParquetStreamWriter:
+    """
+    Write DataFrame batches to one PARQUET object under the given data layer
+    without keeping the whole file in memory. Batches are appended as row
+    groups to a spooled temp file which is uploaded on close. The typed
+    schema of the first batch (see krny_common.parquet) is kept for the
+    following ones: an int column of the first batch takes the gaps of a
+    later batch as nulls, a later non integer value fails the write.
+
+    with s3io.ParquetStreamWriter(BUCKET, file_path, CLEANED_DIR) as writer:
+        for df in s3io.iter_csv_chunks(BUCKET, file_path):
+            writer.write(df)
+    """
+
+    def __init__(self, bucket, file_path, layer=TRANSFORMED_DIR, schema=None,
+                 compression=None, row_group_size=None):
+        from krny_common import parquet
+
+        self.bucket = bucket
+        self.key = os.path.splitext(layer_path(file_path, layer))[0] + '.parquet'
+        self.rows = 0
+        self.compression = compression or parquet.COMPRESSION
+        self.row_group_size = row_group_size or parquet.ROW_GROUP_SIZE
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        self._writer = None
+        self._schema = schema
+
+    def write(self, df):
+        "Append a batch of rows"
+        import pyarrow.parquet as pq
+        from krny_common import parquet
+
+        table = parquet.to_table(df, self._schema)
+        if self._writer is None:
+            self._schema = table.schema
+            self._writer = pq.ParquetWriter(self._file, self._schema,
+                                            compression=self.compression)
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+        self.rows += len(df)
+
+    def close(self):
+        "Finish the file and queue its upload, nothing is uploaded without rows"
+        from krny_common import catalog
+
+        if self._writer is not None:
+            self._writer.close()
+        if not self.rows:
+            self._file.close()
+            return None
+        logger.info(f"Saving file {self.key} ({self.rows} rows)")
+        _count('written', self._file.tell())
+        future = _submit_write(self.bucket, self.key, _upload_file,
+                               self.bucket, self.key, self._file)
+        record_outputs([{'bucket': self.bucket, 'key': self.key, 'format': 'parquet',
+                         'columns': catalog.parquet_columns(self._schema)}], future)
+        return future
+
+    def abort(self):
+        "Drop everything written so far"
+        if self._writer is not None:
+            self._writer.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
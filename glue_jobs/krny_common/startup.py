@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Start up (import) time of the Glue jobs
+
+On pythonshell jobs every run pays the import of its libraries (pandas,
+boto3 ...) before any work is done, and one heavy import added at module
+top (eg. scikit-learn) costs seconds on every start. `log_import_time()`
+is called by the jobs once their imports are done: it logs how long the
+process took to get there and warns about the heavy libraries loaded.
+
+Libraries only needed on some code paths are imported where they are
+used (eg. pyarrow.parquet in s3io), and row normalisation is done with
+NumPy (krny_common.screening.normalize_rows) instead of sklearn.
+
+For a per module breakdown run the job with `python -X importtime`.
+
+Usage:
+    startup.log_import_time()
+
+"""
+
+# builtin imports
+import logging
+import os
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+# libraries not needed by any job at start up
+HEAVY_MODULES = ('sklearn', 'scipy', 'matplotlib', 'statsmodels')
+
+
+def process_age():
+    "Seconds since the process started, the CPU time used when /proc is not available"
+    try:
+        with open('/proc/self/stat') as stat_file:
+            # the command name (2nd field) may contain spaces, fields are counted after it
+            started = int(stat_file.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        return uptime - started / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.process_time()
+
+
+def log_import_time():
+    "Log the start up time of the job and the heavy libraries it imported, return the time"
+    seconds = process_age()
+    logger.info(f"Start up (imports) done in {seconds:.2f}s, {len(sys.modules)} modules loaded")
+    heavy = [name for name in HEAVY_MODULES if name in sys.modules]
+    if heavy:
+        logger.warning(f"Heavy libraries imported at start up: {', '.join(heavy)}")
+    return seconds
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: Shared pytest fixtures of the krny_common tests
+
+The tests run offline: S3, DynamoDB and Glue are moto mocks and
+awsglue.utils comes from the benchmarks stand-in, so the job scripts can
+be run as in Glue. Requirements: pytest, moto, numpy, pandas, pyarrow.
+
+Usage:
+    python -m pytest glue_jobs/tests
+
+"""
+
+# builtin imports
+import os
+import runpy
+import sys
+
+import pytest
+
+GLUE_JOBS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_DIR = os.path.join(GLUE_JOBS_DIR, 'benchmarks')
+sys.path[:0] = [GLUE_JOBS_DIR, BENCHMARKS_DIR]
+
+REGION = 'us-east-1'
+BUCKET = 'krny-test-bucket'
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    "moto mock of every AWS service, with fresh krny_common clients"
+    from moto import mock_aws
+    from krny_common import s3io
+
+    for name, value in {'AWS_DEFAULT_REGION': REGION, 'AWS_ACCESS_KEY_ID': 'testing',
+                        'AWS_SECRET_ACCESS_KEY': 'testing'}.items():
+        monkeypatch.setenv(name, value)
+    with mock_aws():
+        s3io._clients.clear()
+        yield
+        s3io.wait_for_uploads()
+        s3io.pop_outputs()
+        s3io._clients.clear()
+
+
+@pytest.fixture
+def s3(aws):
+    "S3 client with the test bucket created"
+    import boto3
+
+    client = boto3.client('s3', region_name=REGION)
+    client.create_bucket(Bucket=BUCKET)
+    return client
+
+
+@pytest.fixture
+def glue(aws):
+    "Glue client of the moto mock"
+    import boto3
+
+    return boto3.client('glue', region_name=REGION)
+
+
+def run_job(script, args, monkeypatch):
+    "Run a Glue job script as its __main__ with --key value job arguments"
+    path = os.path.join(GLUE_JOBS_DIR, script)
+    monkeypatch.setattr(sys, 'argv', [path] + [item for key, value in args.items()
+                                               for item in (f"--{key}", value)])
+    return runpy.run_path(path, run_name='__main__')
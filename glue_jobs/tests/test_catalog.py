@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"Tests of krny_common.catalog against moto Glue"
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from krny_common import catalog, crawls
+
+from conftest import BUCKET
+
+CRAWLER = 'krny-transformed-data'
+DATABASE = 'krny'
+COLUMNS = [('date', 'string'), ('gdp', 'double')]
+
+
+@pytest.fixture
+def database(s3, glue, monkeypatch):
+    "Catalog database with the partitioned fred table, crawled by CRAWLER"
+    monkeypatch.setattr(crawls.time, 'sleep', lambda seconds: None)
+    glue.create_database(DatabaseInput={'Name': DATABASE})
+    glue.create_crawler(Name=CRAWLER, Role='crawler-role', DatabaseName=DATABASE,
+                        Targets={'S3Targets': [{'Path': f"s3://{BUCKET}/transformed-data"}]})
+    glue.create_table(DatabaseName=DATABASE, TableInput={
+        'Name': 'fred',
+        'StorageDescriptor': {'Location': f"s3://{BUCKET}/transformed-data/fred/",
+                              'Columns': [{'Name': name, 'Type': glue_type} for name, glue_type in COLUMNS]},
+        'PartitionKeys': [{'Name': 'partition_0', 'Type': 'string'}],
+        'Parameters': {'classification': 'csv'},
+    })
+    return DATABASE
+
+
+def output(folder, columns=COLUMNS, file_format='csv'):
+    return {'bucket': BUCKET, 'key': f"transformed-data/fred/{folder}/fred.{file_format}",
+            'format': file_format, 'columns': columns}
+
+
+def test_csv_columns():
+    df = pd.DataFrame({'Date': ['2023-01-01'], 'GDP': [1.5], 'count': [1], 'flag': [True]})
+
+    assert catalog.csv_columns(df) == [('Date', 'string'), ('GDP', 'double'), ('count', 'bigint'),
+                                       ('flag', 'boolean')]
+
+
+def test_parquet_columns():
+    schema = pa.schema([('Date', pa.timestamp('ns')), ('GDP', pa.float64()), ('count', pa.int32())])
+
+    assert catalog.parquet_columns(schema) == [('Date', 'timestamp'), ('GDP', 'double'), ('count', 'int')]
+
+
+def test_schema_change():
+    table = {'Name': 'fred', 'Parameters': {'classification': 'csv'},
+             'StorageDescriptor': {'Columns': [{'Name': 'Date', 'Type': 'string'},
+                                               {'Name': 'GDP', 'Type': 'double'}]}}
+
+    assert catalog.schema_change(table, output('2023-01-01')) is None
+    # csv columns are matched by name and order only
+    assert catalog.schema_change(table, output('2023-01-01', [('date', 'bigint'), ('gdp', 'string')])) is None
+    assert 'differ' in catalog.schema_change(table, output('2023-01-01', COLUMNS[::-1]))
+    assert 'unknown' in catalog.schema_change(table, output('2023-01-01', None))
+    assert 'is parquet' in catalog.schema_change(table, output('2023-01-01', COLUMNS, 'parquet'))
+
+
+def test_publish_adds_partitions(database, glue):
+    started = catalog.publish(BUCKET, [CRAWLER], [output('2023-01-01'), output('2023-01-02')])
+
+    assert started == []
+    partitions = glue.get_partitions(DatabaseName=DATABASE, TableName='fred')['Partitions']
+    assert sorted(partition['Values'] for partition in partitions) == [['2023-01-01'], ['2023-01-02']]
+    # a partition that exists already is left as is
+    assert catalog.publish(BUCKET, [CRAWLER], [output('2023-01-01')]) == []
+
+
+def test_publish_crawls_a_new_dataset(database, glue):
+    new = {'bucket': BUCKET, 'key': 'transformed-data/covid/2023-01-01/covid.csv', 'format': 'csv',
+           'columns': COLUMNS}
+
+    assert catalog.publish(BUCKET, [CRAWLER], [output('2023-01-01'), new]) == [CRAWLER]
+    assert crawls.load_state(BUCKET, CRAWLER)[0]['running'] == [
+        f"s3://{BUCKET}/transformed-data/covid/2023-01-01/", f"s3://{BUCKET}/transformed-data/fred/2023-01-01/"]
+
+
+def test_publish_crawls_a_schema_change(database):
+    changed = output('2023-01-01', COLUMNS + [('cpi', 'double')])
+
+    assert catalog.publish(BUCKET, [CRAWLER], [changed]) == [CRAWLER]
+
+
+def test_deferred_publish_keeps_the_outputs(database, monkeypatch):
+    from krny_common import s3io
+
+    monkeypatch.setattr(catalog, 'DEFERRED', True)
+    assert catalog.publish(BUCKET, [CRAWLER], [output('2023-01-01')]) == []
+
+    assert s3io.pop_outputs() == [output('2023-01-01')]
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"Tests of krny_common.crawls and the crawl follow-up job against moto S3 and Glue"
+
+import pytest
+
+from krny_common import crawls
+
+from conftest import BUCKET, REGION, run_job
+
+CRAWLER = 'krny-cleaned-data'
+
+
+@pytest.fixture
+def crawler(s3, glue, monkeypatch):
+    "A moto crawler on the cleaned-data layer"
+    monkeypatch.setattr(crawls.time, 'sleep', lambda seconds: None)
+    glue.create_crawler(Name=CRAWLER, Role='crawler-role', DatabaseName='krny',
+                        Targets={'S3Targets': [{'Path': f"s3://{BUCKET}/cleaned-data/"}]})
+    return CRAWLER
+
+
+def finish_crawl(crawler):
+    "Mark the last moto crawl of crawler completed, the crawler is READY again"
+    from moto.core import DEFAULT_ACCOUNT_ID
+    from moto.glue.models import glue_backends
+
+    glue_backends[DEFAULT_ACCOUNT_ID][REGION].crawlers[crawler].crawls[-1].status = 'COMPLETED'
+
+
+def prefix(folder):
+    return f"s3://{BUCKET}/cleaned-data/fred/{folder}/"
+
+
+def test_schedule_starts_an_idle_crawler(crawler, glue):
+    assert crawls.schedule(BUCKET, {crawler: [prefix('2023-01-01')]}) == [crawler]
+
+    state, _ = crawls.load_state(BUCKET, crawler)
+    assert state['pending'] == [] and state['running'] == [prefix('2023-01-01')]
+    assert glue.get_crawler(Name=crawler)['Crawler']['State'] == 'RUNNING'
+
+
+def test_requests_during_a_crawl_are_started_by_the_follow_up(crawler):
+    crawls.schedule(BUCKET, {crawler: [prefix('2023-01-01')]})
+    assert crawls.schedule(BUCKET, {crawler: [prefix('2023-01-02')]}) == []
+    assert crawls.schedule(BUCKET, {crawler: [prefix('2023-01-03')]}) == []
+    assert crawls.load_state(BUCKET, crawler)[0]['pending'] == [prefix('2023-01-02'), prefix('2023-01-03')]
+
+    # a follow-up for a crawler still running leaves the requests pending
+    assert crawls.follow_up(BUCKET, [crawler], ready_wait=0) == []
+    finish_crawl(crawler)
+    assert crawls.follow_up(BUCKET, [crawler]) == [crawler]
+
+    state, _ = crawls.load_state(BUCKET, crawler)
+    assert state['pending'] == [] and state['running'] == [prefix('2023-01-02'), prefix('2023-01-03')]
+    # nothing requested during the second crawl, nothing more is started
+    finish_crawl(crawler)
+    assert crawls.follow_up(BUCKET, [crawler]) == []
+
+
+def test_update_state_retries_after_a_concurrent_write(crawler, monkeypatch):
+    load_state = crawls.load_state
+
+    def load_then_other_job_requests(bucket, name):
+        result = load_state(bucket, name)
+        monkeypatch.setattr(crawls, 'load_state', load_state)
+        crawls.request(bucket, name, [prefix('2023-01-02')])
+        return result
+
+    monkeypatch.setattr(crawls, 'load_state', load_then_other_job_requests)
+    crawls.request(BUCKET, crawler, [prefix('2023-01-01')])
+
+    assert crawls.load_state(BUCKET, crawler)[0]['pending'] == [prefix('2023-01-01'), prefix('2023-01-02')]
+
+
+def test_crawl_followup_job(crawler, glue, monkeypatch):
+    glue.create_crawler(Name='krny-transformed-data', Role='crawler-role', DatabaseName='krny',
+                        Targets={'S3Targets': [{'Path': f"s3://{BUCKET}/transformed-data/"}]})
+    crawls.schedule(BUCKET, {crawler: [prefix('2023-01-01')]})
+    crawls.request(BUCKET, crawler, [prefix('2023-01-02')])
+    finish_crawl(crawler)
+
+    run_job('crawl-followup/krny_crawl_followup.py',
+            {'bucket': BUCKET, 'crawler_cleaneddata': crawler,
+             'crawler_transformeddata': 'krny-transformed-data'}, monkeypatch)
+
+    assert crawls.load_state(BUCKET, crawler)[0]['running'] == [prefix('2023-01-02')]
+    assert glue.get_crawler(Name='krny-transformed-data')['Crawler']['State'] == 'READY'
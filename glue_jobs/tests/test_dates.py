@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"Tests of krny_common.dates"
+
+import pandas as pd
+import pytest
+
+from krny_common import dates
+
+
+def test_to_date_drops_the_time():
+    parsed = dates.to_date(pd.Series(['2023-01-15 10:30:00', '2023-02-01']))
+
+    assert parsed.dtype == 'datetime64[ns]'
+    assert list(parsed) == [pd.Timestamp('2023-01-15'), pd.Timestamp('2023-02-01')]
+    assert parsed.to_frame('Date').to_csv(index=False) == 'Date\n2023-01-15\n2023-02-01\n'
+
+
+def test_month_start():
+    assert list(dates.month_start(pd.Series(['2023-01-15', '2023-02-28']))) == [
+        pd.Timestamp('2023-01-01'), pd.Timestamp('2023-02-01')]
+
+
+def test_parse_periods():
+    values = pd.Series(['2010Q1', '2010Q4', '2010M01', '2010M12', '2010-02', '2010-02-15', ' 2011Q2 '])
+
+    assert list(dates.parse_periods(values)) == [pd.Timestamp(day) for day in [
+        '2010-03-31', '2010-12-31', '2010-01-01', '2010-12-01', '2010-02-01', '2010-02-15', '2011-06-30']]
+
+
+def test_parse_periods_keeps_datetimes():
+    values = pd.Series(pd.to_datetime(['2010-01-01']))
+
+    pd.testing.assert_series_equal(dates.parse_periods(values), values)
+
+
+def test_parse_periods_unparseable():
+    values = pd.Series(['2010Q1', 'Q5-2010', '2010M13', None])
+
+    with pytest.raises(ValueError, match=r"2 unparseable periods .*1: 'Q5-2010', 2: '2010M13'"):
+        dates.parse_periods(values)
+    parsed = dates.parse_periods(values, errors='coerce')
+    assert parsed[0] == pd.Timestamp('2010-03-31') and parsed[1:].isna().all()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"Tests of krny_common.manifest against a moto S3 bucket"
+
+import json
+
+from krny_common import manifest
+
+from conftest import BUCKET
+
+SRC_DIR = 'raw-data/fred'
+
+
+def put(s3, key, body='DATE,A\n2023-01-01,1\n'):
+    s3.put_object(Bucket=BUCKET, Key=key, Body=body.encode('utf-8'))
+
+
+def process(folders):
+    "Mark folders processed as a job run does"
+    manifest.mark_processed(BUCKET, SRC_DIR, folders)
+    return folders
+
+
+def saved_objects(s3):
+    body = s3.get_object(Bucket=BUCKET, Key=manifest.manifest_path(SRC_DIR))['Body'].read()
+    return json.loads(body)['objects']
+
+
+def test_seed_from_transformed_folders(s3):
+    put(s3, f"{SRC_DIR}/2023-01-01/a.csv")
+    put(s3, f"{SRC_DIR}/2023-01-02/a.csv")
+    put(s3, 'transformed-data/fred/2023-01-01/fred.csv')
+
+    folders = manifest.get_changed_folders(BUCKET, SRC_DIR)
+
+    assert folders == {f"{SRC_DIR}/2023-01-02": [f"{SRC_DIR}/2023-01-02/a.csv"]}
+
+
+def test_new_and_rewritten_files(s3):
+    put(s3, f"{SRC_DIR}/2023-01-01/a.csv")
+    process(manifest.get_changed_folders(BUCKET, SRC_DIR))
+    assert manifest.get_changed_folders(BUCKET, SRC_DIR) == {}
+
+    # rewritten in the last folder, a new file in a new folder
+    put(s3, f"{SRC_DIR}/2023-01-01/a.csv", 'DATE,A\n2023-01-01,2\n')
+    put(s3, f"{SRC_DIR}/2023-01-02/a.csv")
+
+    folders = manifest.get_changed_folders(BUCKET, SRC_DIR)
+
+    assert sorted(folders) == [f"{SRC_DIR}/2023-01-01", f"{SRC_DIR}/2023-01-02"]
+
+
+def test_deleted_file_is_dropped_and_seen_again_when_restored(s3):
+    put(s3, f"{SRC_DIR}/2023-01-01/a.csv")
+    put(s3, f"{SRC_DIR}/2023-01-01/b.csv")
+    process(manifest.get_changed_folders(BUCKET, SRC_DIR))
+
+    s3.delete_object(Bucket=BUCKET, Key=f"{SRC_DIR}/2023-01-01/b.csv")
+    process(manifest.get_changed_folders(BUCKET, SRC_DIR))
+    assert f"{SRC_DIR}/2023-01-01/b.csv" not in saved_objects(s3)
+
+    # the same file put back is a change of the folder again
+    put(s3, f"{SRC_DIR}/2023-01-01/b.csv")
+    folders = manifest.get_changed_folders(BUCKET, SRC_DIR)
+
+    assert folders == {f"{SRC_DIR}/2023-01-01": [f"{SRC_DIR}/2023-01-01/a.csv", f"{SRC_DIR}/2023-01-01/b.csv"]}
+
+
+def test_deleted_file_in_older_folder_waits_for_full_scan(s3):
+    put(s3, f"{SRC_DIR}/2023-01-01/a.csv")
+    put(s3, f"{SRC_DIR}/2023-01-02/a.csv")
+    process(manifest.get_changed_folders(BUCKET, SRC_DIR))
+
+    s3.delete_object(Bucket=BUCKET, Key=f"{SRC_DIR}/2023-01-01/a.csv")
+    process(manifest.get_changed_folders(BUCKET, SRC_DIR))
+    assert f"{SRC_DIR}/2023-01-01/a.csv" in saved_objects(s3)
+
+    process(manifest.get_changed_folders(BUCKET, SRC_DIR, full_scan_days=0))
+    assert f"{SRC_DIR}/2023-01-01/a.csv" not in saved_objects(s3)
+
+
+def test_backfilled_folder_before_last_key(s3):
+    put(s3, f"{SRC_DIR}/data/2023-01-05/a.csv")
+    process(manifest.get_changed_folders(BUCKET, SRC_DIR))
+
+    put(s3, f"{SRC_DIR}/data/2023-01-01/a.csv")
+
+    assert manifest.get_changed_folders(BUCKET, SRC_DIR) == {
+        f"{SRC_DIR}/data/2023-01-01": [f"{SRC_DIR}/data/2023-01-01/a.csv"]}
+
+
+def test_nested_backfilled_folders(s3):
+    put(s3, f"{SRC_DIR}/2023/05/a.csv")
+    process(manifest.get_changed_folders(BUCKET, SRC_DIR))
+
+    # a new month of a processed year and a new year, both before 2023/05
+    put(s3, f"{SRC_DIR}/2023/01/a.csv")
+    put(s3, f"{SRC_DIR}/2022/12/a.csv")
+    folders = process(manifest.get_changed_folders(BUCKET, SRC_DIR))
+
+    assert sorted(folders) == [f"{SRC_DIR}/2022/12", f"{SRC_DIR}/2023/01"]
+    assert manifest.get_changed_folders(BUCKET, SRC_DIR) == {}
+
+
+def test_failed_folder_is_listed_again(s3):
+    put(s3, f"{SRC_DIR}/2023-01-01/a.csv")
+    folders = manifest.get_changed_folders(BUCKET, SRC_DIR)
+    manifest.mark_processed(BUCKET, SRC_DIR, folders,
+                            failed_keys=['transformed-data/fred/2023-01-01/fred.csv'])
+
+    assert list(manifest.get_changed_folders(BUCKET, SRC_DIR)) == [f"{SRC_DIR}/2023-01-01"]
+
+
+def test_excluded_prefix(s3):
+    put(s3, f"{SRC_DIR}/config/mnemonics.csv")
+    put(s3, f"{SRC_DIR}/2023-01-01/a.csv")
+
+    folders = process(manifest.get_changed_folders(BUCKET, SRC_DIR, exclude=[f"{SRC_DIR}/config"]))
+
+    assert list(folders) == [f"{SRC_DIR}/2023-01-01"]
+    assert list(saved_objects(s3)) == [f"{SRC_DIR}/2023-01-01/a.csv"]
+    put(s3, f"{SRC_DIR}/config/mnemonics.csv", 'mnemonic,description\n')
+    assert manifest.get_changed_folders(BUCKET, SRC_DIR, exclude=[f"{SRC_DIR}/config"]) == {}
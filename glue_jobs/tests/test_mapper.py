@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"Tests of krny_common.mapper against moto DynamoDB and S3"
+
+import json
+
+import boto3
+import pytest
+
+from krny_common import mapper, s3io
+
+from conftest import BUCKET, REGION
+
+TABLE = 'krny-fred-mapper'
+
+
+@pytest.fixture
+def table(s3):
+    "Mapper table with one series, and the scans done by mapper"
+    dynamodb = boto3.client('dynamodb', region_name=REGION)
+    dynamodb.create_table(TableName=TABLE, KeySchema=[{'AttributeName': 'Series_ID', 'KeyType': 'HASH'}],
+                          AttributeDefinitions=[{'AttributeName': 'Series_ID', 'AttributeType': 'S'}],
+                          BillingMode='PAY_PER_REQUEST')
+    put_series(dynamodb, 'GDP', 'Gross domestic product')
+    mapper._mappers.clear()
+    mapper._stale.clear()
+    yield dynamodb
+    mapper._mappers.clear()
+    mapper._stale.clear()
+
+
+def put_series(dynamodb, series_id, name):
+    dynamodb.put_item(TableName=TABLE, Item={'Series_ID': {'S': series_id}, 'Series_Name': {'S': name}})
+
+
+def load():
+    return mapper.load_mapper(TABLE, 'Series_ID', 'Series_Name', BUCKET)
+
+
+def age_snapshot():
+    "Make the saved snapshot older than MAX_AGE_MINUTES"
+    snapshot = json.loads(s3io.get_object(BUCKET, mapper.snapshot_path(TABLE)))
+    snapshot['saved'] = '2023-01-01T00:00:00'
+    s3io.put_object(BUCKET, mapper.snapshot_path(TABLE), json.dumps(snapshot).encode('utf-8'), wait=True)
+
+
+def test_scan_without_snapshot(table):
+    assert load() == {'GDP': 'Gross domestic product'}
+    assert json.loads(s3io.get_object(BUCKET, mapper.snapshot_path(TABLE)))['items'] == load()
+
+
+def test_parallel_segments(table):
+    for i in range(20):
+        put_series(table, f"S{i}", f"Series {i}")
+
+    assert mapper.scan_mapper(TABLE, 'Series_ID', 'Series_Name', segments=4) == \
+        mapper.scan_mapper(TABLE, 'Series_ID', 'Series_Name')
+
+
+def test_old_snapshot_is_used_and_refreshed_after_the_run(table, monkeypatch):
+    load()
+    age_snapshot()
+    put_series(table, 'GDP', 'GDP, real')
+    mapper._mappers.clear()
+    scans = []
+    scan_mapper = mapper.scan_mapper
+    monkeypatch.setattr(mapper, 'scan_mapper', lambda *args: scans.append(args) or scan_mapper(*args))
+
+    assert load() == {'GDP': 'Gross domestic product'}
+    assert scans == []
+    mapper.refresh_stale()
+    assert len(scans) == 1
+
+    mapper._mappers.clear()
+    assert load() == {'GDP': 'GDP, real'}
+    mapper.refresh_stale()
+    assert len(scans) == 1
+
+
+def test_fresh_snapshot_is_not_refreshed(table, monkeypatch):
+    load()
+    mapper._mappers.clear()
+    monkeypatch.setattr(mapper, 'scan_mapper', lambda *args: pytest.fail('table scanned'))
+
+    assert load() == {'GDP': 'Gross domestic product'}
+    mapper.refresh_stale()
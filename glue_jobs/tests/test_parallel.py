@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"Tests of krny_common.parallel, inline and with forked workers"
+
+import logging
+import os
+import sys
+
+import pytest
+
+from krny_common import parallel, s3io
+
+FOLDERS = {f"raw-data/fred/2023-01-0{day}": [f"raw-data/fred/2023-01-0{day}/a.csv"] for day in range(1, 5)}
+# folders failing in process_folder, by exception and by sys.exit as the jobs do
+RAISING = 'raw-data/fred/2023-01-02'
+EXITING = 'raw-data/fred/2023-01-03'
+
+
+def process_folder(folder, files):
+    logging.getLogger('krny_test').info(f"transforming {folder}")
+    if folder == RAISING:
+        raise Exception(f"while transformation: {folder}")
+    if folder == EXITING:
+        sys.exit(0)
+    s3io.record_outputs([{'bucket': 'bucket', 'key': folder.replace('raw-data', 'transformed-data')}])
+    return os.getpid(), len(files)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_run_folders_isolates_failures(workers, caplog):
+    caplog.set_level(logging.INFO)
+
+    results, failures = parallel.run_folders(process_folder, FOLDERS, workers)
+
+    assert sorted(results) == ['raw-data/fred/2023-01-01', 'raw-data/fred/2023-01-04']
+    assert all(count == 1 for _, count in results.values())
+    assert sorted(failures) == [RAISING, EXITING]
+    assert 'while transformation' in failures[RAISING]
+    # the outputs recorded by the folders are back in the parent
+    assert sorted(output['key'] for output in s3io.pop_outputs()) == [
+        'transformed-data/fred/2023-01-01', 'transformed-data/fred/2023-01-04']
+    # the log records of the folders come in folder order
+    messages = [record.getMessage() for record in caplog.records if record.name == 'krny_test']
+    assert messages == [f"transforming {folder}" for folder in sorted(FOLDERS)]
+
+
+def test_run_folders_forks_workers():
+    results, _ = parallel.run_folders(process_folder, FOLDERS, 2)
+
+    assert all(pid != os.getpid() for pid, _ in results.values())
+
+
+def kill_worker(folder, files):
+    if folder == RAISING:
+        # as a worker killed when out of memory
+        os._exit(1)
+    return folder
+
+
+def test_killed_worker_fails_folders_without_raising():
+    results, failures = parallel.run_folders(kill_worker, FOLDERS, 2)
+
+    assert RAISING in failures and 'BrokenProcessPool' in failures[RAISING]
+    assert set(results) | set(failures) == set(FOLDERS)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"Tests of krny_common.registry against a moto S3 bucket"
+
+import pytest
+
+from krny_common import registry
+from krny_common.registry import CsvRegistry
+
+from conftest import BUCKET
+
+KEY = 'raw-data/ihs/config/mnemonics.csv'
+
+
+def new_registry():
+    return CsvRegistry(BUCKET, KEY, 'mnemonic', 'description')
+
+
+def test_commit_creates_and_merges(s3):
+    first = new_registry()
+    first.update({'GDP': 'Gross domestic product'})
+    assert first.commit()
+
+    second = new_registry()
+    second.update({'CPI': 'Consumer prices', 'GDP': 'GDP, real'})
+    assert second.commit()
+
+    assert new_registry().read()[0] == {'GDP': 'GDP, real', 'CPI': 'Consumer prices'}
+    assert second.pending == {}
+
+
+def test_commit_merges_again_after_a_concurrent_write(s3, monkeypatch):
+    monkeypatch.setattr(registry.time, 'sleep', lambda seconds: None)
+    mine = new_registry()
+    mine.update({'CPI': 'Consumer prices'})
+    read = mine.read
+
+    def read_then_other_run_commits():
+        result = read()
+        monkeypatch.setattr(mine, 'read', read)
+        other = new_registry()
+        other.update({'GDP': 'Gross domestic product'})
+        other.commit()
+        return result
+
+    monkeypatch.setattr(mine, 'read', read_then_other_run_commits)
+    assert mine.commit()
+
+    assert new_registry().read()[0] == {'GDP': 'Gross domestic product', 'CPI': 'Consumer prices'}
+
+
+def test_commit_without_pending_pairs_writes_nothing(s3):
+    assert new_registry().commit()
+
+    with pytest.raises(s3.exceptions.NoSuchKey):
+        s3.get_object(Bucket=BUCKET, Key=KEY)
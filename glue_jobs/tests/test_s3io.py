@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"Tests of krny_common.s3io against a moto S3 bucket"
+
+from io import BytesIO
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from botocore.exceptions import ParamValidationError
+
+from krny_common import s3io
+
+from conftest import BUCKET
+
+
+def test_put_if_match(s3):
+    assert s3io.put_if_match(BUCKET, 'state.json', b'1', None)
+    # If-None-Match: the object exists now
+    assert not s3io.put_if_match(BUCKET, 'state.json', b'2', None)
+
+    etag = s3.head_object(Bucket=BUCKET, Key='state.json')['ETag']
+    assert s3io.put_if_match(BUCKET, 'state.json', b'3', etag)
+    # If-Match: the etag read before the last write
+    assert not s3io.put_if_match(BUCKET, 'state.json', b'4', etag)
+    assert s3io.get_object(BUCKET, 'state.json') == b'3'
+
+
+def test_put_if_match_raises_without_conditional_writes(s3, monkeypatch):
+    client = s3io.get_client()
+
+    def put_object(**kwargs):
+        raise ParamValidationError(report='Unknown parameter in input: "IfNoneMatch"')
+
+    monkeypatch.setattr(client, 'put_object', put_object)
+    with pytest.raises(Exception, match='no conditional writes'):
+        s3io.put_if_match(BUCKET, 'state.json', b'1', None)
+
+
+def test_put_if_match_waits_for_queued_put(s3):
+    s3io.put_object(BUCKET, 'state.json', b'1')
+
+    assert not s3io.put_if_match(BUCKET, 'state.json', b'2', None)
+
+
+def test_save_frame_and_read_back(s3):
+    df = pd.DataFrame({'Date': ['2023-01-01', '2023-02-01'], 'value': [1.5, 2.5], 'count': [1, 2]})
+
+    s3io.save_frame(df, BUCKET, 'raw-data/fred/2023-01-01/fred.csv', wait=True)
+    s3io.save_frame(df, BUCKET, 'raw-data/fred/2023-01-01/fred.csv', file_format='parquet', wait=True)
+
+    assert s3io.wait_for_uploads() == []
+    pd.testing.assert_frame_equal(s3io.read_csv(BUCKET, 'transformed-data/fred/2023-01-01/fred.csv'), df)
+    table = pq.read_table(BytesIO(s3io.get_object(BUCKET, 'transformed-data/fred/2023-01-01/fred.parquet')))
+    assert table.schema.field('count').type == pa.int64()
+    outputs = s3io.pop_outputs()
+    assert [(output['key'], output['format']) for output in outputs] == [
+        ('transformed-data/fred/2023-01-01/fred.csv', 'csv'),
+        ('transformed-data/fred/2023-01-01/fred.parquet', 'parquet')]
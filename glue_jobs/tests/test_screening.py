@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"Tests of krny_common.screening against the pandas / sklearn style rule it replaced"
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from krny_common import screening
+
+
+def frame(columns, rows=40, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(rng.normal(size=(rows, columns)) * rng.uniform(0.1, 5, size=columns),
+                        columns=[f"S{i}" for i in range(columns)])
+
+
+def qcut_columns(df, percentile):
+    "The screening rule used before: qcut of the variance ranks, first `percentile` buckets"
+    normalized = df.div(np.sqrt((df ** 2).sum(axis=1)), axis=0)
+    buckets = pd.qcut(normalized.var().rank(method='first', ascending=False), 100, labels=False)
+    return list(df.columns[(buckets < percentile).to_numpy()])
+
+
+def test_normalize_rows():
+    values = np.array([[3.0, 4.0], [0.0, 0.0]])
+
+    np.testing.assert_allclose(screening.normalize_rows(values), [[0.6, 0.8], [0.0, 0.0]])
+
+
+@pytest.mark.parametrize('columns', [2, 7, 10, 99, 100, 101, 257])
+@pytest.mark.parametrize('percentile', [1, 15, 50, 99])
+def test_percentile_keeps_the_qcut_columns(columns, percentile):
+    df = frame(columns)
+
+    assert screening.screen_columns(df, percentile=percentile) == qcut_columns(df, percentile)
+
+
+def test_top_k_in_original_order():
+    df = frame(10)
+    variance = screening.column_variance(df)
+    top = set(variance.sort_values(ascending=False).index[:3])
+
+    assert screening.select_columns(variance, top_k=3) == [column for column in df.columns if column in top]
+    assert screening.screen_columns(df) == list(df.columns)
+
+
+def test_float32_ranks_as_float64():
+    df = frame(50)
+
+    assert screening.screen_columns(df, top_k=10, dtype=np.float32) == screening.screen_columns(df, top_k=10)
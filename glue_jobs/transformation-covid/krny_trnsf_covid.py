@@ -14,6 +14,8 @@ with Job Parameters as :
     --irm_file: <external file path>
     --crawler_cleaneddata: <crawler name for cleaned data>
     --crawler_transformeddata: <crawler name for tarnsformed data>
+    --output_format: <csv or parquet, optional>
+    --workers: <number of folders processed in parallel, optional>
 
 """
 
@@ -26,13 +28,13 @@ __date__ = "March 2023"
 
 # builtin imports 
 import logging
-import os
-from io import StringIO
 import sys
 
 # Lib
 import pandas as pd
-import boto3
+
+# Shared helpers
+from krny_common import s3io, manifest, parallel, dates, refdata, catalog, metrics, startup, CLEANED_DIR
 
 # Platform specific imports
 from awsglue.utils import getResolvedOptions
@@ -47,11 +49,20 @@ args = getResolvedOptions(sys.argv, [
 # source data
 BUCKET = args.get('bucket')
 FOLDER = args.get('folder')
+SRC_DIR = FOLDER + '/data'
 
 # get crawler name
 CRAWLER1 = args.get('crawler_cleaneddata')
 CRAWLER2 = args.get('crawler_transformeddata')
 
+# output format of cleaned and transformed data: csv (default) or parquet
+OUTPUT_FORMAT = getResolvedOptions(sys.argv, ['output_format'])['output_format'] \
+    if '--output_format' in sys.argv else 'csv'
+
+# number of folders processed in parallel (forked processes), 1 runs them one by one
+WORKERS = int(getResolvedOptions(sys.argv, ['workers'])['workers']) \
+    if '--workers' in sys.argv else 1
+
 # additional files
 IRM_FILE_PATH = args.get('irm_file')
 
@@ -63,14 +74,10 @@ rubbish_states = ['Department of Defense',
                   'Long Term Care (LTC) Program',
                   'Veterans Health Administration'
                   ]
+rubbish_cases_states = ['Recovered']
 REVELANT_COLS = ['Province_State', 'Date',
                  'People_at_least_one_dose', 'People_fully_vaccinated']
 
-# Data layers in the S3 bucket
-RAW_DIR = 'raw-data'
-CLEANED_DIR = 'cleaned-data'
-TRANSFORMED_DIR = 'transformed-data'
-
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -81,85 +88,32 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
-s3_resource = boto3.resource('s3')
-bucket = s3_resource.Bucket(BUCKET)
-
-client = boto3.client('s3')
-# paginator = client.get_paginator('list_objects_v2')
-# result = paginator.paginate(Bucket=BUCKET,Prefix=FOLDER)
-
-def read_csv(file_path, **kwargs):
-    "Read data file and return pd dataframe"
-    logger.info(f"Reading file: {file_path}")
-    try:
-        response = client.get_object(Bucket=BUCKET, Key=file_path)
-        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
-        if status == 200:
-            print(f"Successful S3 get_object response. Status - {status}")
-            return pd.read_csv(response.get("Body"))
-    except Exception as err:
-        logger.error(f"Error while reading: {err}")
-        raise Exception(f"While reading file: {err}")
-
-
-def save_csv(df, file_path):
-    "Save the DataFrame as CSV in transformed directory"
-    try:
-        dst_path = file_path.replace(RAW_DIR, TRANSFORMED_DIR)
-        logger.info(f"Saving file {dst_path}")
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3_resource.Object(BUCKET, dst_path).put(Body=csv_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
-        
-def save_csv_raw(df, file_path):
-    "Save the DataFrame as CSV in cleaned data dir"
-    try:
-        dst_path = file_path.replace(RAW_DIR, CLEANED_DIR)
-        logger.info(f"Saving file {dst_path}")
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3_resource.Object(BUCKET, dst_path).put(Body=csv_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
 
 def get_folder_list():
     """
-    This function returns the list for folders from raw-data which do not exists in transform-data.
-    ie. only incremented / newly added directory will be returned
+    This function returns the dict of folders (with their files) from raw-data which are
+    new or changed since the last processed run, as per the processed-partition manifest.
+    ie. only incremented / newly added / updated directory will be returned
     """
-    src_dict = {}
-    dst_dict = {}
-    SRC_DIR = FOLDER + '/data'
-    DST_DIR = SRC_DIR.replace(RAW_DIR, TRANSFORMED_DIR)
-
     try:
-        for objects in bucket.objects.filter(Prefix=SRC_DIR):
-            path_str = objects.key
-            if path_str.endswith(".csv"):
-                dirname = os.path.dirname(path_str)
-                try:
-                    src_dict[dirname].append(path_str)
-                except:
-                    src_dict[dirname] = [path_str,]
+        return manifest.get_changed_folders(BUCKET, SRC_DIR)
     except Exception as error:
         logger.error(f"Error: {error}")
+        return {}
 
-    try:
-        for objects in bucket.objects.filter(Prefix=DST_DIR):
-            path_str = objects.key
-            if path_str.endswith(".csv"):
-                dirname = os.path.dirname(path_str)
-                try:
-                    dst_dict[dirname].append(path_str)
-                except:
-                    dst_dict[dirname] = [path_str,]
-    except Exception as error:
-        logger.error(f"Error: {error}")
 
-    dst_dict = {k.replace(TRANSFORMED_DIR, RAW_DIR): v for (k, v) in dst_dict.items()}
-    return {k: src_dict[k] for k in set(src_dict) - set(dst_dict)}
+def build_irm_tables(pop):
+    "It returns the (population, irm) tables of the US states from the IRM file"
+    options = ['UNITED STATES',]
+    pop = pop[pop['Country'].isin(options)]
+    pop = pop.loc[pop['Province_State_'] != 'z_total']
+    pop = pop.loc[~(pop['Population'].isna()), :]
+    pop = pop.rename(columns={'Province_State_': 'Province_State'})
+    irm = pop[['Date', 'Province_State', 'Inverse Risk Metric']].copy()
+    irm['Date'] = dates.to_date(irm['Date'])
+    pop = pop[['Province_State', 'Population']
+              ].drop_duplicates('Province_State')
+    return pop, irm
 
 
 def apply_transformations(folder, files):
@@ -170,11 +124,18 @@ def apply_transformations(folder, files):
     """
     try:
         logger.debug(folder, files)
+        # download vaccine and covidcases files concurrently
+        data_files = [file_path for file_path in files
+                      if 'vaccinedata' in file_path or 'covidcases' in file_path]
+        with metrics.stage('read', folder=folder) as stage:
+            frames = dict(zip(data_files, s3io.read_csv_many(BUCKET, data_files)))
+            for df in frames.values():
+                stage.frame(df)
         for file_path in files:
             if 'vaccinedata' in file_path:
                 try:
                     # Get vaccine data
-                    vaccine_df = read_csv(file_path)
+                    vaccine_df = frames[file_path]
                     # Select US only
                     vaccine_df = vaccine_df.loc[vaccine_df['Country_Region'] == COUNTRY, :].reset_index(
                     )
@@ -182,9 +143,7 @@ def apply_transformations(folder, files):
                     vaccine_df = vaccine_df.loc[~(
                         vaccine_df['Province_State'].isin(rubbish_states)), :]
                     # Format date
-                    vaccine_df['Date'] = pd.to_datetime(vaccine_df['Date'])
-                    vaccine_df['Date'] = vaccine_df['Date'].apply(
-                        lambda x: x.date())
+                    vaccine_df['Date'] = dates.to_date(vaccine_df['Date'])
                     # Sort table
                     vaccine_df = vaccine_df.sort_values(
                         ['Province_State', 'Date'])
@@ -206,42 +165,38 @@ def apply_transformations(folder, files):
 
                 try:
                     # read data file as df
-                    cases_df = read_csv(file_path)
+                    cases_df = frames[file_path]
                     # Select US only
                     cases_df = cases_df.loc[cases_df['Country_Region'] == 'US', :].reset_index(
                     )
                     # Format date
-                    cases_df['Date'] = pd.to_datetime(
+                    cases_df['Date'] = dates.to_date(
                         cases_df['Date'], format="%Y-%m-%d")
-
-                    cases_df['Date'] = cases_df['Date'].apply(
-                        lambda x: x.date())
                     # Sort table
                     cases_df = cases_df.sort_values(['Province_State', 'Date'])
                     # Select only relevant cols
                     cases_df = cases_df[['Province_State',
                                          'Date', 'Confirmed', 'Deaths']]
 
-                    # Calculate 7 Day Average New Cases
-                    cases_df['New Cases'] = cases_df.loc[:, 'Confirmed'] - \
-                        cases_df.loc[:, 'Confirmed'].shift(1).fillna(0)
-                    cases_df.loc[cases_df['New Cases'] < 0] = 0
-                    # Remove new cases for 1st months
-                    for p in cases_df['Province_State'].unique():
-                        mindate = cases_df.loc[cases_df['Province_State'] == p, 'Date'].min(
-                        )
-                        cases_df.loc[(cases_df['Province_State'] == p) & (
-                            cases_df['Date'] == mindate), 'New Cases'] = 0
-                    cases_df['7 Day Average New Cases'] = cases_df.loc[:,
-                                                                       'New Cases'].rolling(window=7).mean()
+                    # Calculate 7 Day Average New Cases, per state
+                    # (rows are sorted by state and date, so the groups keep date order)
+                    by_state = cases_df.groupby('Province_State', sort=False, dropna=False)
+                    cases_df['New Cases'] = by_state['Confirmed'].diff()
+                    # Remove new cases for 1st day of each state
+                    cases_df.loc[by_state.cumcount() == 0, 'New Cases'] = 0
+                    # Negative new cases (corrections) count as 0, their rows are dropped below
+                    negative = cases_df['New Cases'] < 0
+                    cases_df.loc[negative, 'New Cases'] = 0
+                    cases_df['7 Day Average New Cases'] = cases_df.groupby(
+                        'Province_State', sort=False, dropna=False)['New Cases'].rolling(
+                        window=7).mean().reset_index(level=0, drop=True)
+                    cases_df = cases_df.loc[~negative, :]
                     # Rename columns
                     cases_df = cases_df.rename(
                         columns={'Confirmed': 'total_cases', 'Deaths': 'total_deaths'})
                     # Get rid of rubbish states
-                    rubbish_states = ['Recovered', 0]
                     cases_df = cases_df.loc[~(
-                        cases_df['Province_State'].isin(rubbish_states)), :]
-                    cases_df = cases_df.loc[cases_df['Province_State'] != 0]
+                        cases_df['Province_State'].isin(rubbish_cases_states)), :]
                     # cases_df.to_csv(dest_path,index=False)
                 except Exception as err:
                     logger.error(f"Error while transforming: {err}")
@@ -252,47 +207,40 @@ def apply_transformations(folder, files):
 
         # Operations on third file
         try:
-            pop = read_csv(IRM_FILE_PATH)  # irm_data
-            options = ['UNITED STATES',]
-            pop = pop[pop['Country'].isin(options)]
-            pop = pop.loc[pop['Province_State_'] != 'z_total']
-            pop = pop.loc[~(pop['Population'].isna()), :]
-            pop = pop.rename(columns={'Province_State_': 'Province_State'})
-            irm = pop[['Date', 'Province_State', 'Inverse Risk Metric']]
-            pop = pop[['Province_State', 'Population']
-                      ].drop_duplicates('Province_State')
+            # irm_data, read once per process and reused while its ETag is unchanged
+            pop, irm = refdata.derived('irm_tables', build_irm_tables, BUCKET, [IRM_FILE_PATH])
         except Exception as err:
             logger.error(f"Error while reading IRM file: {err}")
 
         # Merge data
         if (not vaccine_df.empty and not cases_df.empty):
-            covid_df = pd.merge(vaccine_df, cases_df, left_on=['Date', 'Province_State'],
-                                right_on=['Date', 'Province_State'], how='outer')
+            with metrics.stage('merge', folder=folder) as stage:
+                covid_df = pd.merge(vaccine_df, cases_df, left_on=['Date', 'Province_State'],
+                                    right_on=['Date', 'Province_State'], how='outer')
 
-            del vaccine_df
-            del cases_df
+                del vaccine_df
+                del cases_df
 
-            # Merge population
-            covid_df['Province_State'] = covid_df['Province_State'].apply(
-                lambda x: str(x).upper())
-            covid_df = pd.merge(covid_df, pop, on='Province_State', how='left')
-            # Drop minor states without population stats
-            origstates = set(covid_df['Province_State'])
-            covid_df = covid_df.loc[~(covid_df['Population'].isna()), :]
-            # print(f"Dropped minor states due to missing population stats: {origstates-set(covid_df['Province_State'])}")
+                # Merge population
+                covid_df['Province_State'] = covid_df['Province_State'].apply(
+                    lambda x: str(x).upper())
+                covid_df = pd.merge(covid_df, pop, on='Province_State', how='left')
+                # Drop minor states without population stats
+                covid_df = covid_df.loc[~(covid_df['Population'].isna()), :]
 
-            # Merge IRM
-            irm['Date'] = pd.to_datetime(irm['Date']).apply(lambda x: x.date())
-            covid_df = pd.merge(covid_df, irm, on=[
-                                'Province_State', 'Date'], how='left')
+                # Merge IRM
+                covid_df = pd.merge(covid_df, irm, on=[
+                                    'Province_State', 'Date'], how='left')
 
-            # Fill down missing IRM per state (recent months)
-            covid_df = covid_df.sort_values(['Province_State', 'Date'])
-            covid_df['Inverse Risk Metric'] = covid_df['Inverse Risk Metric'].ffill()
+                # Fill down missing IRM per state (recent months)
+                covid_df = covid_df.sort_values(['Province_State', 'Date'])
+                covid_df['Inverse Risk Metric'] = covid_df['Inverse Risk Metric'].ffill()
+                stage.frame(covid_df)
 
             # Saving as merged and clean data
             dst_file = f"{folder}/covid.csv"
-            save_csv_raw(covid_df, dst_file)
+            with metrics.stage('write_cleaned', folder=folder) as stage:
+                s3io.save_frame(stage.frame(covid_df), BUCKET, dst_file, CLEANED_DIR, OUTPUT_FORMAT)
 
         ##############
         if not covid_df.empty:
@@ -305,8 +253,7 @@ def apply_transformations(folder, files):
             covid_df['Province_State'] = covid_df['Province_State'].apply(
                 lambda x: str(x).upper())
             # Take only rows up to maxmonth
-            covid_df['month_year'] = pd.to_datetime(
-                covid_df['Date']).apply(lambda x: x.replace(day=1).date())
+            covid_df['month_year'] = dates.month_start(covid_df['Date'])
 
             # Calculate monthly per state
             covid_df_monthly_state = covid_df.groupby(['month_year', 'Province_State']).agg({
@@ -338,27 +285,31 @@ def apply_transformations(folder, files):
             # dst_file = f"{folder}/covid_monthly_state.csv"
             # save_csv(covid_df_monthly_state, dst_file)
             dst_file = f"{folder}/covid_monthly.csv"
-            save_csv(covid_df_monthly, dst_file)
+            with metrics.stage('write', folder=folder) as stage:
+                s3io.save_frame(stage.frame(covid_df_monthly), BUCKET, dst_file, file_format=OUTPUT_FORMAT)
 
     except Exception as err:
         logger.error(f"Error while transformation: {err}")
         raise Exception(f"While transformation: {err}")
 
 
-if __name__ == "__main__":
+def main():
+    "Process the new or changed raw folders and publish the outputs"
     logger.info("-- start --")
-    folders = get_folder_list()
+    with metrics.stage('list'):
+        folders = get_folder_list()
     if folders:
-        for folder, files in folders.items():
-            apply_transformations(folder, files)
+        results, failures = parallel.run_folders(apply_transformations, folders, WORKERS)
+        done = {folder: files for folder, files in folders.items() if folder not in failures}
+        manifest.mark_processed(BUCKET, SRC_DIR, done)
 
-        # trigger crawlers
-        try:
-            logger.info("Triggering Crawlers")
-            glue_client = boto3.client('glue')
-            glue_client.start_crawler(Name=CRAWLER1)
-            glue_client.start_crawler(Name=CRAWLER2)
-        except Exception as err:
-            logger.error(f"Exception while triggering crawler {err}")
+        # register the new partitions, a crawl is only scheduled for a new table or a schema change
+        with metrics.stage('publish'):
+            catalog.publish(BUCKET, [CRAWLER1, CRAWLER2], s3io.pop_outputs())
     else:
         logger.info("No new dir to process")
+
+
+if __name__ == "__main__":
+    startup.log_import_time()
+    main()
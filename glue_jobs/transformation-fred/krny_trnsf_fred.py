@@ -14,6 +14,8 @@ with Job Parameters as:
     --mapper: <dynamodb table name of fred>
     --crawler_cleaneddata: <crawler name for cleaned data>
     --crawler_transformeddata: <crawler name for tarnsformed data>
+    --output_format: <csv or parquet, optional>
+    --workers: <number of folders processed in parallel, optional>
 
 """
 
@@ -26,17 +28,14 @@ __date__ = "March 2023"
 
 # builtin imports 
 import logging
-import os
-from io import StringIO
-import io
 import sys
-from functools import reduce
+from functools import partial
 
 # Lib
 import pandas as pd
-import numpy as np
-from sklearn.preprocessing import normalize
-import boto3
+
+# Shared helpers
+from krny_common import s3io, manifest, parallel, mapper, catalog, metrics, startup, CLEANED_DIR
 
 # Platform specific imports
 from awsglue.utils import getResolvedOptions
@@ -51,16 +50,20 @@ args = getResolvedOptions(sys.argv, [
 # Source data
 BUCKET = args['bucket']
 FOLDER = args['folder']
+SRC_DIR = FOLDER
 MAPPER_TABLE = args['mapper']
 
 # get crawler name
 CRAWLER1 = args.get('crawler_cleaneddata')
 CRAWLER2 = args.get('crawler_transformeddata')
 
-# Data layers in the S3 bucket
-RAW_DIR = 'raw-data'
-CLEANED_DIR = 'cleaned-data'
-TRANSFORMED_DIR = 'transformed-data'
+# output format of cleaned and transformed data: csv (default) or parquet
+OUTPUT_FORMAT = getResolvedOptions(sys.argv, ['output_format'])['output_format'] \
+    if '--output_format' in sys.argv else 'csv'
+
+# number of folders processed in parallel (forked processes), 1 runs them one by one
+WORKERS = int(getResolvedOptions(sys.argv, ['workers'])['workers']) \
+    if '--workers' in sys.argv else 1
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -71,137 +74,92 @@ formatter = logging.Formatter(
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
-s3_resource = boto3.resource('s3')
-bucket = s3_resource.Bucket(BUCKET)
-
-client = boto3.client('s3')
-
 def get_mapper():
     "It retrives Series_ID and Series_Name from dynamodb table for mapping column name"
     try:
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(MAPPER_TABLE)
-        response = table.scan()
-        data = response['Items']
-
-        return {item['Series_ID']: item['Series_Name'] for item in data}
+        # paginated scan, read from its S3 snapshot when there is one (refreshed after the run)
+        return mapper.load_mapper(MAPPER_TABLE, 'Series_ID', 'Series_Name', BUCKET)
     except Exception as err:
         logger.error(f"Error while reading mapper: {err}")
         sys.exit(0)
 
-def read_csv(file_path, **kwargs):
-    "Read csv data file and return pd dataframe"
-    logger.info(f"Reading file: {file_path}")
-    try:
-        response = client.get_object(Bucket=BUCKET, Key=file_path)
-        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
-        if status == 200:
-            print(f"Successful S3 get_object response. Status - {status}")
-            return pd.read_csv(response.get("Body"))
-    except Exception as err:
-        logger.error(f"Error while reading: {err}")
-
-
-def save_csv(df, file_path):
-    "Save the DataFrame as CSV in transformed directory"
-    try:
-        dst_path = file_path.replace(RAW_DIR, TRANSFORMED_DIR)
-        logger.info(f"Saving file {dst_path}")
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3_resource.Object(BUCKET, dst_path).put(Body=csv_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
-
-def save_csv_cleaned(df, file_path):
-    "Save the DataFrame as CSV in cleaned data dir"
-    try:
-        dst_path = file_path.replace(RAW_DIR, CLEANED_DIR)
-        logger.info(f"Saving file {dst_path}")
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3_resource.Object(BUCKET, dst_path).put(Body=csv_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
-
 
 def get_folder_list():
     """
-    This function returns the list for folders from raw-data which do not exists in transform-data.
-    ie. only incremented / newly added directory will be returned
+    This function returns the dict of folders (with their files) from raw-data which are
+    new or changed since the last processed run, as per the processed-partition manifest.
+    ie. only incremented / newly added / updated directory will be returned
     """
-    src_dict = {}
-    dst_dict = {}
-    SRC_DIR = FOLDER
-    DST_DIR = SRC_DIR.replace(RAW_DIR, TRANSFORMED_DIR)
-
     try:
-        for objects in bucket.objects.filter(Prefix=SRC_DIR):
-            path_str = objects.key
-            if path_str.endswith(".csv"):
-                dirname = os.path.dirname(path_str)
-                try:
-                    src_dict[dirname].append(path_str)
-                except:
-                    src_dict[dirname] = [path_str,]
+        return manifest.get_changed_folders(BUCKET, SRC_DIR)
     except Exception as error:
         logger.error(f"Error: {error}")
-
-    try:
-        for objects in bucket.objects.filter(Prefix=DST_DIR):
-            path_str = objects.key
-            if path_str.endswith(".csv"):
-                dirname = os.path.dirname(path_str)
-                try:
-                    dst_dict[dirname].append(path_str)
-                except:
-                    dst_dict[dirname] = [path_str,]
-    except Exception as error:
-        logger.error(f"Error: {error}")
-
-    dst_dict = {k.replace(TRANSFORMED_DIR, RAW_DIR): v for (k, v) in dst_dict.items()}
-    return {k: src_dict[k] for k in set(src_dict) - set(dst_dict)}
+        return {}
 
 
 def apply_transformations(folder, files, mapper_dict):
     """
-    It creates list of df from list of files
-    merged it and apply transformations 
+    It creates list of df from list of files (read concurrently)
+    merged it on DATE in one outer concat and apply transformations 
     """
     try:
-        logger.debug('files--', files)
-        dfs = [read_csv(file) for file in files]
-        df_merged = reduce(lambda left, right: pd.merge(
-            left, right, on=['DATE'], how='outer'), dfs)
+        logger.debug(f"files--{files}")
+        dfs = []
+        with metrics.stage('read', folder=folder) as stage:
+            frames = s3io.read_csv_many(BUCKET, files)
+            for df in frames:
+                stage.frame(df)
+        for file, df in zip(files, frames):
+            df = df.set_index('DATE')
+            if df.index.has_duplicates:
+                logger.warning(f"Duplicate DATE rows in {file}, keeping the first one")
+                df = df[~df.index.duplicated(keep='first')]
+            dfs.append(df)
+        with metrics.stage('merge', folder=folder) as stage:
+            df_merged = stage.frame(
+                pd.concat(dfs, axis=1, join='outer', sort=True).rename_axis('DATE').reset_index())
 
         # save cleaned data
         file_path = f"{folder}/fred.csv"
-        save_csv_cleaned(df_merged, file_path)
+        with metrics.stage('write_cleaned', folder=folder) as stage:
+            s3io.save_frame(stage.frame(df_merged), BUCKET, file_path, CLEANED_DIR, OUTPUT_FORMAT)
         return df_merged.rename(columns=mapper_dict)
     except Exception as err:
         logger.error(f"Error while transformation: {err}")
         raise Exception(f"while transformation: {err}")
 
 
-if __name__ == "__main__":
+def process_folder(folder, files, mapper_dict):
+    "It transforms the files of one raw folder and saves the merged fred file"
+    transformed_df = apply_transformations(folder, files, mapper_dict)
+    if not transformed_df.empty:
+        with metrics.stage('write', folder=folder) as stage:
+            s3io.save_frame(stage.frame(transformed_df), BUCKET, f"{folder}/fred.csv",
+                            file_format=OUTPUT_FORMAT)
+
+
+def main():
+    "Process the new or changed raw folders and publish the outputs"
     logger.info("-- start --")
-    folders = get_folder_list()
+    with metrics.stage('list'):
+        folders = get_folder_list()
     mapper_dict = get_mapper()
     logger.debug(mapper_dict)
     logger.debug(folders)
     if folders and mapper_dict:
-        for folder, files in folders.items():
-            transformed_df = apply_transformations(folder, files, mapper_dict)
-            if not transformed_df.empty:
-                save_csv(transformed_df, f"{folder}/fred.csv")
-
-        # trigger crawlers
-        try:
-            logger.info("Triggering crawlers")
-            glue_client = boto3.client('glue')
-            glue_client.start_crawler(Name=CRAWLER1)
-            glue_client.start_crawler(Name=CRAWLER2)
-        except Exception as err:
-            logger.error(f"Exception while triggering crawler {err}")
+        results, failures = parallel.run_folders(partial(process_folder, mapper_dict=mapper_dict), folders, WORKERS)
+        done = {folder: files for folder, files in folders.items() if folder not in failures}
+        manifest.mark_processed(BUCKET, SRC_DIR, done)
+
+        # register the new partitions, a crawl is only scheduled for a new table or a schema change
+        with metrics.stage('publish'):
+            catalog.publish(BUCKET, [CRAWLER1, CRAWLER2], s3io.pop_outputs())
     else:
         logger.info("No new dir to process")
+    # scan the mapper table again when its snapshot was old, for the next run
+    mapper.refresh_stale()
+
+
+if __name__ == "__main__":
+    startup.log_import_time()
+    main()
@@ -13,6 +13,10 @@ Usage: This script meant for AWS Glue Job -ETL
 with Job Parameters : 
     --bucket: <bucketname>
     --folder: <folder path of ihs rawdata>
+    --output_format: <csv or parquet, optional>
+    --workers: <number of folders processed in parallel, optional>
+    --variance_percentile: <keep the top % mnemonics by normalised variance, optional>
+    --variance_top_k: <keep the top k mnemonics by normalised variance, optional>
 
 """
 
@@ -26,17 +30,15 @@ __date__ = "March 2023"
 # builtin imports 
 import logging
 import os
-from io import StringIO
 import sys
-import dateutil.relativedelta
-from datetime import timedelta
-import datetime
 
 # Lib
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import normalize
-import boto3
+
+# Shared helpers
+from krny_common import s3io, manifest, parallel, dates, screening, catalog, metrics, startup, CLEANED_DIR, TRANSFORMED_DIR
+from krny_common.registry import CsvRegistry
 
 # Platform specific imports
 from awsglue.utils import getResolvedOptions
@@ -50,15 +52,25 @@ args = getResolvedOptions(sys.argv, [
 # source data
 BUCKET = args.get('bucket')
 FOLDER = args.get('folder')
+SRC_DIR = FOLDER + '/data'
 
 # get crawler name
 CRAWLER1 = args.get('crawler_cleaneddata')
 CRAWLER2 = args.get('crawler_transformeddata')
 
-# Data layers in the S3 bucket
-RAW_DIR = 'raw-data'
-CLEANED_DIR = 'cleaned-data'
-TRANSFORMED_DIR = 'transformed-data'
+# output format of cleaned and transformed data: csv (default) or parquet
+OUTPUT_FORMAT = getResolvedOptions(sys.argv, ['output_format'])['output_format'] \
+    if '--output_format' in sys.argv else 'csv'
+
+# number of folders processed in parallel (forked processes), 1 runs them one by one
+WORKERS = int(getResolvedOptions(sys.argv, ['workers'])['workers']) \
+    if '--workers' in sys.argv else 1
+
+# variance screening of the mnemonics (see krny_common.screening), all of them are kept by default
+VARIANCE_PERCENTILE = float(getResolvedOptions(sys.argv, ['variance_percentile'])['variance_percentile']) \
+    if '--variance_percentile' in sys.argv else None
+VARIANCE_TOP_K = int(getResolvedOptions(sys.argv, ['variance_top_k'])['variance_top_k']) \
+    if '--variance_top_k' in sys.argv else None
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -69,156 +81,82 @@ formatter = logging.Formatter(
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
-s3_resource = boto3.resource('s3')
-bucket = s3_resource.Bucket(BUCKET)
-
-client = boto3.client('s3')
-# paginator = client.get_paginator('list_objects_v2')
-# result = paginator.paginate(Bucket=BUCKET,Prefix=FOLDER)
-
 # code specific file path
 MNEMONIC_FILE = f"{TRANSFORMED_DIR}/mnemonics/ihs_mnemonics/ihs_mnemonics.csv"
 
-def read_csv(file_path, **kwargs):
-    "Read data file and return pd dataframe"
-    logger.info(f"Reading file: {file_path}")
-    try:
-        response = client.get_object(Bucket=BUCKET, Key=file_path)
-        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
-        if status == 200:
-            logger.debug(
-                f"Successful S3 get_object response. Status - {status}")
-            return pd.read_csv(response.get("Body"))
-    except Exception as err:
-        logger.error(f"Error while reading: {err}")
-
-
-def save_csv(df, file_path):
-    "Save the DataFrame as CSV in transformed directory"
-    try:
-        dst_path = file_path.replace(RAW_DIR, TRANSFORMED_DIR)
-        logger.info(f"Saving file {dst_path}")
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3_resource.Object(BUCKET, dst_path).put(Body=csv_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
-
-def save_csv_cleaned(df, file_path):
-    "Save the DataFrame as CSV in cleaned data dir"
-    try:
-        dst_path = file_path.replace(RAW_DIR, CLEANED_DIR)
-        logger.info(f"Saving file {dst_path}")
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3_resource.Object(BUCKET, dst_path).put(Body=csv_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
 
 def get_folder_dict():
     """
-    This function returns the list for folders from raw-data which do not exists in transform-data.
-    ie. only incremented / newly added directory will be returned
+    This function returns the dict of folders (with their files) from raw-data which are
+    new or changed since the last processed run, as per the processed-partition manifest.
+    ie. only incremented / newly added / updated directory will be returned
     """
-    src_dict = {}
-    dst_dict = {}
-    SRC_DIR = FOLDER + '/data'
-    DST_DIR = SRC_DIR.replace(RAW_DIR, TRANSFORMED_DIR)
-
-    try:
-        for objects in bucket.objects.filter(Prefix=SRC_DIR):
-            path_str = objects.key
-            if path_str.endswith(".csv"):
-                dirname = os.path.dirname(path_str)
-                try:
-                    src_dict[dirname].append(path_str)
-                except:
-                    src_dict[dirname] = [path_str,]
-    except Exception as error:
-        print(f"Error: {error}")
-
     try:
-        for objects in bucket.objects.filter(Prefix=DST_DIR):
-            path_str = objects.key
-            if path_str.endswith(".csv"):
-                dirname = os.path.dirname(path_str)
-                try:
-                    dst_dict[dirname].append(path_str)
-                except:
-                    dst_dict[dirname] = [path_str,]
+        return manifest.get_changed_folders(BUCKET, SRC_DIR)
     except Exception as error:
-        print(f"Error: {error}")
+        logger.error(f"Error: {error}")
+        return {}
 
-    dst_dict = {k.replace(TRANSFORMED_DIR, RAW_DIR): v for (k, v) in dst_dict.items()}
-    return {k: src_dict[k] for k in set(src_dict) - set(dst_dict)}
-
-def read_ihs_mnemonic_file():
-    "It read ihs nmemonic file and return dict, if not exists return new empty dict"
-    
+def update_ihs_mnemonic_file(mnemonic_dfs):
+    """
+    It gathers the mnemonic and desc of every processed file (in order)
+    and add or update them in the mnemonic file with one conditional write,
+    it returns False when the file could not be saved
+    """
+    registry = CsvRegistry(BUCKET, MNEMONIC_FILE, 'mnemonic', 'description')
+    for mnemonic_df in mnemonic_dfs:
+        mnemonic_df = mnemonic_df.set_index('New Mnemonic')
+        registry.update(mnemonic_df.to_dict()['Short Label'])
     try:
-        logger.info(f"Reading {MNEMONIC_FILE}")
-        df = read_csv(f"{MNEMONIC_FILE}")
-        mnemonic_df = df[['mnemonic','description']]
-        mnemonic_df = mnemonic_df.set_index('mnemonic')
-        return mnemonic_df.to_dict()['description']
+        return registry.commit()
     except Exception as err:
-        logger.error(f"while read_ihs_mnemonic_file {err} ")
-        
-    return {}
+        logger.error(f"while update_ihs_mnemonic_file {err} ")
+        return False
+
+def read_ihs_file(file_path):
+    """
+    It streams the wide ihs file in row batches (one row per mnemonic)
+    and returns (mnemonic_df, df) with df already transposed:
+    one row per date column of the file and one column per mnemonic.
+    Only numeric batches are transposed, so the whole file is never
+    turned into one object dtype frame.
+    """
+    columns = ['New Mnemonic','Short Label']
+    mnemonic_parts = []
+    parts = []
+    for chunk in s3io.iter_csv_chunks(BUCKET, file_path):
+        mnemonic_parts.append(chunk.reindex(columns=columns))
+        chunk = chunk.drop(['Short Label','Mnemonic'], axis=1, errors='ignore')
+        parts.append(chunk.set_index('New Mnemonic').transpose())
+    return pd.concat(mnemonic_parts, ignore_index=True), pd.concat(parts, axis=1)
 
 def apply_transformations(df, file_path):
-    "It applied all the transformation rules on df passed to it"
+    "It applied all the transformation rules on df (see read_ihs_file) passed to it"
     # get data
     # Drop Columns
     # Set index and sort
     # Remove duplicate columns
     # remove null value columns
-    # normalize data
-    # Divide Variance into 100 categories 
+    # screen columns on normalised variance
     # save data
 
-    
-    # read existing mnemonic file, 
-    # add or update new mnemonic and desc to it
-    # and save to same mnemonic file
-    mnemonic_df_dict = read_ihs_mnemonic_file()
-    columns = ['New Mnemonic','Short Label']
-    mnemonic_df = df.reindex(columns=columns)
-    # mnemonic_df = df[['New Mnemonic','Short Label']]
-    mnemonic_df = mnemonic_df.set_index('New Mnemonic')
-    mnemonic_df_dict = {**mnemonic_df_dict, **mnemonic_df.to_dict()['Short Label']}
-    mnemonic_df = pd.DataFrame.from_dict(mnemonic_df_dict,orient='index').reset_index()
-    mnemonic_df = mnemonic_df.rename(columns={'index':'mnemonic',0:'description'})
-    save_csv(mnemonic_df,f"{MNEMONIC_FILE}")
-
     # maxmonth = MAX_MONTH  # datetime.date(2021, 9, 1)
     try:
-        df = df.drop(['Short Label','Mnemonic'], axis=1)
-    except:
-        df = df
-
-    try:
-        df = df.dropna(axis=1,how='all')
+        # drop the date columns of the file without any value
+        df = df.dropna(axis=0,how='all')
 
-        df = df.transpose()
-        df = df.rename(columns={'New Mnemonic': 'Date'})
-        df.columns = df.iloc[0]
-        df = df.iloc[1:,]
         df = df.reset_index().rename(columns={'index': 'Date'})
         df = df.rename(columns={'Month_Starting_Date': 'Date'})
 
         # Drop columns with duplicate names
-        orignum = df.shape[1]
         data = df.loc[:, ~df.columns.duplicated(keep='first')]
         data.isin([np.inf, -np.inf]
                   ).sum()[data.isin([np.inf, -np.inf]).sum() != 0]
 
-        # Take only rows up to maxmonth
-        orignum = data.shape[1]
-        data['Date'] = pd.to_datetime(data['Date']).apply(lambda x: x.date())
+        data['Date'] = dates.to_date(data['Date'])
 
         # save cleaned data
-        save_csv_cleaned(data, file_path)
+        s3io.save_frame(data, BUCKET, file_path, CLEANED_DIR, OUTPUT_FORMAT)
 
         maxmonth = data['Date'].max()
         logger.info(f"maxmonth:{maxmonth}")
@@ -234,23 +172,12 @@ def apply_transformations(df, file_path):
             logger.info(f"dataset_name:{dataset_name}")
             return data
         
-        data_norm = data.drop(['Date'], axis=1)
-        
-        normalize1 = normalize(data_norm)
-
-        data_scaled = pd.DataFrame(normalize1)
-        variance = data_scaled.var()
-        var_df = pd.DataFrame({'columns': data_norm.columns.to_list(),
-                              'variance': variance})
-        var_df['percentile'] = pd.qcut(var_df['variance'].rank(method='first', ascending=False),
-                                       100,
-                                       labels=False)
-
-        # var_df_fin = var_df.loc[var_df.percentile <= 14]
-        var_df_fin = var_df
-        var_df_fin.reset_index(drop=True, inplace=True)
-        var_df_fin = var_df_fin.iloc[2:]
-        final_col = var_df_fin['columns'].to_list()
+        # rank the mnemonics by variance of the row normalised values
+        final_col = screening.screen_columns(data.drop(['Date'], axis=1),
+                                             top_k=VARIANCE_TOP_K,
+                                             percentile=VARIANCE_PERCENTILE)
+        # the first two mnemonics are never kept
+        final_col = final_col[2:]
         data = data[['Date']+final_col]
         return data
 
@@ -261,27 +188,51 @@ def apply_transformations(df, file_path):
         logger.debug(f"{exc_type}, {fname}, {exc_tb.tb_lineno}")
         logger.debug(f"{exc_type}, {exc_obj}, {exc_tb}")
 
-if __name__ == "__main__":
-
+def process_folder(folder, files):
+    "It transforms and saves every file of one raw folder, returns the mnemonic_df of each file"
+    mnemonic_dfs = []
+    for file_path in files:
+        # streamed and transposed batch by batch
+        with metrics.stage('read_transpose', file=file_path) as stage:
+            mnemonic_df, df = read_ihs_file(file_path)
+            stage.frame(df)
+        mnemonic_dfs.append(mnemonic_df)
+
+        with metrics.stage('transform', file=file_path) as stage:
+            transformed_df = stage.frame(apply_transformations(df, file_path))
+        if not transformed_df.empty:
+            with metrics.stage('write', file=file_path) as stage:
+                s3io.save_frame(stage.frame(transformed_df), BUCKET, file_path, file_format=OUTPUT_FORMAT)
+    return mnemonic_dfs
+
+
+def main():
+    "Process the new or changed raw folders and publish the outputs"
     logger.info("--Start Transformation--")
-    folders = get_folder_dict()
+    with metrics.stage('list'):
+        folders = get_folder_dict()
     if folders:
         logger.info(f"folders--{folders}")
-        for folder, files in folders.items():
-            for file_path in files:
-                df = read_csv(file_path)
-
-                transformed_df = apply_transformations(df, file_path)
-                if not transformed_df.empty:
-                    save_csv(transformed_df, file_path)
-
-        # trigger crawlers
-        try:
-            glue_client = boto3.client('glue')
-            glue_client.start_crawler(Name=CRAWLER1)
-            glue_client.start_crawler(Name=CRAWLER2)
-        except Exception as err:
-            logger.error(f"Exception while triggering crawler {err}")
+        results, failures = parallel.run_folders(process_folder, folders, WORKERS)
+
+        # the mnemonic file is updated once by this process, not by every worker
+        saved = update_ihs_mnemonic_file([mnemonic_df for folder in sorted(results)
+                                          for mnemonic_df in results[folder]])
+        done = {folder: files for folder, files in folders.items() if folder not in failures}
+        if not saved:
+            # their mnemonics are only read again if the folders are processed again
+            logger.error("Mnemonic file not saved, the folders are left for the next run")
+            done = {}
+        manifest.mark_processed(BUCKET, SRC_DIR, done)
+
+        # register the new partitions, a crawl is only scheduled for a new table or a schema change
+        with metrics.stage('publish'):
+            catalog.publish(BUCKET, [CRAWLER1, CRAWLER2], s3io.pop_outputs())
     else:
         logger.info("No new dir to process")
+
+
+if __name__ == "__main__":
+    startup.log_import_time()
+    main()
 # transformed_df
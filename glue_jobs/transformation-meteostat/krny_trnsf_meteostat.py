@@ -13,6 +13,8 @@ with Job Parameters as:
     --folder: <folder path of meteostat rawdata>
     --mapped_file: <external file path>
     --region_file: <external file path>
+    --output_format: <csv or parquet, optional>
+    --workers: <number of folders processed in parallel, optional>
 
 """
 
@@ -26,13 +28,13 @@ __date__ = "March 2023"
 # builtin imports 
 import logging
 import os
-from io import StringIO
 import sys
 
 # Lib
 import pandas as pd
-import boto3
-from sklearn.preprocessing import normalize
+
+# Shared helpers
+from krny_common import s3io, manifest, parallel, refdata, catalog, metrics, startup, RAW_DIR, CLEANED_DIR, TRANSFORMED_DIR
 
 # Platform specific imports
 from awsglue.utils import getResolvedOptions
@@ -50,6 +52,7 @@ args = getResolvedOptions(sys.argv, [
 # source data
 BUCKET = args.get('bucket')
 FOLDER = args.get('folder')
+SRC_DIR = FOLDER + '/data'
 
 # additonal files
 MAPPED_WEATHER_STATIONS = args.get('mapped_file')
@@ -59,10 +62,13 @@ US_STATE_REGION = args.get('region_file')
 CRAWLER1 = args.get('crawler_cleaneddata')
 CRAWLER2 = args.get('crawler_transformeddata')
 
-# Data layers in the S3 bucket
-RAW_DIR = 'raw-data'
-CLEANED_DIR = 'cleaned-data'
-TRANSFORMED_DIR = 'transformed-data'
+# output format of cleaned and transformed data: csv (default) or parquet
+OUTPUT_FORMAT = getResolvedOptions(sys.argv, ['output_format'])['output_format'] \
+    if '--output_format' in sys.argv else 'csv'
+
+# number of folders processed in parallel (forked processes), 1 runs them one by one
+WORKERS = int(getResolvedOptions(sys.argv, ['workers'])['workers']) \
+    if '--workers' in sys.argv else 1
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -73,38 +79,6 @@ formatter = logging.Formatter(
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
-s3_resource = boto3.resource('s3')
-bucket = s3_resource.Bucket(BUCKET)
-
-client = boto3.client('s3')
-# paginator = client.get_paginator('list_objects_v2')
-# result = paginator.paginate(Bucket=BUCKET,Prefix=FOLDER)
-
-
-def read_csv(file_path, **kwargs):
-    "Read data file and return pd dataframe"
-    logger.info(f"Reading file: {file_path}")
-    try:
-        response = client.get_object(Bucket=BUCKET, Key=file_path)
-        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
-        if status == 200:
-            print(f"Successful S3 get_object response. Status - {status}")
-            return pd.read_csv(response.get("Body"))
-    except Exception as err:
-        logger.error(f"Error while reading: {err}")
-
-
-def save_csv(df, file_path):
-    "Save the DataFrame as CSV in transformed directory"
-    try:
-        dst_path = file_path.replace(RAW_DIR, TRANSFORMED_DIR)
-        logger.info(f"Saving file {dst_path}")
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer)
-        s3_resource.Object(BUCKET, dst_path).put(Body=csv_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
-
 
 def save_excel(df, file_path):
     "Save the DataFrame as XLSX file in transformed directory"
@@ -117,53 +91,43 @@ def save_excel(df, file_path):
     except Exception as err:
         logger.error(f"Error while saving: {err}")
 
-def save_csv_cleaned(df, file_path):
-    "Save the DataFrame as CSV in cleaned data dir"
-    try:
-        dst_path = file_path.replace(RAW_DIR, CLEANED_DIR)
-        logger.info(f"Saving file {dst_path}")
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3_resource.Object(BUCKET, dst_path).put(Body=csv_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
 
 def get_folder_list():
     """
-    This function returns the list for folders from raw-data which do not exists in transform-data.
-    ie. only incremented / newly added directory will be returned
+    This function returns the dict of folders (with their files) from raw-data which are
+    new or changed since the last processed run, as per the processed-partition manifest.
+    ie. only incremented / newly added / updated directory will be returned
     """
-    src_dict = {}
-    dst_dict = {}
-    SRC_DIR = FOLDER + '/data'
-    DST_DIR = SRC_DIR.replace(RAW_DIR, TRANSFORMED_DIR)
-
-    try:
-        for objects in bucket.objects.filter(Prefix=SRC_DIR):
-            path_str = objects.key
-            if path_str.endswith(".csv"):
-                dirname = os.path.dirname(path_str)
-                try:
-                    src_dict[dirname].append(path_str)
-                except:
-                    src_dict[dirname] = [path_str,]
-    except Exception as error:
-        logger.error(f"Error: {error}")
-
     try:
-        for objects in bucket.objects.filter(Prefix=DST_DIR):
-            path_str = objects.key
-            if path_str.endswith(".csv"):
-                dirname = os.path.dirname(path_str)
-                try:
-                    dst_dict[dirname].append(path_str)
-                except:
-                    dst_dict[dirname] = [path_str,]
+        return manifest.get_changed_folders(BUCKET, SRC_DIR)
     except Exception as error:
         logger.error(f"Error: {error}")
-
-    dst_dict = {k.replace(TRANSFORMED_DIR, RAW_DIR): v for (k, v) in dst_dict.items()}
-    return {k: src_dict[k] for k in set(src_dict) - set(dst_dict)}
+        return {}
+
+
+def build_station_region_map(finalweatherst_df, df_region_state):
+    "It returns the stationID -> Region, State map from the mapper and region files"
+    # (xebia)- added the 'state' column as it is required in next step i.e. cleaning
+    station_region_map = pd.merge(
+        finalweatherst_df.loc[:, ["StationID", "region"]],
+        df_region_state.loc[:, ["State Code", "Region", "State"]],
+        how="left",
+        left_on=["region"],
+        right_on=["State Code"]
+    )
+    station_region_map.drop(["region", "State Code"], axis=1, inplace=True)
+    station_region_map.rename(
+        columns={"StationID": "stationID"}, inplace=True)
+    station_region_map = station_region_map.drop_duplicates().reset_index(drop=True)
+    # join on the str stationID of the data
+    station_region_map['stationID'] = station_region_map['stationID'].astype(str)
+    return station_region_map
+
+
+def get_station_region_map():
+    "Station -> region map, built once per process and rebuilt when a source file changes"
+    return refdata.derived('station_region_map', build_station_region_map,
+                           BUCKET, [MAPPED_WEATHER_STATIONS, US_STATE_REGION])
 
 
 def apply_transformations(df, file_path):
@@ -174,34 +138,21 @@ def apply_transformations(df, file_path):
     try:
         data = df
         ################################################
-        finalweatherst_df = read_csv(MAPPED_WEATHER_STATIONS)
-        df_region_state = read_csv(US_STATE_REGION)
+        station_region_map = get_station_region_map()
 
         # (xebia) -snow , wdir,wpgt these keys are removed as they are no longer available in above table and giving key error.
         finalweatherdata_df_pivot = data.pivot_table(
             values=['tavg', 'tmin', 'tmax', 'prcp', 'wspd', 'pres', 'tsun'], index=['stationID'], columns=['time'])
 
-        finalweatherdata_df_pivot.reset_index()
-        # finalweatherdata_df_pivot1=finalweatherdata_df_pivot.reset_index(level=0, inplace=True)
-        finalweatherdata_df_pivot2 = finalweatherdata_df_pivot.T
-        finalweatherdata_df_pivot2.to_csv(
-            r'Meteostat_temp.csv', index=True, header=True)
-        # finalweatherdata_df_pivot2
-
-        # (xebia)- added the 'state' column as it is required in next step i.e. cleaning
-        station_region_map = pd.merge(
-            finalweatherst_df.loc[:, ["StationID", "region"]],
-            df_region_state.loc[:, ["State Code", "Region", "State"]],
-            how="left",
-            left_on=["region"],
-            right_on=["State Code"]
-        )
-        station_region_map.drop(["region", "State Code"], axis=1, inplace=True)
-        station_region_map.rename(
-            columns={"StationID": "stationID"}, inplace=True)
-        station_region_map = station_region_map.drop_duplicates().reset_index(drop=True)
-        # station_region_map
-        
+        # Avg/Min/Max over the stations, one row per (indicator, time), kept in memory
+        stations_df = finalweatherdata_df_pivot.T
+        df_meteo = pd.DataFrame({
+            'Avg': stations_df.mean(axis=1),
+            'Min': stations_df.min(axis=1),
+            'Max': stations_df.max(axis=1),
+        })
+        df_meteo.index.names = ['indicator', 'time']
+
         # convert stationID to str
         data['stationID']=data['stationID'].astype(str)
         data = pd.merge(
@@ -210,30 +161,10 @@ def apply_transformations(df, file_path):
         )
 
         # save cleaned data
-        save_csv_cleaned(data,file_path)
-
-        data1 = data.groupby(['Region', 'time']).aggregate(
-            ['mean', 'min', 'max'])
+        s3io.save_frame(data, BUCKET, file_path, CLEANED_DIR, OUTPUT_FORMAT)
 
-        data1 = data1.swaplevel(axis=1)
-        data1 = data1.reindex(sorted(data1.columns),
-                              axis=1).loc[:, ["mean", "min", "max"]]
-
-        df_meteo = pd.read_csv("Meteostat_temp.csv")
-        # (xebia)- Renamed the column unnamed:0 to indicator as it required in below code.
-        df_meteo.rename(columns={'Unnamed: 0': 'indicator'}, inplace=True)
-
-        column_list = list(df_meteo)
-        column_list.remove("indicator")
-        column_list.remove("time")
-
-        df_meteo["Avg"] = df_meteo[column_list].mean(axis=1)
-        df_meteo["Min"] = df_meteo[column_list].min(axis=1)
-        df_meteo["Max"] = df_meteo[column_list].max(axis=1)
-        df_meteo[['indicator', 'time', 'Avg', 'Min', 'Max']]
-
-        df_meteo = df_meteo.pivot(
-            index='time', columns='indicator', values=['Avg', 'Min', 'Max'])
+        # one row per time, one column per statistic and indicator: Avg_tavg ...
+        df_meteo = df_meteo.unstack('indicator')
         df_meteo.columns = ["_".join((i, j)) for i, j in df_meteo.columns]
         df_meteo.index.names = ['Date']
         return df_meteo
@@ -244,25 +175,33 @@ def apply_transformations(df, file_path):
         sys.exit(0)
 
 
-if __name__ == "__main__":
+def process_folder(folder, files):
+    "It transforms and saves every file of one raw folder"
+    for file_path, df in metrics.iter_stage('read', s3io.iter_csv(BUCKET, files)):
+        with metrics.stage('transform', file=file_path) as stage:
+            transformed_df = stage.frame(apply_transformations(df, file_path))
+        with metrics.stage('write', file=file_path) as stage:
+            s3io.save_frame(stage.frame(transformed_df), BUCKET, file_path, file_format=OUTPUT_FORMAT, index=True)
+        # save_excel(transformed_df,file_path)
 
+
+def main():
+    "Process the new or changed raw folders and publish the outputs"
     logger.info("-- start --")
-    folders = get_folder_list()
+    with metrics.stage('list'):
+        folders = get_folder_list()
     if folders:
-        for folder, files in folders.items():
-            for file_path in files:
-                df = read_csv(file_path)
-                transformed_df = apply_transformations(df, file_path)
-                save_csv(transformed_df, file_path)
-                # save_excel(transformed_df,file_path)
-        # trigger crawlers
-        try:
-            logger.info("Triggering Crawlers")
-            glue_client = boto3.client('glue')
-            glue_client.start_crawler(Name=CRAWLER1)
-            glue_client.start_crawler(Name=CRAWLER2)
-        except Exception as err:
-            logger.error(f"Exception while triggering crawler {err}")    
+        results, failures = parallel.run_folders(process_folder, folders, WORKERS)
+        done = {folder: files for folder, files in folders.items() if folder not in failures}
+        manifest.mark_processed(BUCKET, SRC_DIR, done)
+        # register the new partitions, a crawl is only scheduled for a new table or a schema change
+        with metrics.stage('publish'):
+            catalog.publish(BUCKET, [CRAWLER1, CRAWLER2], s3io.pop_outputs())
 
     else:
         logger.info("No new dir to process")
+
+
+if __name__ == "__main__":
+    startup.log_import_time()
+    main()
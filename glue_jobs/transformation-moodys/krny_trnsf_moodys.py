@@ -5,12 +5,19 @@ Short Desc: This programe is a ETL Glue Job for kearney sensing solution
 This scripts reads the raw data from source path on S3 bucket
 and do the cleaning of files and save in cleaned data path
 and apply the transformations on it
+and save on transformed data path on S3
 
+All the Moody's sources given with --sources (eg. moodys_all, moodys_188)
+are handled by this one job, in one run: the new folders of every source are listed,
+then processed together, and the mnemonics file of each source is
+published from its config folder.
 
 Usage: This script meant for AWS Glue Job -ETL
 with Job Parameters as: 
     --bucket: <bucketname>
-    --folder: <folder path of moodys rawdata>
+    --sources: <json {source: {"folder": <raw data folder>, "config": <config folder with
+               the <source>_mnemonics.csv file>, "date_column": <name of the date column>}}>
+    --workers: <number of folders processed in parallel, optional>
 
 """
 
@@ -22,40 +29,37 @@ __email__ = "dchand01@atkearney.com"
 __date__ = "March 2023"
 
 # builtin imports 
+import json
 import logging
-import os
-from io import StringIO, BytesIO
 import sys
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
 
 # Lib
 import pandas as pd
-import boto3
+
+# Shared helpers
+from krny_common import s3io, manifest, parallel, dates, config_sync, catalog, metrics, startup, CLEANED_DIR, TRANSFORMED_DIR
 
 # Platform specific imports
 from awsglue.utils import getResolvedOptions
 args = getResolvedOptions(sys.argv, [
     'bucket', 
-    'folder',
-    'config',
+    'sources',
     'crawler_cleaneddata',
     'crawler_transformeddata'
 ])
 
-# Data layers in the S3 bucket
-RAW_DIR = 'raw-data'
-CLEANED_DIR = 'cleaned-data'
-TRANSFORMED_DIR = 'transformed-data'
-
 # source data
 BUCKET = args.get('bucket')
-FOLDER = args.get('folder')
-CONFIG = args.get('config')
 
 # get crawler name
 CRAWLER1 = args.get('crawler_cleaneddata')
 CRAWLER2 = args.get('crawler_transformeddata')
 
+# number of folders processed in parallel (forked processes), 1 runs them one by one
+WORKERS = int(getResolvedOptions(sys.argv, ['workers'])['workers']) \
+    if '--workers' in sys.argv else 1
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -65,170 +69,136 @@ formatter = logging.Formatter(
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
-s3_resource = boto3.resource('s3')
-bucket = s3_resource.Bucket(BUCKET)
-
-client = boto3.client('s3')
-# paginator = client.get_paginator('list_objects_v2')
-# result = paginator.paginate(Bucket=BUCKET,Prefix=FOLDER)
-
-
-def read_csv(file_path, **kwargs):
-    "Read data file and return pd dataframe"
-    logger.info(f"Reading file: {file_path}")
-    try:
-        response = client.get_object(Bucket=BUCKET, Key=file_path)
-        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
-        if status == 200:
-            print(f"Successful S3 get_object response. Status - {status}")
-            return pd.read_csv(response.get("Body"))
-    except Exception as err:
-        logger.error(f"Error while reading: {err}")
-
-
-def save_csv(df, file_path):
-    "Save the DataFrame as CSV in transformed directory"
-    try:
-        dst_path = file_path.replace(RAW_DIR, TRANSFORMED_DIR)
-        logger.info(f"Saving file {dst_path}")
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3_resource.Object(BUCKET, dst_path).put(Body=csv_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
-
-def save_csv_cleaned(df, file_path):
-    "Save the DataFrame as CSV in cleaned data dir"
-    try:
-        dst_path = file_path.replace(RAW_DIR, CLEANED_DIR)
-        logger.info(f"Saving file {dst_path}")
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3_resource.Object(BUCKET, dst_path).put(Body=csv_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
-
-def save_parquet(df, file_path):
-    "Save the DataFrame as PARQUET in cleaned-data directory"
-    try:
-        dst_path = file_path.replace(RAW_DIR, TRANSFORMED_DIR)
-        pq_buffer = BytesIO()
-        dst_path = os.path.splitext(dst_path)[0]+'.parquet'
-        logger.info(f"Saving file {dst_path}")
-        df.to_parquet(pq_buffer, index=False)
-        # s3_client.put_object(Bucket=BUCKET, Key=dst_path, Body=pq_buffer.getvalue())
-        s3_resource.Object(BUCKET, dst_path).put(Body=pq_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
-
-def save_parquet_cleaned(df, file_path):
-    "Save the DataFrame as PARQUET in cleaned-data directory"
-    try:
-        dst_path = file_path.replace(RAW_DIR, CLEANED_DIR)
-        pq_buffer = BytesIO()
-        dst_path = os.path.splitext(dst_path)[0]+'.parquet'
-        logger.info(f"Saving file {dst_path}")
-        df.to_parquet(pq_buffer, index=False)
-        # s3_client.put_object(Bucket=BUCKET, Key=dst_path, Body=pq_buffer.getvalue())
-        s3_resource.Object(BUCKET, dst_path).put(Body=pq_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
-
-def get_folder_list():
+# Moody's sources: raw data folder, config folder (with the <source>_mnemonics.csv file)
+# and name of the date column (quarters, months or days, see dates.parse_periods)
+try:
+    SOURCES = json.loads(args['sources'])
+    SOURCE_NAMES = list(SOURCES)
+    for name in SOURCE_NAMES:
+        missing = [field for field in ('folder', 'config', 'date_column') if field not in SOURCES[name]]
+        if missing:
+            raise Exception(f"source {name} has no {missing}")
+except Exception as err:
+    logger.error(f"Error while reading --sources: {err}")
+    raise Exception(f"Invalid --sources: {err}")
+
+
+def get_source_folders(name):
     """
-    This function returns the list for folders from raw-data which do not exists in transform-data.
-    ie. only incremented / newly added directory will be returned
+    This function returns the dict of folders (with their files) of one source which are
+    new or changed since the last processed run, as per the processed-partition manifest.
+    ie. only incremented / newly added / updated directory will be returned
     """
-    src_dict = {}
-    dst_dict = {}
-    SRC_DIR = FOLDER # + '/data'
-    DST_DIR = SRC_DIR.replace(RAW_DIR, TRANSFORMED_DIR)
-
+    source = SOURCES[name]
+    # a config folder inside the data folder holds the mnemonics, not data
+    exclude = [source['config']] if source['config'].startswith(source['folder'].rstrip('/') + '/') else []
     try:
-        for objects in bucket.objects.filter(Prefix=SRC_DIR):
-            path_str = objects.key
-            if path_str.endswith(".csv"):
-                dirname = os.path.dirname(path_str)
-                try:
-                    src_dict[dirname].append(path_str)
-                except:
-                    src_dict[dirname] = [path_str,]
+        return manifest.get_changed_folders(BUCKET, source['folder'], exclude=exclude)
     except Exception as error:
-        logger.error(f"Error: {error}")
+        logger.error(f"Error while listing {name}: {error}")
+        return {}
 
-    try:
-        for objects in bucket.objects.filter(Prefix=DST_DIR):
-            path_str = objects.key
-            if path_str.endswith(".parquet"):
-                dirname = os.path.dirname(path_str)
-                try:
-                    dst_dict[dirname].append(path_str)
-                except:
-                    dst_dict[dirname] = [path_str,]
-    except Exception as error:
-        logger.error(f"Error: {error}")
 
-    dst_dict = {k.replace(TRANSFORMED_DIR, RAW_DIR)
-                          : v for (k, v) in dst_dict.items()}
-    return {k: src_dict[k] for k in set(src_dict) - set(dst_dict)}
+def get_folder_list():
+    "It returns {source: {folder: files}} for every source, listed concurrently"
+    with ThreadPoolExecutor(max_workers=len(SOURCE_NAMES)) as executor:
+        return dict(zip(SOURCE_NAMES, executor.map(get_source_folders, SOURCE_NAMES)))
+
+
+def source_of(folder):
+    "Name of the source a raw folder belongs to"
+    for name in SOURCE_NAMES:
+        if folder.startswith(SOURCES[name]['folder'] + '/'):
+            return name
+    raise Exception(f"No moodys source for {folder}")
 
 
-def apply_transformations(df,file_path):
+def apply_transformations(df, cleaned_writer, source):
     """
-    It applies transformations on df
-    and returned transformed df
+    It applies transformations on a batch of rows of df,
+    writes the cleaned rows to cleaned_writer
+    and returned transformed df, sorted by process_folder once the whole file is read
     """
     try:
-        # df['Date'] = (list(map(lambda x: datetime.strptime(
-        #     x, "%Y-%m-%d").strftime("%Y-%m-%d"), df['Date'])))
-        df['Date'] = pd.to_datetime(df['Date'], format="%Y-%m-%d")
+        # rename date to Date
+        df.rename(columns={source['date_column']: 'Date'}, inplace=True)
+
+        # `2010Q1 type quarters to the quarter end date, months and days as is
+        df['Date'] = dates.parse_periods(df['Date'])
         # cleaned data save
-        # save_csv_cleaned(df, file_path)
-        save_parquet_cleaned(df, file_path)
+        cleaned_writer.write(df)
 
         # Format date
-        df['Date'] = pd.to_datetime(df['Date'])
-        df['Date'] = df['Date'].apply(lambda x: x.replace(day=1))
-
-        # ordering
-        return df.sort_values(by=['Date'], ascending=True)
+        df['Date'] = dates.month_start(df['Date'])
+        return df
 
     except Exception as err:
         logger.error(f"Error while transformation: {err}")
+        raise Exception(f"while transformation: {err}")
 
-if __name__ == "__main__":
-    logger.info("-- start --")
-    folders = get_folder_list()
+def process_folder(folder, files):
+    """
+    It streams every file of one raw folder to the cleaned layer, the transformed
+    file (one row per period) is sorted by Date as a whole and written once
+    """
+    source = SOURCES[source_of(folder)]
+    for file_path in files:
+        logger.debug(file_path)
+        # stream the file in row batches to keep memory flat
+        batches = []
+        # one stage per file, read, transformed and written batch by batch
+        with metrics.stage('stream', file=file_path) as stage, \
+                s3io.ParquetStreamWriter(BUCKET, file_path, CLEANED_DIR) as cleaned_writer, \
+                s3io.ParquetStreamWriter(BUCKET, file_path) as transformed_writer:
+            for df in s3io.iter_csv_chunks(BUCKET, file_path):
+                batches.append(apply_transformations(df, cleaned_writer, source))
+            if batches:
+                # ordering, over the whole file
+                transformed_df = stage.frame(pd.concat(batches).sort_values(by=['Date'], ascending=True))
+                transformed_writer.write(transformed_df)
+
+
+def update_mnemonic_files():
+    """
+    Publish the mnemonics file of every source from its config folder to transformed data,
+    only the changed ones are copied. It returns the files copied
+    """
+    pairs = [(f"{SOURCES[name]['config']}/{name}_mnemonics.csv",
+              f"{TRANSFORMED_DIR}/mnemonics/{name}_mnemonics/{name}_mnemonics.csv")
+             for name in SOURCE_NAMES]
+    copied = config_sync.sync_objects(BUCKET, pairs)
+    logger.info(f"Mnemonics files updated: {copied}")
+    return copied
+
+
+def main():
+    "Process the new or changed raw folders and publish the outputs"
+    logger.info(f"-- start -- sources: {SOURCE_NAMES}")
+    with metrics.stage('list'):
+        source_folders = get_folder_list()
+    folders = {folder: files for name in SOURCE_NAMES for folder, files in source_folders[name].items()}
     if folders:
-        for folder, files in folders.items():
-            for file_path in files:
-                logger.debug(file_path)
-                df = read_csv(file_path)
-                transformed_df = apply_transformations(df,file_path)
-                if not transformed_df.empty:
-                    # save_csv(transformed_df, file_path)
-                    save_parquet(transformed_df, file_path)
-
-        # Update mnemonics file from raw to transformed data
-        try:
-            MNEMONIC_FILE = f"{TRANSFORMED_DIR}/mnemonics/moodys_all_mnemonics/moodys_all_mnemonics.csv"
-            logger.info(f"Updating mnemonics file: {MNEMONIC_FILE}")
-            logger.info( f"{CONFIG}/moodys_all_mnemonics.csv")
-            copy_source = {
-                'Bucket': f"{BUCKET}",
-                'Key': f"{CONFIG}/moodys_all_mnemonics.csv"
-            }
-            s3_resource.meta.client.copy(copy_source, f"{BUCKET}", MNEMONIC_FILE)
-        except Exception as err:
-            logger.error(f"Exception while mnenomics file {err}")
-
-        # trigger crawlers
-        try:
-            logger.info(f"Triggering Crawlers {CRAWLER1},{CRAWLER2}")
-            glue_client = boto3.client('glue')
-            glue_client.start_crawler(Name=CRAWLER1)
-            glue_client.start_crawler(Name=CRAWLER2)
-        except Exception as err:
-            logger.error(f"Exception while triggering crawler {err}")
+        # the folders of all the sources are processed together
+        results, failures = parallel.run_folders(process_folder, folders, WORKERS)
+        for name in SOURCE_NAMES:
+            if not source_folders[name]:
+                continue
+            done = {folder: files for folder, files in source_folders[name].items()
+                    if folder not in failures}
+            manifest.mark_processed(BUCKET, SOURCES[name]['folder'], done)
     else:
         logger.info("No new dir to process")
+
+    # Update mnemonics files from raw to transformed data, when they changed
+    with metrics.stage('sync_config'):
+        copied = update_mnemonic_files()
+
+    if folders or copied:
+        # register the new partitions, a crawl is only scheduled for a new table or a schema change
+        with metrics.stage('publish'):
+            catalog.publish(BUCKET, [CRAWLER1, CRAWLER2], s3io.pop_outputs())
+
+
+if __name__ == "__main__":
+    startup.log_import_time()
+    main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Short Desc: This programe runs several ETL Glue Jobs of kearney sensing solution in one process
+
+Each transformation job (covid, ihs, fred, meteostat, yahoofin, moodys) is
+run here as a stage of one pythonshell job, so the imports, the pooled S3
+client, the reference files (krny_common.refdata) and the catalog lookups
+are paid once and the independent sources run concurrently (one thread
+per stage). The end-to-end time is about the longest stage instead of the
+sum of the job runs with their cold starts.
+
+The arguments of a stage are those of its own Glue job
+(transformation-<stage>), overridden by --stage_args and by the common
+arguments below. Stages run their folders one by one (workers=1): the
+process is threaded, forking it is not safe. The outputs of all the stages
+are published to the catalog once at the end (krny_common.catalog).
+
+similarweb and google are not stages, their scripts do not run anything.
+
+Usage: This script meant for AWS Glue Job -ETL
+with Job Parameters as:
+    --bucket: <bucketname>
+    --crawler_cleaneddata: <crawler name for cleaned data>
+    --crawler_transformeddata: <crawler name for tarnsformed data>
+    --stages: <comma separated stages to run, optional (all)>
+    --stage_args: <json {stage: {argument: value}} added to the Glue job arguments, optional>
+    --concurrency: <number of stages run at the same time, optional (all)>
+    --output_format: <csv or parquet, optional>
+
+"""
+
+__author__ = "Divesh Chandolia"
+__copyright__ = "Copyright 2023, Kearney Sensing Solution"
+__version__ = "1.0.1"
+__maintainer__ = "Divesh Chandolia"
+__email__ = "dchand01@atkearney.com"
+__date__ = "March 2023"
+
+# builtin imports
+import json
+import logging
+import os
+import runpy
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared helpers
+from krny_common import s3io, catalog, metrics, startup
+
+# Platform specific imports
+from awsglue.utils import getResolvedOptions
+args = getResolvedOptions(sys.argv, [
+    'bucket',
+    'crawler_cleaneddata',
+    'crawler_transformeddata'
+])
+
+# stage -> job script module, the scripts come with --extra-py-files (krny_jobs.zip)
+STAGES = {
+    'covid': 'krny_trnsf_covid',
+    'ihs': 'krny_trnsf_ihs',
+    'fred': 'krny_trnsf_fred',
+    'meteostat': 'krny_trnsf_meteostat',
+    'yahoofin': 'krny_trnsf_yahoofin',
+    'moodys': 'krny_trnsf_moodys',
+}
+# job folders next to this one, used when the scripts are not packaged (local runs)
+JOBS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BUCKET = args.get('bucket')
+
+# get crawler name
+CRAWLER1 = args.get('crawler_cleaneddata')
+CRAWLER2 = args.get('crawler_transformeddata')
+
+STAGE_NAMES = getResolvedOptions(sys.argv, ['stages'])['stages'].split(',') \
+    if '--stages' in sys.argv else list(STAGES)
+STAGE_ARGS = json.loads(getResolvedOptions(sys.argv, ['stage_args'])['stage_args']) \
+    if '--stage_args' in sys.argv else {}
+CONCURRENCY = int(getResolvedOptions(sys.argv, ['concurrency'])['concurrency']) \
+    if '--concurrency' in sys.argv else len(STAGE_NAMES)
+
+# passed to every stage
+COMMON_ARGS = {
+    'bucket': BUCKET,
+    'crawler_cleaneddata': CRAWLER1,
+    'crawler_transformeddata': CRAWLER2,
+    'workers': '1',
+}
+if '--output_format' in sys.argv:
+    COMMON_ARGS['output_format'] = getResolvedOptions(sys.argv, ['output_format'])['output_format']
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter(
+    '%(asctime)s - %(threadName)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# sys.argv is swapped while a stage script is loaded
+_load_lock = threading.Lock()
+
+
+def get_stage_args(stage):
+    "Arguments of a stage: its Glue job default arguments, --stage_args, then the common ones"
+    stage_args = {}
+    if stage not in STAGE_ARGS:
+        try:
+            job = s3io.get_client('glue').get_job(JobName=f"transformation-{stage}")['Job']
+            stage_args = {name.lstrip('-'): str(value) for name, value in job.get('DefaultArguments', {}).items()}
+        except Exception as err:
+            logger.error(f"Error while reading the arguments of job transformation-{stage}: {err}")
+            raise Exception(f"No arguments for stage {stage}: {err}")
+    stage_args.update(STAGE_ARGS.get(stage, {}))
+    if stage_args.get('workers', '1') != '1':
+        logger.warning(f"Stage {stage} runs its folders one by one, workers={stage_args['workers']} ignored")
+    stage_args.update(COMMON_ARGS)
+    return stage_args
+
+
+def load_stage(stage):
+    """
+    Run the module level code of the stage script with its arguments and
+    return its main function. The script is not run as __main__, so only
+    its set up (arguments, constants) is done here.
+    """
+    argv = [item for name, value in get_stage_args(stage).items() for item in (f"--{name}", value)]
+    script = os.path.join(JOBS_DIR, f"transformation-{stage}", f"{STAGES[stage]}.py")
+    root = logging.getLogger()
+    with _load_lock:
+        saved_argv, saved_handlers = sys.argv, root.handlers[:]
+        sys.argv = [f"{STAGES[stage]}.py"] + argv
+        try:
+            if os.path.exists(script):
+                namespace = runpy.run_path(script, run_name=STAGES[stage])
+            else:
+                namespace = runpy.run_module(STAGES[stage], run_name=STAGES[stage])
+        finally:
+            # every script adds its own log handler, the pipeline one is kept only
+            sys.argv, root.handlers = saved_argv, saved_handlers
+    return namespace['main']
+
+
+def run_stage(stage, main):
+    """
+    Run the main of a stage in this thread. Return (None or the error
+    message, the outputs saved by the stage), s3io keeps them per thread.
+    """
+    threading.current_thread().name = stage
+    metrics.set_job(STAGES[stage])
+    logger.info(f"-- start stage {stage} --")
+    error = None
+    try:
+        with metrics.stage('job'):
+            main()
+    except (Exception, SystemExit) as err:
+        logger.error(f"Error while running stage {stage}: {err!r}")
+        error = repr(err)
+    else:
+        logger.info(f"-- end stage {stage} --")
+    return error, s3io.pop_outputs()
+
+
+def main():
+    "Load the stages, run them concurrently and publish their outputs once"
+    unknown = [stage for stage in STAGE_NAMES if stage not in STAGES]
+    if unknown:
+        raise Exception(f"Unknown stages {unknown}, expected some of {list(STAGES)}")
+    logger.info(f"-- start -- stages: {STAGE_NAMES}")
+
+    # the outputs of all the stages are published together below
+    catalog.DEFERRED = True
+
+    failures = {}
+    outputs = []
+    mains = {}
+    for stage in STAGE_NAMES:
+        try:
+            with metrics.stage('load', stage_name=stage):
+                mains[stage] = load_stage(stage)
+        except (Exception, SystemExit) as err:
+            logger.error(f"Error while loading stage {stage}: {err!r}")
+            failures[stage] = repr(err)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(CONCURRENCY, len(mains)))) as executor:
+        futures = {stage: executor.submit(run_stage, stage, stage_main) for stage, stage_main in mains.items()}
+        for stage, future in futures.items():
+            error, stage_outputs = future.result()
+            outputs.extend(stage_outputs)
+            if error is not None:
+                failures[stage] = error
+
+    catalog.DEFERRED = False
+    with metrics.stage('publish'):
+        catalog.publish(BUCKET, [CRAWLER1, CRAWLER2], outputs)
+
+    if failures:
+        raise Exception(f"{len(failures)} of {len(STAGE_NAMES)} stages failed: {failures}")
+    logger.info("-- end --")
+
+
+if __name__ == "__main__":
+    startup.log_import_time()
+    main()
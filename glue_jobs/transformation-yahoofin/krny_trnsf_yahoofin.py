@@ -12,6 +12,8 @@ with Job Parameters as:
     --bucket: <bucketname>
     --folder: <folder path of yahoo_finance rawdata>
     --table_name: <dynamodb table name of yahoo securites with col ticker and ticeker_name>
+    --output_format: <csv or parquet, optional>
+    --workers: <number of folders processed in parallel, optional>
 
 """
 
@@ -24,15 +26,14 @@ __date__ = "March 2023"
 
 # builtin imports 
 import logging
-import os
-from io import StringIO
 import sys
+from functools import partial
 
 # Lib
 import pandas as pd
-import numpy as np
-from sklearn.preprocessing import normalize
-import boto3
+
+# Shared helpers
+from krny_common import s3io, manifest, parallel, mapper, catalog, metrics, startup, CLEANED_DIR
 
 # Platform specific imports
 from awsglue.utils import getResolvedOptions
@@ -47,16 +48,20 @@ args = getResolvedOptions(sys.argv, [
 # source data
 BUCKET = args['bucket']
 FOLDER = args['folder']
+SRC_DIR = FOLDER
 MAPPER_TABLE = args['table_name']
 
 # get crawler name
 CRAWLER1 = args.get('crawler_cleaneddata')
 CRAWLER2 = args.get('crawler_transformeddata')
 
-# Data layers in the S3 bucket
-RAW_DIR = 'raw-data'
-CLEANED_DIR = 'cleaned-data'
-TRANSFORMED_DIR = 'transformed-data'
+# output format of cleaned and transformed data: csv (default) or parquet
+OUTPUT_FORMAT = getResolvedOptions(sys.argv, ['output_format'])['output_format'] \
+    if '--output_format' in sys.argv else 'csv'
+
+# number of folders processed in parallel (forked processes), 1 runs them one by one
+WORKERS = int(getResolvedOptions(sys.argv, ['workers'])['workers']) \
+    if '--workers' in sys.argv else 1
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -67,102 +72,28 @@ formatter = logging.Formatter(
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
-s3_resource = boto3.resource('s3')
-bucket = s3_resource.Bucket(BUCKET)
-
-client = boto3.client('s3')
-# paginator = client.get_paginator('list_objects_v2')
-# result = paginator.paginate(Bucket=BUCKET,Prefix=FOLDER)
-
 
 def get_mapper():
     "It retrives ticker and ticker_name from dynamodb table for mapping column name"
     try:
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(MAPPER_TABLE)
-        response = table.scan()
-        data = response['Items']
-
-        return {item['ticker']: item['ticker_name'] for item in data}
+        # paginated scan, read from its S3 snapshot when there is one (refreshed after the run)
+        return mapper.load_mapper(MAPPER_TABLE, 'ticker', 'ticker_name', BUCKET)
     except Exception as err:
         logger.error(f"Error while reading mapper: {err}")
         raise Exception(f"Exception raised: {err}")
 
 
-def read_csv(file_path, **kwargs):
-    "Read data file and return pd dataframe"
-    logger.info(f"Reading file: {file_path}")
-    try:
-        response = client.get_object(Bucket=BUCKET, Key=file_path)
-        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
-        if status == 200:
-            logger.info(
-                f"Successful S3 get_object response. Status - {status}")
-            return pd.read_csv(response.get("Body"))
-    except Exception as err:
-        logger.error(f"Error while reading: {err}")
-
-
-def save_csv(df, file_path):
-    "Save the DataFrame as CSV in transformed directory"
-    try:
-        dst_path = file_path.replace(RAW_DIR, TRANSFORMED_DIR)
-        logger.info(f"Saving file {dst_path}")
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer)
-        s3_resource.Object(BUCKET, dst_path).put(Body=csv_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
-        
-def save_csv_cleaned(df, file_path):
-    "Save the DataFrame as CSV in cleaned data dir"
-    try:
-        dst_path = file_path.replace(RAW_DIR, CLEANED_DIR)
-        logger.info(f"Saving file {dst_path}")
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
-        s3_resource.Object(BUCKET, dst_path).put(Body=csv_buffer.getvalue())
-    except Exception as err:
-        logger.error(f"Error while saving: {err}")
-
-
 def get_folder_list():
-    #     def get_folder_dict():
     """
-    This function returns the list for folders from raw-data which do not exists in transform-data.
-    ie. only incremented / newly added directory will be returned
+    This function returns the dict of folders (with their files) from raw-data which are
+    new or changed since the last processed run, as per the processed-partition manifest.
+    ie. only incremented / newly added / updated directory will be returned
     """
-    src_dict = {}
-    dst_dict = {}
-    SRC_DIR = FOLDER
-    DST_DIR = SRC_DIR.replace(RAW_DIR, TRANSFORMED_DIR)
-
-    try:
-        for objects in bucket.objects.filter(Prefix=SRC_DIR):
-            path_str = objects.key
-            if path_str.endswith(".csv"):
-                dirname = os.path.dirname(path_str)
-                try:
-                    src_dict[dirname].append(path_str)
-                except:
-                    src_dict[dirname] = [path_str,]
-    except Exception as error:
-        logger.error(f"Error: {error}")
-
     try:
-        for objects in bucket.objects.filter(Prefix=DST_DIR):
-            path_str = objects.key
-            if path_str.endswith(".csv"):
-                dirname = os.path.dirname(path_str)
-                try:
-                    dst_dict[dirname].append(path_str)
-                except:
-                    dst_dict[dirname] = [path_str,]
+        return manifest.get_changed_folders(BUCKET, SRC_DIR)
     except Exception as error:
         logger.error(f"Error: {error}")
-
-    dst_dict = {k.replace(TRANSFORMED_DIR, RAW_DIR): v for (k, v) in dst_dict.items()}
-    return {k: src_dict[k] for k in set(src_dict) - set(dst_dict)}
+        return {}
 
 
 def apply_transformations(df, mapper_dict, file_path):
@@ -189,7 +120,7 @@ def apply_transformations(df, mapper_dict, file_path):
         df['Date'] = pd.to_datetime(df['Date'])
         
         # save cleaned data
-        save_csv_cleaned(df, file_path)
+        s3io.save_frame(df, BUCKET, file_path, CLEANED_DIR, OUTPUT_FORMAT)
 
         # Group the data by month, and get the data on the first day of each month
         df = df.groupby(pd.Grouper(key='Date', freq='MS')).first()
@@ -202,26 +133,37 @@ def apply_transformations(df, mapper_dict, file_path):
         raise Exception(f"Exception raised: {err}")
 
 
-if __name__ == "__main__":
+def process_folder(folder, files, mapper_dict):
+    "It transforms and saves every file of one raw folder"
+    for file_path, df in metrics.iter_stage('read', s3io.iter_csv(BUCKET, files)):
+        with metrics.stage('transform', file=file_path) as stage:
+            transformed_df = stage.frame(apply_transformations(
+                df, mapper_dict, file_path))
+        with metrics.stage('write', file=file_path) as stage:
+            s3io.save_frame(stage.frame(transformed_df), BUCKET, file_path, file_format=OUTPUT_FORMAT, index=True)
+
+
+def main():
+    "Process the new or changed raw folders and publish the outputs"
     logger.info("-- start --")
-    folders = get_folder_list()
+    with metrics.stage('list'):
+        folders = get_folder_list()
     if folders:
         mapper_dict = get_mapper()
         logger.debug(f"folders--{folders}")
         logger.debug(f"mapper_dict--{mapper_dict}")
-        for folder, files in folders.items():
-            for file_path in files:
-                df = read_csv(file_path)
-                transformed_df = apply_transformations(
-                    df, mapper_dict, file_path)
-                save_csv(transformed_df, file_path)
-        # trigger crawlers
-        try:
-            logger.info("Triggering Crawlers")
-            glue_client = boto3.client('glue')
-            glue_client.start_crawler(Name=CRAWLER1)
-            glue_client.start_crawler(Name=CRAWLER2)
-        except Exception as err:
-            logger.error(f"Exception while triggering crawler {err}")
+        results, failures = parallel.run_folders(partial(process_folder, mapper_dict=mapper_dict), folders, WORKERS)
+        done = {folder: files for folder, files in folders.items() if folder not in failures}
+        manifest.mark_processed(BUCKET, SRC_DIR, done)
+        # register the new partitions, a crawl is only scheduled for a new table or a schema change
+        with metrics.stage('publish'):
+            catalog.publish(BUCKET, [CRAWLER1, CRAWLER2], s3io.pop_outputs())
     else:
         logger.info("No new dir to process")
+    # scan the mapper table again when its snapshot was old, for the next run
+    mapper.refresh_stale()
+
+
+if __name__ == "__main__":
+    startup.log_import_time()
+    main()